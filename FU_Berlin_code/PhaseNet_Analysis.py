@@ -11,8 +11,11 @@ import datetime
 from scipy.spatial import distance_matrix
 import matplotlib.pyplot as plt
 
+from phasenet_picks import read_phasenet_picks
+
 obspy.UTCDateTime.DEFAULT_PRECISION = 3
 
+
 class PhaseNet_Analysis (object):
 
     '''
@@ -326,16 +329,7 @@ class PhaseNet_Analysis (object):
         picks_csv.loc[:, 's_idx'] = picks_csv["s_idx"].apply(lambda x: x.strip("[]").split(","))
         picks_csv.loc[:, 's_prob'] = picks_csv["s_prob"].apply(lambda x: x.strip("[]").split(","))
 
-        with open(os.path.join(self.PROJECT_ROOT, "results/picks.json")) as fp:
-            picks_json = json.load(fp)
-        
-        if len (picks_json) == 0:
-            df_p_picks = pd.DataFrame({'A' : []})
-            df_s_picks = pd.DataFrame({'B' : []})
-        else:
-            df = pd.DataFrame.from_dict(pd.json_normalize(picks_json), orient='columns')
-            df_p_picks = df[df["type"] == 'p']
-            df_s_picks = df[df["type"] == 's']
+        df_p_picks, df_s_picks = read_phasenet_picks(self.PROJECT_ROOT)
 
         return df_p_picks, df_s_picks
     
@@ -362,6 +356,10 @@ class PhaseNet_Analysis (object):
             3- take the maximum amplitude between s pick time and the next 15 seconds data for each trace.
              in case of appearing a p picks within 15 seconds window, decrease the time window exactly before the p picks.
         '''
+        # stations without picks
+        if (p_picks.empty == True) and (s_picks.empty == True):
+            return p_picks, s_picks
+
         amplitude_p = np.empty([p_picks.shape[0], 4])
         
         # create an numpy array to store p_picks time in numpy array. this file array will be use to
@@ -369,7 +367,7 @@ class PhaseNet_Analysis (object):
 
         p_picks__time_arr = np.zeros((p_picks.shape[0],1))
 
-        stream = self.read_data (p_picks.id.iloc[0])
+        stream = self.read_data (pd.concat([p_picks.id, s_picks.id]).iloc[0])
         # create timstamp data in nano second
         timestamp_0 = pd.to_datetime(stream[0].times("timestamp"), unit='s', origin='unix').astype(int) / 10**9
         timestamp_1 = pd.to_datetime(stream[1].times("timestamp"), unit='s', origin='unix').astype(int) / 10**9
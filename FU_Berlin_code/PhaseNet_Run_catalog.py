@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 from subprocess import call
 import pickle
 
+from phasenet_picks import read_phasenet_picks
 
 
 class P_S_Picker(object):
@@ -234,12 +235,7 @@ class P_S_Picker(object):
         picks_csv.loc[:, 's_idx'] = picks_csv["s_idx"].apply(lambda x: x.strip("[]").split(","))
         picks_csv.loc[:, 's_prob'] = picks_csv["s_prob"].apply(lambda x: x.strip("[]").split(","))
 
-        with open(os.path.join(self.PROJECT_ROOT, "results/picks.json")) as fp:
-            picks_json = json.load(fp)
-        
-        df = pd.DataFrame.from_dict(pd.json_normalize(picks_json), orient='columns')
-        df_p_waves = df[df["type"] == 'p']
-        df_s_waves = df[df["type"] == 's']
+        df_p_waves, df_s_waves = read_phasenet_picks(self.PROJECT_ROOT)
 
         return df_p_waves, df_s_waves
     
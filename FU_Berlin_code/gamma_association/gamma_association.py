@@ -9,6 +9,18 @@ import os
 import json
 import pickle
 from tqdm import tqdm
+import sys
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--phasenet_dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."),
+                    help="PhaseNet checkout providing read_picks_json")
+parser.add_argument("--picks", default="/home/javak/phasenet_chile-subduction-zone-main/FU_Berlin_code/gamma_association/test_data/picks.json",
+                    help="PhaseNet picks: json, jsonl or jsonl.gz")
+args = parser.parse_args()
+## the phasenet modules import each other as top-level modules
+sys.path.insert(0, os.path.abspath(os.path.join(args.phasenet_dir, "phasenet")))
+from postprocess import read_picks_json
 
 data_dir = lambda x: os.path.join("test_data", x)
 station_csv = data_dir("stations.csv")
@@ -28,7 +40,9 @@ config = {'center': (-117.504, 35.705),
     'endtime': datetime(2019, 7, 5, 0, 0)}
 
 ## read picks
-picks = pd.read_json('/home/javak/phasenet_chile-subduction-zone-main/FU_Berlin_code/gamma_association/test_data/picks.json')
+picks = read_picks_json(args.picks)
+if len(picks) == 0:
+    sys.exit(f"No picks in {args.picks}")
 picks["time_idx"] = picks["timestamp"].apply(lambda x: x.strftime("%Y-%m-%dT%H")) ## process by hours
 
 ## read stations
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pandas as pd
+
+COLUMNS = ["id", "timestamp", "prob", "type"]
+
+
+def import_read_picks_json(phasenet_direc):
+    '''
+    read_picks_json of the PhaseNet checkout in phasenet_direc. The phasenet modules import each other
+    as top-level modules, so their directory has to be on sys.path.
+    '''
+    code_direc = os.path.abspath(os.path.join(phasenet_direc, "phasenet"))
+    if code_direc not in sys.path:
+        sys.path.insert(0, code_direc)
+    from postprocess import read_picks_json
+    return read_picks_json
+
+
+def read_phasenet_picks(phasenet_direc):
+    '''
+    Read the picks of the last PhaseNet run in phasenet_direc/results (picks.jsonl.gz, picks.jsonl or picks.json).
+
+        Output:
+                - df_p_picks (dataframe): P picks with the columns id, timestamp, prob and type
+                - df_s_picks (dataframe): S picks, both empty if PhaseNet found none
+    '''
+    read_picks_json = import_read_picks_json(phasenet_direc)
+
+    results_direc = os.path.join(phasenet_direc, "results")
+    fname = [os.path.join(results_direc, x) for x in ["picks.jsonl.gz", "picks.jsonl", "picks.json"]]
+    fname = [x for x in fname if os.path.exists(x)]
+    if len(fname) == 0:
+        print('No PhaseNet picks found in {0}'.format(results_direc))
+        return pd.DataFrame(columns=COLUMNS), pd.DataFrame(columns=COLUMNS)
+    df = read_picks_json(fname[0], convert_dates=False)
+
+    return df[df["type"] == 'p'], df[df["type"] == 's']
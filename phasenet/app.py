@@ -1,18 +1,30 @@
+import io
 import os
+import queue
+import threading
+import time
 from collections import defaultdict, namedtuple
+from contextlib import asynccontextmanager
+from concurrent.futures import Future
 from datetime import datetime, timedelta
 from json import dumps
 from typing import Any, AnyStr, Dict, List, NamedTuple, Union, Optional
 
 import numpy as np
-import requests
 import tensorflow as tf
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request
 from kafka import KafkaProducer
 from pydantic import BaseModel
 from scipy.interpolate import interp1d
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 
+from gamma_client import GammaClient
+from inference_worker import WorkerPool
+from kafka_publisher import RAW_HEADER, RAW_MAGIC, KafkaPublisher
+from metrics import SIZE_BUCKETS, Counter, Gauge, Histogram, render
 from model import ModelConfig, UNet
+from prediction_cache import PredictionCache
 from postprocess import extract_amplitude, extract_picks
 
 tf.compat.v1.disable_eager_execution()
@@ -22,57 +34,171 @@ JSONObject = Dict[AnyStr, Any]
 JSONArray = List[Any]
 JSONStructure = Union[JSONArray, JSONObject]
 
-app = FastAPI()
 X_SHAPE = [3000, 1, 3]
 SAMPLING_RATE = 100
-
-# load model
-model = UNet(mode="pred")
-sess_config = tf.compat.v1.ConfigProto()
-sess_config.gpu_options.allow_growth = True
-
-sess = tf.compat.v1.Session(config=sess_config)
-saver = tf.compat.v1.train.Saver(tf.compat.v1.global_variables())
-init = tf.compat.v1.global_variables_initializer()
-sess.run(init)
-latest_check_point = tf.train.latest_checkpoint(f"{PROJECT_ROOT}/model/190703-214543")
-print(f"restoring model {latest_check_point}")
-saver.restore(sess, latest_check_point)
+# micro-batching: wait up to BATCH_MAX_WAIT_MS for up to BATCH_MAX_SIZE stations
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", 10))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 64))
+# inference: INFERENCE_WORKERS processes with their own sessions, or 0 for one session in the API process;
+# thread counts of 0 let TF decide in-process, and split the cores evenly between worker processes
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 0))
+INTRA_OP_THREADS = int(os.getenv("INTRA_OP_THREADS", 0))
+INTER_OP_THREADS = int(os.getenv("INTER_OP_THREADS", 0))
+CHECKPOINT_DIR = f"{PROJECT_ROOT}/model/190703-214543"
+# cache of per-window probabilities and picks, PREDICTION_CACHE_MB = 0 disables it
+PREDICTION_CACHE_MB = float(os.getenv("PREDICTION_CACHE_MB", 0))
+PREDICTION_CACHE_TTL = float(os.getenv("PREDICTION_CACHE_TTL", 300))
+# picks are extracted with the extract_picks defaults; change the namespace with them
+PREDICTION_CACHE_NAMESPACE = f"{CHECKPOINT_DIR}|min_p_prob=0.3,min_s_prob=0.3,mpd=50"
+CHN2IDX = {"E": 0, "N": 1, "Z": 2, "3": 0, "2": 1, "1": 2}
+# streaming: windows of X_SHAPE[0] samples overlapping by STREAM_OVERLAP samples; drop stations idle for STREAM_TTL seconds
+STREAM_OVERLAP = int(os.getenv("STREAM_OVERLAP", 1000))
+STREAM_TTL = float(os.getenv("STREAM_TTL", 600))
 
 # GAMMA API Endpoint
 GAMMA_API_URL = "http://gamma-api:8001"
 # GAMMA_API_URL = 'http://localhost:8001'
 # GAMMA_API_URL = "http://gamma.quakeflow.com"
 # GAMMA_API_URL = "http://127.0.0.1:8001"
-
-# Kafak producer
-use_kafka = False
-
-try:
-    print("Connecting to k8s kafka")
-    BROKER_URL = "quakeflow-kafka-headless:9092"
-    # BROKER_URL = "34.83.137.139:9094"
-    producer = KafkaProducer(
-        bootstrap_servers=[BROKER_URL],
-        key_serializer=lambda x: dumps(x).encode("utf-8"),
-        value_serializer=lambda x: dumps(x).encode("utf-8"),
+GAMMA_TIMEOUT = float(os.getenv("GAMMA_TIMEOUT", 10))
+GAMMA_MAX_CONNECTIONS = int(os.getenv("GAMMA_MAX_CONNECTIONS", 10))
+# merge picks of streaming requests arriving within GAMMA_COALESCE_MS into one association call; 0 disables
+GAMMA_COALESCE_MS = float(os.getenv("GAMMA_COALESCE_MS", 0))
+
+# Kafak producer, tried in order: k8s, then local
+BROKER_URLS = ["quakeflow-kafka-headless:9092", "localhost:9092"]
+# BROKER_URLS = ["34.83.137.139:9094"]
+KAFKA_MAX_BACKOFF = 60
+KAFKA_MAX_QUEUE = int(os.getenv("KAFKA_MAX_QUEUE", 1000))
+# "json": one message per pick and JSON waveforms as in earlier releases; "binary": see kafka_publisher.py
+KAFKA_WIRE_FORMAT = os.getenv("KAFKA_WIRE_FORMAT", "json")
+
+model = None
+sess = None
+worker_pool = None
+producer = None
+publisher = None
+gamma_client = None
+prediction_cache = None
+if PREDICTION_CACHE_MB > 0:
+    prediction_cache = PredictionCache(
+        int(PREDICTION_CACHE_MB * 1024 ** 2), ttl=PREDICTION_CACHE_TTL, namespace=PREDICTION_CACHE_NAMESPACE
     )
-    use_kafka = True
-    print("k8s kafka connection success!")
-except BaseException:
-    print("k8s Kafka connection error")
-    try:
-        print("Connecting to local kafka")
-        producer = KafkaProducer(
-            bootstrap_servers=["localhost:9092"],
-            key_serializer=lambda x: dumps(x).encode("utf-8"),
-            value_serializer=lambda x: dumps(x).encode("utf-8"),
+use_kafka = False
+model_ready = threading.Event()
+shutdown = threading.Event()
+
+
+def load_model():
+    global model, sess, worker_pool
+    # pay TF's first-run cost at the batch shapes requests will use
+    warmup_shapes = [[nsta] + X_SHAPE for nsta in sorted({1, BATCH_MAX_SIZE})]
+
+    if INFERENCE_WORKERS > 0:
+        worker_pool = WorkerPool(
+            CHECKPOINT_DIR,
+            num_workers=INFERENCE_WORKERS,
+            intra_op_threads=INTRA_OP_THREADS or max(os.cpu_count() // INFERENCE_WORKERS, 1),
+            inter_op_threads=INTER_OP_THREADS or 1,
+            warmup_shapes=warmup_shapes,
         )
-        use_kafka = True
-        print("local kafka connection success!")
-    except BaseException:
-        print("local Kafka connection error")
-print(f"Kafka status: {use_kafka}")
+        worker_pool.wait_ready()
+        model_ready.set()
+        print(f"{INFERENCE_WORKERS} inference workers ready")
+        return
+
+    model = UNet(mode="pred")
+    sess_config = tf.compat.v1.ConfigProto(
+        intra_op_parallelism_threads=INTRA_OP_THREADS, inter_op_parallelism_threads=INTER_OP_THREADS
+    )
+    sess_config.gpu_options.allow_growth = True
+
+    sess = tf.compat.v1.Session(config=sess_config)
+    saver = tf.compat.v1.train.Saver(tf.compat.v1.global_variables())
+    init = tf.compat.v1.global_variables_initializer()
+    sess.run(init)
+    latest_check_point = tf.train.latest_checkpoint(CHECKPOINT_DIR)
+    print(f"restoring model {latest_check_point}")
+    saver.restore(sess, latest_check_point)
+
+    for shape in warmup_shapes:
+        run_model(np.zeros(shape, dtype=np.float32))
+    model_ready.set()
+    print("model warm-up finished")
+
+
+def connect_kafka():
+    global producer, publisher, use_kafka
+    backoff = 1
+    while not shutdown.is_set():
+        for broker_url in BROKER_URLS:
+            try:
+                print(f"Connecting to kafka {broker_url}")
+                producer = KafkaProducer(
+                    bootstrap_servers=[broker_url],
+                    key_serializer=lambda x: dumps(x).encode("utf-8"),
+                )
+                publisher = KafkaPublisher(producer, max_queue=KAFKA_MAX_QUEUE, wire_format=KAFKA_WIRE_FORMAT)
+                use_kafka = True
+                print(f"kafka {broker_url} connection success!")
+                return
+            except BaseException:
+                print(f"kafka {broker_url} connection error")
+        print(f"Retry kafka connection in {backoff}s")
+        shutdown.wait(backoff)
+        backoff = min(backoff * 2, KAFKA_MAX_BACKOFF)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global gamma_client
+    gamma_client = GammaClient(
+        GAMMA_API_URL, timeout=GAMMA_TIMEOUT, max_connections=GAMMA_MAX_CONNECTIONS, coalesce_ms=GAMMA_COALESCE_MS
+    )
+    threading.Thread(target=load_model, daemon=True).start()
+    threading.Thread(target=connect_kafka, daemon=True).start()
+    yield
+    shutdown.set()
+    await gamma_client.aclose()
+    if publisher is not None:
+        publisher.close()
+    if producer is not None:
+        producer.close()
+    if sess is not None:
+        sess.close()
+    if worker_pool is not None:
+        worker_pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+REQUEST_SECONDS = Histogram("phasenet_request_seconds", "Request latency by endpoint", labelnames=["endpoint"])
+STAGE_SECONDS = Histogram(
+    "phasenet_stage_seconds", "Latency of decode, normalize, inference, picking and serialize", labelnames=["stage"]
+)
+BATCH_SIZE = Histogram("phasenet_batch_size", "Stations per sess.run batch", buckets=SIZE_BUCKETS)
+REQUEST_STATIONS = Histogram("phasenet_request_stations", "Stations per request", buckets=SIZE_BUCKETS)
+PICKS_TOTAL = Counter("phasenet_picks_total", "Picks returned, rate() gives picks per second", labelnames=["type"])
+QUEUE_DEPTH = Gauge(
+    "phasenet_queue_depth",
+    "Items waiting in the micro-batch and Kafka queues",
+    lambda: {("batch",): batcher.queue.qsize(), ("kafka",): publisher.queue.qsize() if publisher is not None else 0},
+    labelnames=["queue"],
+)
+CACHE_REQUESTS = Counter("phasenet_cache_requests_total", "Prediction cache lookups per window", labelnames=["result"])
+CACHE_BYTES = Gauge(
+    "phasenet_cache_bytes", "Memory held by the prediction cache", lambda: prediction_cache.nbytes if prediction_cache else 0
+)
+
+
+@app.middleware("http")
+async def record_latency(request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    if route is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, route.path)
+    return response
 
 
 def normalize_batch(data, window=3000):
@@ -130,8 +256,8 @@ def format_picks(picks, dt, amplitudes):
                     {
                         "id": pick.fname,
                         "timestamp": calc_timestamp(pick.t0, float(idx) * dt),
-                        "prob": prob,
-                        "amp": amp,
+                        "prob": float(prob),
+                        "amp": float(amp),
                         "type": "p",
                     }
                 )
@@ -141,67 +267,343 @@ def format_picks(picks, dt, amplitudes):
                     {
                         "id": pick.fname,
                         "timestamp": calc_timestamp(pick.t0, float(idx) * dt),
-                        "prob": prob,
-                        "amp": amp,
+                        "prob": float(prob),
+                        "amp": float(amp),
                         "type": "s",
                     }
                 )
     return picks_
 
 
-def format_data(data):
+def format_data(data, nt=X_SHAPE[0]):
+    """
+    Group channels (id = station + channel code) into a (nsta, nt, X_SHAPE[-1]) array aligned at the
+    earliest channel start of each station, each channel demeaned over the samples that fit.
+    nt=None keeps the full span of the longest station.
+    """
 
     # chn2idx = {"ENZ": {"E":0, "N":1, "Z":2},
     #            "123": {"3":0, "2":1, "1":2},
     #            "12Z": {"1":0, "2":1, "Z":2}}
-    chn2idx = {"E": 0, "N": 1, "Z": 2, "3": 0, "2": 1, "1": 2}
-    Data = NamedTuple("data", [("id", list), ("timestamp", list), ("vec", list), ("dt", float)])
-
-    # Group by station
-    chn_ = defaultdict(list)
-    t0_ = defaultdict(list)
-    vv_ = defaultdict(list)
-    for i in range(len(data.id)):
-        key = data.id[i][:-1]
-        chn_[key].append(data.id[i][-1])
-        t0_[key].append(datetime.strptime(data.timestamp[i], "%Y-%m-%dT%H:%M:%S.%f").timestamp() * SAMPLING_RATE)
-        vv_[key].append(np.array(data.vec[i]))
-
-    # Merge to Data tuple
-    id_ = []
-    timestamp_ = []
-    vec_ = []
-    for k in chn_:
-        id_.append(k)
-        min_t0 = min(t0_[k])
-        timestamp_.append(datetime.fromtimestamp(min_t0 / SAMPLING_RATE).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3])
-        vec = np.zeros([X_SHAPE[0], X_SHAPE[-1]])
-        for i in range(len(chn_[k])):
-            # vec[int(t0_[k][i]-min_t0):len(vv_[k][i]), chn2idx[chn_[k][i]]] = vv_[k][i][int(t0_[k][i]-min_t0):X_SHAPE[0]] - np.mean(vv_[k][i])
-            shift = int(t0_[k][i] - min_t0)
-            vec[shift : len(vv_[k][i]) + shift, chn2idx[chn_[k][i]]] = vv_[k][i][: X_SHAPE[0] - shift] - np.mean(
-                vv_[k][i][: X_SHAPE[0] - shift]
-            )
-        vec_.append(vec.tolist())
+    chn2idx = CHN2IDX
+    Data = NamedTuple("data", [("id", list), ("timestamp", list), ("vec", np.ndarray), ("dt", float)])
+    nch = X_SHAPE[-1]
+
+    # Group by station, keeping the order of first appearance
+    keys = [x[:-1] for x in data.id]
+    id_ = list(dict.fromkeys(keys))
+    key2sta = {k: i for i, k in enumerate(id_)}
+    sta = np.array([key2sta[k] for k in keys], dtype=int)
+    chn = np.array([chn2idx[x[-1]] for x in data.id], dtype=int)
+
+    # Align channels to the earliest start of their station
+    t0 = np.array(data.timestamp, dtype="datetime64[us]").astype(np.int64)
+    min_t0 = np.full(len(id_), np.iinfo(np.int64).max)
+    np.minimum.at(min_t0, sta, t0)
+    shift = (t0 - min_t0[sta]) * SAMPLING_RATE // 1_000_000
+    timestamp_ = list(np.datetime_as_string(min_t0.astype("datetime64[us]"), unit="ms"))
+
+    # Scatter all samples at once: sample j of channel i goes to (sta[i], shift[i] + j, chn[i])
+    vv = [np.asarray(x, dtype=np.float64) for x in data.vec]
+    lengths = np.array([len(x) for x in vv], dtype=int)
+    flat = np.concatenate(vv) if len(vv) > 0 else np.zeros(0)
+    channel = np.repeat(np.arange(len(vv)), lengths)
+    t = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths) + shift[channel]
+    if nt is None:
+        nt = int(t.max()) + 1 if len(t) > 0 else X_SHAPE[0]
+    keep = t < nt
+    channel, t, flat = channel[keep], t[keep], flat[keep]
+    count = np.bincount(channel, minlength=len(vv))
+    mean = np.bincount(channel, weights=flat, minlength=len(vv)) / np.maximum(count, 1)
+
+    vec_ = np.zeros([len(id_), nt, nch])
+    vec_[sta[channel], t, chn[channel]] = flat - mean[channel]
 
     return Data(id=id_, timestamp=timestamp_, vec=vec_, dt=1 / SAMPLING_RATE)
     # return {"id": id_, "timestamp": timestamp_, "vec": vec_, "dt":1 / SAMPLING_RATE}
 
 
-def get_prediction(data, return_preds=False):
-
-    vec = np.array(data.vec)
-    vec, vec_raw = preprocess(vec)
+class MicroBatcher:
+    """
+    Gather windows from concurrent requests for up to max_wait seconds or max_batch stations,
+    run them through run_fn as one batch, and hand each caller its own slice of the output.
+    With concurrency > 1, that many batches can be in run_fn at once (one per inference worker).
+    """
 
+    def __init__(self, run_fn, max_batch=64, max_wait=0.01, concurrency=1):
+        self.run_fn = run_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.pending = None
+        self.collect_lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.loop, daemon=True) for _ in range(concurrency)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, vec):
+        future = Future()
+        self.queue.put((vec, future))
+        return future.result()
+
+    def collect(self):
+        if self.pending is not None:
+            batch, self.pending = [self.pending], None
+        else:
+            batch = [self.queue.get()]
+        nsta = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while nsta < self.max_batch:
+            try:
+                timeout = deadline - time.monotonic()
+                if timeout > 0:
+                    item = self.queue.get(timeout=timeout)
+                else:
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if nsta + len(item[0]) > self.max_batch:
+                self.pending = item
+                break
+            batch.append(item)
+            nsta += len(item[0])
+        return batch
+
+    def loop(self):
+        while True:
+            with self.collect_lock:
+                batch = self.collect()
+            # windows of different length can not share one tensor
+            groups = defaultdict(list)
+            for vec, future in batch:
+                groups[vec.shape[1:]].append((vec, future))
+            for items in groups.values():
+                try:
+                    vec = np.concatenate([vec for vec, _ in items], axis=0)
+                    BATCH_SIZE.observe(len(vec))
+                    with STAGE_SECONDS.time("inference"):
+                        preds = self.run_fn(vec)
+                except Exception as error:
+                    for _, future in items:
+                        future.set_exception(error)
+                    continue
+                i = 0
+                for vec, future in items:
+                    future.set_result(preds[i : i + len(vec)])
+                    i += len(vec)
+
+
+def run_model(vec):
+    if worker_pool is not None:
+        return worker_pool.run(vec)
     feed = {model.X: vec, model.drop_rate: 0, model.is_training: False}
-    preds = sess.run(model.preds, feed_dict=feed)
+    return sess.run(model.preds, feed_dict=feed)
 
-    picks = extract_picks(preds, fnames=data.id, station_ids=data.id, t0=data.timestamp)
-    amps = extract_amplitude(vec_raw, picks)
-    picks = format_picks(picks, data.dt, amps)
+
+batcher = MicroBatcher(
+    run_model, max_batch=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT_MS / 1000, concurrency=max(INFERENCE_WORKERS, 1)
+)
+
+
+# timestamps are naive UTC (as in format_data); count from the epoch without going through local time
+EPOCH = datetime(1970, 1, 1)
+
+
+def timestamp2index(timestamp):
+    return int(round((datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%f") - EPOCH) / timedelta(seconds=1) * SAMPLING_RATE))
+
+
+def index2timestamp(index):
+    return (EPOCH + timedelta(seconds=index / SAMPLING_RATE)).strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+class StationBuffer:
+    """
+    Ring buffer of the recent samples of one station, indexed by absolute sample (timestamp * SAMPLING_RATE).
+    A window of nt samples is cut every nt - overlap new samples. Each window keeps the picks in
+    [emitted, end - overlap // 2), so every sample belongs to exactly one window and no pick is emitted twice.
+    """
+
+    def __init__(self, nt=X_SHAPE[0], nch=X_SHAPE[-1], overlap=STREAM_OVERLAP):
+        self.nt = nt
+        self.overlap = overlap
+        self.hop = nt - overlap
+        self.data = np.zeros([2 * nt, nch], dtype=np.float32)
+        self.t_begin = None
+        self.t_end = None
+        self.last_run = None
+        self.emitted = None
+        self.updated = time.monotonic()
+
+    def reset(self, t0):
+        self.data[:] = 0
+        self.t_begin = self.t_end = self.last_run = self.emitted = t0
+
+    def write(self, t0, vec, ich):
+        self.updated = time.monotonic()
+        size = len(self.data)
+        t1 = t0 + len(vec)
+        if (self.t_end is None) or (t0 - self.t_end >= size):
+            self.reset(t0)
+        if t1 > self.t_end:
+            self.data[np.arange(max(self.t_end, t1 - size), t1) % size] = 0
+            self.t_end = t1
+        lo = max(t0, self.t_end - size, self.t_begin)
+        if lo < t1:
+            self.data[np.arange(lo, t1) % size, ich] = vec[lo - t0 :]
+
+    def windows(self):
+        """
+        Return (start, keep_from, keep_to, vec) for every window completed since the last call.
+        """
+        size = len(self.data)
+        windows = []
+        while self.t_end - self.last_run >= self.hop:
+            end = max(self.last_run + self.hop, self.t_end - size + self.nt)
+            start = end - self.nt
+            vec = self.data[np.arange(start, end) % size]
+            valid = max(self.t_begin - start, 0)
+            vec[valid:] -= np.mean(vec[valid:], axis=0)
+            keep_to = end - self.overlap // 2
+            windows.append((start, self.emitted, keep_to, vec))
+            self.last_run, self.emitted = end, keep_to
+        return windows
+
+
+stream_buffers = {}
+stream_lock = threading.Lock()
+
+
+def select_picks(picks, amps, keep):
+    """
+    Keep the picks (and their amplitudes) of station i with index in [keep[i][0], keep[i][1]).
+    """
+    picks_, amps_ = [], []
+    for pick, amp, (lo, hi) in zip(picks, amps, keep):
+        selected = {}
+        for phase in ["p", "s"]:
+            idx_, prob_, amp_ = [], [], []
+            for idxs, probs, amps in zip(getattr(pick, f"{phase}_idx"), getattr(pick, f"{phase}_prob"), getattr(amp, f"{phase}_amp")):
+                mask = [lo <= idx < hi for idx in idxs]
+                idx_.append([x for x, m in zip(idxs, mask) if m])
+                prob_.append([x for x, m in zip(probs, mask) if m])
+                amp_.append([x for x, m in zip(amps, mask) if m])
+            selected[f"{phase}_idx"], selected[f"{phase}_prob"], selected[f"{phase}_amp"] = idx_, prob_, amp_
+        picks_.append(pick._replace(p_idx=selected["p_idx"], p_prob=selected["p_prob"], s_idx=selected["s_idx"], s_prob=selected["s_prob"]))
+        amps_.append(amp._replace(p_amp=selected["p_amp"], s_amp=selected["s_amp"]))
+    return picks_, amps_
+
+
+BinaryData = namedtuple("BinaryData", ["id", "timestamp", "vec", "dt"])
+
+
+def decode_raw(body):
+    magic, nsta, nt, nch = RAW_HEADER.unpack_from(body)
+    if len(body) != RAW_HEADER.size + nsta * nt * nch * 4:
+        raise ValueError(f"Expect {nsta}x{nt}x{nch} float32 samples, got {len(body) - RAW_HEADER.size} bytes")
+    return np.frombuffer(body, dtype="<f4", offset=RAW_HEADER.size).reshape(nsta, nt, nch)
+
+
+def decode_npy(body):
+    fp = io.BytesIO(body)
+    if np.lib.format.read_magic(fp) == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+    if dtype.hasobject:
+        raise ValueError("Object arrays are not supported")
+    vec = np.frombuffer(body, dtype=dtype, offset=fp.tell(), count=int(np.prod(shape)))
+    return vec.reshape(shape, order="F" if fortran_order else "C")
+
+
+def decode_mseed(body):
+    import obspy
+
+    mseed = obspy.read(io.BytesIO(body), format="MSEED")
+    mseed = mseed.merge(fill_value=0)
+    id_, timestamp_, vec_ = [], [], []
+    for trace in mseed:
+        if trace.stats.sampling_rate != SAMPLING_RATE:
+            trace = trace.interpolate(SAMPLING_RATE, method="linear")
+        id_.append(trace.id)
+        timestamp_.append(trace.stats.starttime.datetime.strftime("%Y-%m-%dT%H:%M:%S.%f"))
+        vec_.append(trace.data)
+    # the model and normalize_batch take any length, so keep whole records instead of cutting them to X_SHAPE[0]
+    return format_data(BinaryData(id=id_, timestamp=timestamp_, vec=vec_, dt=1 / SAMPLING_RATE), nt=None)
+
+
+def decode_waveform(body, id=None, timestamp=None, dt=0.01):
+    """
+    Decode a binary body into model input without going through JSON.
+    The format is sniffed from the first bytes: RAW_MAGIC, .npy, otherwise miniSEED.
+    For raw and .npy bodies, id and timestamp give one entry per station.
+    """
+    if body[: len(RAW_MAGIC)] == RAW_MAGIC:
+        vec = decode_raw(body)
+    elif body[: len(np.lib.format.MAGIC_PREFIX)] == np.lib.format.MAGIC_PREFIX:
+        vec = decode_npy(body)
+    else:
+        return decode_mseed(body)
+
+    if vec.ndim == 2:
+        vec = vec[np.newaxis, :, :]
+    if vec.ndim != 3:
+        raise ValueError(f"Expect waveforms of shape (nsta, nt, nch), got {vec.shape}")
+    if (id is None) or (timestamp is None) or (len(id) != len(vec)) or (len(timestamp) != len(vec)):
+        raise ValueError(f"Expect {len(vec)} id and timestamp query parameters")
+    return BinaryData(id=id, timestamp=timestamp, vec=vec, dt=dt)
+
+
+def get_prediction(data, return_preds=False, keep=None):
+    """
+    keep: optional [start, end) sample range per station; picks outside it are dropped
+    """
+
+    if not model_ready.is_set():
+        raise HTTPException(status_code=503, detail="Model is loading")
+
+    with STAGE_SECONDS.time("decode"):
+        vec = np.asarray(data.vec)
+    REQUEST_STATIONS.observe(len(vec))
+
+    # (preds, picks, amps) per station window; only cache misses go through the model
+    results = [None] * len(vec)
+    if prediction_cache is not None:
+        keys = [prediction_cache.key(x) for x in vec]
+        results = [prediction_cache.get(key) for key in keys]
+        num_hit = sum(x is not None for x in results)
+        CACHE_REQUESTS.inc(num_hit, "hit")
+        CACHE_REQUESTS.inc(len(vec) - num_hit, "miss")
+    miss = [i for i, x in enumerate(results) if x is None]
+
+    if len(miss) > 0:
+        with STAGE_SECONDS.time("normalize"):
+            vec_, vec_raw = preprocess(vec if len(miss) == len(vec) else vec[miss])
+
+        preds_ = batcher.submit(vec_)
+
+        with STAGE_SECONDS.time("picking"):
+            picks_ = extract_picks(preds_)
+            amps_ = extract_amplitude(vec_raw, picks_)
+        for i, pred, pick, amp in zip(miss, preds_, picks_, amps_):
+            results[i] = (pred, pick, amp)
+            if prediction_cache is not None:
+                prediction_cache.put(keys[i], (pred.copy(), pick, amp))
+
+    picks = [
+        pick._replace(fname=data.id[i], station_id=data.id[i], t0=data.timestamp[i]) for i, (_, pick, _) in enumerate(results)
+    ]
+    amps = [amp for _, _, amp in results]
+    if keep is not None:
+        picks, amps = select_picks(picks, amps, keep)
+    with STAGE_SECONDS.time("serialize"):
+        picks = format_picks(picks, data.dt, amps)
+    num_p = sum(pick["type"] == "p" for pick in picks)
+    PICKS_TOTAL.inc(num_p, "p")
+    PICKS_TOTAL.inc(len(picks) - num_p, "s")
 
     if return_preds:
-        return picks, preds
+        return picks, np.stack([pred for pred, _, _ in results])
 
     return picks
 
@@ -238,6 +640,23 @@ def predict(data: Data):
     return picks
 
 
+@app.post("/predict_binary")
+async def predict_binary(
+    request: Request, id: Optional[List[str]] = Query(None), timestamp: Optional[List[str]] = Query(None), dt: float = 0.01
+):
+
+    body = await request.body()
+    try:
+        with STAGE_SECONDS.time("decode"):
+            data = decode_waveform(body, id, timestamp, dt)
+    except Exception as error:
+        raise HTTPException(status_code=400, detail=f"Can not decode waveform: {error}")
+
+    picks = await run_in_threadpool(get_prediction, data)
+
+    return picks
+
+
 @app.post("/predict_prob")
 def predict(data: Data):
 
@@ -247,85 +666,124 @@ def predict(data: Data):
 
 
 @app.post("/predict_phasenet2gamma")
-def predict(data: Data):
+async def predict(data: Data):
 
-    picks = get_prediction(data)
+    picks = await run_in_threadpool(get_prediction, data)
 
     # if use_kafka:
     #     print("Push picks to kafka...")
     #     for pick in picks:
     #         producer.send("phasenet_picks", key=pick["id"], value=pick)
     try:
-        catalog = requests.post(f"{GAMMA_API_URL}/predict", json={"picks": picks, 
-                                                                 "stations": data.stations, 
-                                                                 "config": data.config})
-        print(catalog.json()["catalog"])
-        return catalog.json()
+        catalog = await gamma_client.predict(picks, data.stations, data.config)
+        print(catalog["catalog"])
+        return catalog
     except Exception as error:
         print(error)
 
     return {}
 
 @app.post("/predict_phasenet2gamma2ui")
-def predict(data: Data):
+async def predict(data: Data):
 
-    picks = get_prediction(data)
+    picks = await run_in_threadpool(get_prediction, data)
 
     try:
-        catalog = requests.post(f"{GAMMA_API_URL}/predict", json={"picks": picks,
-                                                                  "stations": data.stations, 
-                                                                  "config": data.config})
-        print(catalog.json()["catalog"])
-        return catalog.json()
+        catalog = await gamma_client.predict(picks, data.stations, data.config)
+        print(catalog["catalog"])
+        return catalog
     except Exception as error:
         print(error)
 
     if use_kafka:
-        print("Push picks to kafka...")
-        for pick in picks:
-            producer.send("phasenet_picks", key=pick["id"], value=pick)
-        print("Push waveform to kafka...")
-        for id, timestamp, vec in zip(data.id, data.timestamp, data.vec):
-            producer.send("waveform_phasenet", key=id, value={"timestamp": timestamp, "vec": vec, "dt": data.dt})
+        publisher.publish_picks(picks)
+        publisher.publish_waveforms(data.id, data.timestamp, data.vec, data.dt)
 
     return {}
 
 
-@app.post("/predict_stream_phasenet2gamma")
-def predict(data: Data):
+def stream_picks(data):
+    """
+    Append the new samples to each station's ring buffer and pick on the windows that are complete.
+    """
+    # append the new samples to each station's ring buffer and cut the windows that are complete
+    windows = []
+    with stream_lock:
+        keys = []
+        for i in range(len(data.id)):
+            key = data.id[i][:-1]
+            if key not in stream_buffers:
+                stream_buffers[key] = StationBuffer()
+            stream_buffers[key].write(timestamp2index(data.timestamp[i]), np.asarray(data.vec[i]), CHN2IDX[data.id[i][-1]])
+            if key not in keys:
+                keys.append(key)
+        cursors = []
+        for key in keys:
+            buffer = stream_buffers[key]
+            last_run, emitted = buffer.last_run, buffer.emitted
+            for window in buffer.windows():
+                windows.append((key,) + window)
+            if buffer.last_run != last_run:
+                cursors.append((key, buffer, last_run, emitted, buffer.last_run))
+        now = time.monotonic()
+        for key in [k for k, v in stream_buffers.items() if now - v.updated > STREAM_TTL]:
+            del stream_buffers[key]
+
+    picks = []
+    if len(windows) > 0:
+        try:
+            picks = get_prediction(
+                BinaryData(
+                    id=[key for key, *_ in windows],
+                    timestamp=[index2timestamp(start) for _, start, *_ in windows],
+                    vec=np.stack([vec for *_, vec in windows]),
+                    dt=1 / SAMPLING_RATE,
+                ),
+                keep=[(keep_from - start, keep_to - start) for _, start, keep_from, keep_to, _ in windows],
+            )
+        except Exception:
+            # e.g. 503 while the model loads: rewind the cursors so the next request cuts these windows again
+            with stream_lock:
+                for key, buffer, last_run, emitted, cut in cursors:
+                    if (stream_buffers.get(key) is buffer) and (buffer.last_run == cut):
+                        buffer.last_run, buffer.emitted = last_run, emitted
+            raise
 
-    data = format_data(data)
-    # for i in range(len(data.id)):
-    #     plt.clf()
-    #     plt.subplot(311)
-    #     plt.plot(np.array(data.vec)[i, :, 0])
-    #     plt.subplot(312)
-    #     plt.plot(np.array(data.vec)[i, :, 1])
-    #     plt.subplot(313)
-    #     plt.plot(np.array(data.vec)[i, :, 2])
-    #     plt.savefig(f"{data.id[i]}.png")
+    return picks
 
-    picks = get_prediction(data)
+
+@app.post("/predict_stream_phasenet2gamma")
+async def predict(data: Data):
+
+    picks = await run_in_threadpool(stream_picks, data)
 
     return_value = {}
-    try:
-        catalog = requests.post(f"{GAMMA_API_URL}/predict_stream", json={"picks": picks})
-        print("GMMA:", catalog.json()["catalog"])
-        return_value = catalog.json()
-    except Exception as error:
-        print(error)
+    if len(picks) > 0:
+        try:
+            catalog = await gamma_client.predict_stream(picks)
+            print("GMMA:", catalog["catalog"])
+            return_value = catalog
+        except Exception as error:
+            print(error)
 
     if use_kafka:
-        print("Push picks to kafka...")
-        for pick in picks:
-            producer.send("phasenet_picks", key=pick["id"], value=pick)
-        print("Push waveform to kafka...")
-        for id, timestamp, vec in zip(data.id, data.timestamp, data.vec):
-            producer.send("waveform_phasenet", key=id, value={"timestamp": timestamp, "vec": vec, "dt": data.dt})
+        publisher.publish_picks(picks)
+        data = await run_in_threadpool(format_data, data)
+        publisher.publish_waveforms(data.id, data.timestamp, data.vec, data.dt)
 
     return return_value
 
 
 @app.get("/healthz")
 def healthz():
-    return {"status": "ok"}
+    if not model_ready.is_set():
+        return JSONResponse(status_code=503, content={"status": "loading", "kafka": use_kafka})
+    status = {"status": "ok", "kafka": use_kafka, "inference_workers": INFERENCE_WORKERS}
+    if use_kafka:
+        status["kafka_publisher"] = publisher.stats()
+    return status
+
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
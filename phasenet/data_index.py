@@ -0,0 +1,117 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+### Convert a data_list csv once into a binary index, used wherever a data_list is expected:
+### python phasenet/data_index.py --data_list dataset/waveform.csv --output dataset/waveform.idx
+
+NUMERIC_COLUMNS = ["itp", "its", "snr"]
+
+
+def read_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_list", default="./dataset/waveform.csv", help="Input csv file")
+    parser.add_argument("--output", default=None, help="Output index directory (default: data_list with .idx)")
+    parser.add_argument("--chunksize", default=1000000, type=int, help="Rows parsed at a time")
+    args = parser.parse_args()
+
+    return args
+
+
+def is_index(fname):
+    return os.path.isfile(os.path.join(fname, "fname_offsets.npy"))
+
+
+class DataList:
+    """
+    Memory-mapped list of file names written by build_index, indexable like the fname column of a
+    data_list csv. Numeric columns are in self.columns. Pickling sends the path only, so worker processes
+    map the same pages instead of receiving a copy.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fname = np.load(os.path.join(path, "fname.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "fname_offsets.npy"), mmap_mode="r")
+        self.columns = {}
+        for name in NUMERIC_COLUMNS:
+            if os.path.exists(os.path.join(path, f"{name}.npy")):
+                self.columns[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.fname[self.offsets[i] : self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+
+def read_csv_chunks(data_list, chunksize):
+    with open(data_list) as fp:
+        header = fp.readline()
+    if "\t" in header:
+        return pd.read_csv(data_list, header=0, sep="\t", chunksize=chunksize)
+    if "," in header:
+        return pd.read_csv(data_list, header=0, sep=",", chunksize=chunksize)
+    return pd.read_csv(data_list, header=0, sep=r"\s+", chunksize=chunksize)
+
+
+def build_index(data_list, output, chunksize=1000000):
+    """
+    Write fname.npy (utf-8 bytes of all names), fname_offsets.npy, and one float64 array per numeric column
+    (itp, its, snr; missing values as NaN) into the output directory.
+    """
+    fname, lengths = [], []
+    columns = {name: [] for name in NUMERIC_COLUMNS}
+    for chunk in read_csv_chunks(data_list, chunksize):
+        encoded = [x.encode("utf-8") for x in chunk["fname"].astype(str)]
+        fname.append(b"".join(encoded))
+        lengths.append(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+        for name in NUMERIC_COLUMNS:
+            if (name in chunk) and (columns[name] is not None):
+                values = pd.to_numeric(chunk[name], errors="coerce")
+                if not chunk[name].isna().equals(values.isna()):
+                    logging.warning(f"Column {name} is not numeric, not indexed")
+                    columns[name] = None
+                else:
+                    columns[name].append(values.to_numpy(dtype=np.float64))
+            else:
+                columns[name] = None
+
+    os.makedirs(output, exist_ok=True)
+    lengths = np.concatenate(lengths) if lengths else np.array([], dtype=np.int64)
+    np.save(os.path.join(output, "fname.npy"), np.frombuffer(b"".join(fname), dtype=np.uint8))
+    np.save(os.path.join(output, "fname_offsets.npy"), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+    for name, values in columns.items():
+        if values is not None:
+            np.save(os.path.join(output, f"{name}.npy"), np.concatenate(values) if values else np.array([]))
+    logging.info(f"Indexed {len(lengths)} rows of {data_list} in {output}")
+    return DataList(output)
+
+
+def main(args):
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+    output = args.output if args.output is not None else os.path.splitext(args.data_list)[0] + ".idx"
+    build_index(args.data_list, output, args.chunksize)
+
+
+if __name__ == "__main__":
+    args = read_args()
+    main(args)
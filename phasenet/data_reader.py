@@ -4,6 +4,14 @@ tf.compat.v1.disable_eager_execution()
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 import logging
 import os
+import weakref
+from itertools import chain
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    ## Python < 3.8: the event pool stays in process memory and training uses the tf.data path
+    shared_memory = None
 
 import numpy as np
 import pandas as pd
@@ -15,6 +23,12 @@ import obspy
 from scipy.interpolate import interp1d
 from tqdm import tqdm
 
+from data_index import DataList, is_index
+from train_loader import TrainLoader
+
+## start time of records that carry none
+DEFAULT_T0 = "1970-01-01T00:00:00.000"
+
 
 def py_func_decorator(output_types=None, output_shapes=None, name=None):
     def decorator(func):
@@ -47,6 +61,34 @@ def dataset_map(iterator, output_types, output_shapes=None, num_parallel_calls=N
     return dataset.map(index_to_entry, num_parallel_calls=num_parallel_calls)
 
 
+def shard_dataset_map(iterator, output_types, output_shapes=None, num_parallel_calls=None, name=None, shuffle_buffer=1000):
+    """
+    Like dataset_map for packed shards: shards are visited in a random order every epoch and rows are read
+    sequentially within a shard, lightly reshuffled through a small buffer.
+    """
+    shard_start = tf.constant(iterator.shard_start, dtype=tf.int64)
+    num_shards = len(iterator.shard_start) - 1
+    dataset = tf.data.Dataset.range(num_shards).shuffle(num_shards, reshuffle_each_iteration=True)
+    dataset = dataset.flat_map(lambda k: tf.data.Dataset.range(shard_start[k], shard_start[k + 1]))
+    if shuffle_buffer > 1:
+        dataset = dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+
+    @py_func_decorator(output_types, output_shapes, name=name)
+    def index_to_entry(idx):
+        return iterator[idx]
+
+    return dataset.map(index_to_entry, num_parallel_calls=num_parallel_calls)
+
+
+def randint(rng, low, high=None):
+    """
+    np.random.randint from the global state, or from a np.random.Generator when rng is given.
+    """
+    if rng is None:
+        return np.random.randint(low, high)
+    return rng.integers(low, high)
+
+
 def normalize(data, axis=(0,)):
     """data shape: (nt, nsta, nch)"""
     data -= np.mean(data, axis=axis, keepdims=True)
@@ -173,11 +215,17 @@ class DataReader:
         self.dtype = config.dtype
         self.label_shape = config.label_shape
         self.label_width = config.label_width
+        self.label_window = self.make_label_window()
         self.config = config
         self.format = format
         if "highpass_filter" in kwargs:
             self.highpass_filter = kwargs["highpass_filter"]
-        if format in ["numpy", "mseed", "sac"]:
+        if format in ["numpy", "mseed"] and is_index(kwargs["data_list"]):
+            ## binary index from data_index.py
+            self.data_dir = kwargs["data_dir"]
+            self.data_list = DataList(kwargs["data_list"])
+            self.num_data = len(self.data_list)
+        elif format in ["numpy", "mseed", "sac"]:
             self.data_dir = kwargs["data_dir"]
             try:
                 csv = pd.read_csv(kwargs["data_list"], header=0, sep='[,|\s+]', engine="python")
@@ -188,10 +236,23 @@ class DataReader:
                 self.sac_trace = csv[["E", "N", "Z"]]
             self.num_data = len(self.data_list)
         elif format == "hdf5":
-            self.h5 = h5py.File(kwargs["hdf5_file"], 'r', libver='latest', swmr=True)
-            self.h5_data = self.h5[kwargs["hdf5_group"]]
+            self.hdf5_file = kwargs["hdf5_file"]
+            self.hdf5_group = kwargs["hdf5_group"]
+            self.open_files()
             self.data_list = list(self.h5_data.keys())
             self.num_data = len(self.data_list)
+        elif format == "shards":
+            ## written by pack_shards.py; data_dir is the output_dir of the packer
+            self.data_dir = kwargs["data_dir"]
+            index = np.load(os.path.join(self.data_dir, "index.npz"))
+            self.data_list = index["fname"]
+            self.shard_index = index["shard"]
+            self.shard_row = index["row"]
+            self.shard_itp = index["itp"]
+            self.shard_its = index["its"]
+            self.open_files()
+            self.shard_start = np.concatenate([[0], np.cumsum([len(x) for x in self.shards])])
+            self.num_data = len(self.data_list)
         elif format == "s3":
             self.s3fs = s3fs.S3FileSystem(
                 anon=kwargs["anon"],
@@ -207,6 +268,30 @@ class DataReader:
     def __len__(self):
         return self.num_data
 
+    def open_files(self):
+        ## the HDF5 file and the memory-mapped shards are opened by each process, see __setstate__
+        if self.format == "hdf5":
+            self.h5 = h5py.File(self.hdf5_file, 'r', libver='latest', swmr=True)
+            self.h5_data = self.h5[self.hdf5_group]
+        elif self.format == "shards":
+            self.shards = [
+                np.load(os.path.join(self.data_dir, f"shard_{k:05d}.npy"), mmap_mode="r")
+                for k in range(self.shard_index.max() + 1)
+            ]
+
+    def __getstate__(self):
+        ## open HDF5 handles can not be pickled and memory maps would be copied, so worker processes
+        ## (TrainLoader) reopen them; the read buffer starts empty
+        state = self.__dict__.copy()
+        for name in ["h5", "h5_data", "shards"]:
+            state.pop(name, None)
+        state["buffer"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open_files()
+
     def read_numpy(self, fname):
         # try:
         if fname not in self.buffer:
@@ -282,6 +367,23 @@ class DataReader:
             meta["t0"] = attrs["t0"]
         return meta
 
+    def read_shard(self, i):
+        trim = lambda picks: [list(trace[~np.isnan(trace)].astype("int64")) for trace in picks]
+        meta = {}
+        meta["data"] = np.array(self.shards[self.shard_index[i]][self.shard_row[i]])
+        meta["itp"] = trim(self.shard_itp[i])
+        meta["its"] = trim(self.shard_its[i])
+        return meta
+
+    def read_meta(self, i):
+        if self.format == "numpy":
+            return self.read_numpy(os.path.join(self.data_dir, self.data_list[i]))
+        elif self.format == "hdf5":
+            return self.read_hdf5(self.data_list[i])
+        elif self.format == "shards":
+            return self.read_shard(i)
+        return None
+
     def read_s3(self, format, fname, bucket, key, secret, s3_url, use_ssl):
         with self.s3fs.open(bucket + "/" + fname, 'rb') as fp:
             if format == "numpy":
@@ -459,41 +561,56 @@ class DataReader:
             meta = {"data": data, "t0": t0, "station_id": station_id, "fname": station_id}
         return meta
 
-    def generate_label(self, data, phase_list, mask=None):
-        # target = np.zeros(self.Y_shape, dtype=self.dtype)
-        target = np.zeros_like(data)
-
+    def make_label_window(self):
         if self.label_shape == "gaussian":
-            label_window = np.exp(
+            return np.exp(
                 -((np.arange(-self.label_width // 2, self.label_width // 2 + 1)) ** 2)
                 / (2 * (self.label_width / 5) ** 2)
             )
         elif self.label_shape == "triangle":
-            label_window = 1 - np.abs(
-                2 / self.label_width * (np.arange(-self.label_width // 2, self.label_width // 2 + 1))
-            )
-        else:
+            return 1 - np.abs(2 / self.label_width * (np.arange(-self.label_width // 2, self.label_width // 2 + 1)))
+        return None
+
+    def generate_label(self, data, phase_list, mask=None):
+        # target = np.zeros(self.Y_shape, dtype=self.dtype)
+        target = np.zeros_like(data)
+
+        if self.label_window is None:
             print(f"Label shape {self.label_shape} should be guassian or triangle")
             raise
 
-        for i, phases in enumerate(phase_list):
-            for j, idx_list in enumerate(phases):
-                for idx in idx_list:
-                    if np.isnan(idx):
-                        continue
-                    idx = int(idx)
-                    if (idx - self.label_width // 2 >= 0) and (idx + self.label_width // 2 + 1 <= target.shape[0]):
-                        target[idx - self.label_width // 2 : idx + self.label_width // 2 + 1, j, i + 1] = label_window
+        picks = [
+            (idx, j, i + 1)
+            for i, phases in enumerate(phase_list)
+            for j, idx_list in enumerate(phases)
+            for idx in idx_list
+        ]
+        if len(picks) > 0:
+            idx, station, phase = np.array(picks, dtype=float).T
+            half = self.label_width // 2
+            keep = ~np.isnan(idx)
+            idx, station, phase = idx[keep].astype(int), station[keep].astype(int), phase[keep].astype(int)
+            keep = (idx - half >= 0) & (idx + half + 1 <= target.shape[0])
+            idx, station, phase = idx[keep], station[keep], phase[keep]
+            ## one row per pick and window sample; later picks overwrite overlapping windows of earlier ones
+            rows = (idx[:, np.newaxis] + np.arange(-half, half + 1)).ravel()
+            flat = np.ravel_multi_index(
+                (rows, np.repeat(station, 2 * half + 1), np.repeat(phase, 2 * half + 1)), target.shape
+            )
+            values = np.tile(self.label_window, len(idx))
+            flat, last = np.unique(flat[::-1], return_index=True)
+            target.flat[flat] = values[::-1][last]
 
+        if len(phase_list) > 0:
             target[..., 0] = 1 - np.sum(target[..., 1:], axis=-1)
             if mask is not None:
                 target[:, mask == 0, :] = 0
 
         return target
 
-    def random_shift(self, sample, itp, its, itp_old=None, its_old=None, shift_range=None):
+    def random_shift(self, sample, itp, its, itp_old=None, its_old=None, shift_range=None, rng=None):
         # anchor = np.round(1/2 * (min(itp[~np.isnan(itp.astype(float))]) + min(its[~np.isnan(its.astype(float))]))).astype(int)
-        flattern = lambda x: np.array([i for trace in x for i in trace], dtype=float)
+        flattern = lambda x: np.fromiter(chain.from_iterable(x), dtype=float)
         shift_pick = lambda x, shift: [[i - shift for i in trace] for trace in x]
         itp_flat = flattern(itp)
         its_flat = flattern(its)
@@ -501,9 +618,9 @@ class DataReader:
             hi = np.round(np.median(itp_flat[~np.isnan(itp_flat)])).astype(int)
             lo = -(sample.shape[0] - np.round(np.median(its_flat[~np.isnan(its_flat)])).astype(int))
             if shift_range is None:
-                shift = np.random.randint(low=lo, high=hi + 1)
+                shift = randint(rng, lo, hi + 1)
             else:
-                shift = np.random.randint(low=max(lo, shift_range[0]), high=min(hi + 1, shift_range[1]))
+                shift = randint(rng, max(lo, shift_range[0]), min(hi + 1, shift_range[1]))
         else:
             itp_old_flat = flattern(itp_old)
             its_old_flat = flattern(its_old)
@@ -513,16 +630,19 @@ class DataReader:
             its_old_ref = np.round(np.max(its_old_flat[~np.isnan(its_old_flat)])).astype(int)
             # min_event_gap = np.round(self.min_event_gap*(its_ref-itp_ref)).astype(int)
             # min_event_gap_old = np.round(self.min_event_gap*(its_old_ref-itp_old_ref)).astype(int)
-            if shift_range is None:
-                hi = list(range(max(its_ref - itp_old_ref + self.min_event_gap, 0), itp_ref))
-                lo = list(range(-(sample.shape[0] - its_ref), -(max(its_old_ref - itp_ref + self.min_event_gap, 0))))
-            else:
-                lo_ = max(-(sample.shape[0] - its_ref), shift_range[0])
-                hi_ = min(itp_ref, shift_range[1])
-                hi = list(range(max(its_ref - itp_old_ref + self.min_event_gap, 0), hi_))
-                lo = list(range(lo_, -(max(its_old_ref - itp_ref + self.min_event_gap, 0))))
-            if len(hi + lo) > 0:
-                shift = np.random.choice(hi + lo)
+            ## valid shifts are [hi_start, hi_end) followed by [lo_start, lo_end), drawn uniformly over both
+            hi_start = max(its_ref - itp_old_ref + self.min_event_gap, 0)
+            hi_end = itp_ref
+            lo_start = -(sample.shape[0] - its_ref)
+            lo_end = -(max(its_old_ref - itp_ref + self.min_event_gap, 0))
+            if shift_range is not None:
+                lo_start = max(lo_start, shift_range[0])
+                hi_end = min(hi_end, shift_range[1])
+            num_hi = max(hi_end - hi_start, 0)
+            num_lo = max(lo_end - lo_start, 0)
+            if num_hi + num_lo > 0:
+                k = randint(rng, num_hi + num_lo)
+                shift = hi_start + k if k < num_hi else lo_start + k - num_hi
             else:
                 shift = 0
 
@@ -536,14 +656,21 @@ class DataReader:
 
         return shifted_sample, shift_pick(itp, shift), shift_pick(its, shift), shift
 
-    def stack_events(self, sample_old, itp_old, its_old, shift_range=None, mask_old=None):
+    def stack_events(self, sample_old, itp_old, its_old, shift_range=None, mask_old=None, rng=None):
+
+        event_pool = getattr(self, "event_pool", None)
+        if (event_pool is not None) and (mask_old is None):
+            sample, itp, its = event_pool.sample(rng)
+            sample, itp, its, shift = self.random_shift(sample, itp, its, itp_old, its_old, shift_range, rng)
+            if shift != 0:
+                sample_old += sample
+                itp_old = [i + j for i, j in zip(itp_old, itp)]
+                its_old = [i + j for i, j in zip(its_old, its)]
+            return sample_old, itp_old, its_old, mask_old
 
-        i = np.random.randint(self.num_data)
+        i = randint(rng, self.num_data)
         base_name = self.data_list[i]
-        if self.format == "numpy":
-            meta = self.read_numpy(os.path.join(self.data_dir, base_name))
-        elif self.format == "hdf5":
-            meta = self.read_hdf5(base_name)
+        meta = self.read_meta(i)
         if meta == -1:
             return sample_old, itp_old, its_old
 
@@ -553,7 +680,7 @@ class DataReader:
         if mask_old is not None:
             mask = np.copy(meta["mask"])
         sample = normalize(sample)
-        sample, itp, its, shift = self.random_shift(sample, itp, its, itp_old, its_old, shift_range)
+        sample, itp, its, shift = self.random_shift(sample, itp, its, itp_old, its_old, shift_range, rng)
 
         if shift != 0:
             sample_old += sample
@@ -573,6 +700,72 @@ class DataReader:
         return (sample, target, shift_pick(itp, select_range[0]), shift_pick(its, select_range[0]))
 
 
+class EventPool:
+    """
+    Bounded pool of normalized events for stack_events, read once and kept in shared memory, so that
+    stacking does not read and normalize a second file per sample. The pool is picklable: worker processes
+    attach to the same block instead of copying it. Without multiprocessing.shared_memory (Python < 3.8)
+    the events are kept in a plain array. seed selects the events.
+    """
+
+    def __init__(self, data_reader, size=1000, dtype="float32", seed=None):
+        rng = np.random.default_rng(seed)
+        index = rng.choice(data_reader.num_data, min(size, data_reader.num_data), replace=False)
+        events = []
+        for i in tqdm(index, desc="Event pool"):
+            meta = data_reader.read_meta(i)
+            if (meta is None) or (meta == -1):
+                continue
+            data_reader.buffer.clear()
+            events.append((normalize(np.copy(meta["data"])), meta["itp"], meta["its"]))
+        if len(events) == 0:
+            raise ValueError(f"Event pool: none of the {len(index)} selected events could be read")
+        shape = events[0][0].shape
+        events = [x for x in events if x[0].shape == shape]
+        self.shape = (len(events),) + shape
+        self.dtype = dtype
+        self.itp = [[list(trace) for trace in x[1]] for x in events]
+        self.its = [[list(trace) for trace in x[2]] for x in events]
+        if shared_memory is None:
+            self.shm = None
+            self.data = np.zeros(self.shape, dtype=dtype)
+        else:
+            self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(self.shape)) * np.dtype(dtype).itemsize)
+            self.data = np.ndarray(self.shape, dtype=dtype, buffer=self.shm.buf)
+            self.finalizer = weakref.finalize(self, EventPool.release, self.shm.name)
+        for k, (data, _, _) in enumerate(events):
+            self.data[k] = data
+
+    @staticmethod
+    def release(name):
+        try:
+            shared_memory.SharedMemory(name=name).unlink()
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getstate__(self):
+        state = {"shape": self.shape, "dtype": self.dtype, "itp": self.itp, "its": self.its}
+        if self.shm is None:
+            state["data"] = self.data
+        else:
+            state["name"] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = None
+        if "name" in state:
+            self.shm = shared_memory.SharedMemory(name=state["name"])
+            self.data = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def sample(self, rng=None):
+        k = randint(rng, len(self))
+        return self.data[k], self.itp[k], self.its[k]
+
+
 class DataReader_train(DataReader):
     def __init__(self, format="numpy", config=DataConfig(), **kwargs):
 
@@ -582,14 +775,21 @@ class DataReader_train(DataReader):
         self.buffer_channels = {}
         self.shift_range = [-2000 + self.label_width * 2, 1000 - self.label_width * 2]
         self.select_range = [5000, 8000]
+        self.event_pool = None
+        if kwargs.get("event_pool_size", 0) > 0:
+            self.event_pool = EventPool(self, kwargs["event_pool_size"], seed=kwargs.get("seed"))
 
     def __getitem__(self, i):
+        return self.sample(i)
+
+    def sample(self, i, rng=None):
+        """
+        One augmented training sample; random draws come from rng (a np.random.Generator) if given, else from
+        the global np.random state.
+        """
 
         base_name = self.data_list[i]
-        if self.format == "numpy":
-            meta = self.read_numpy(os.path.join(self.data_dir, base_name))
-        elif self.format == "hdf5":
-            meta = self.read_hdf5(base_name)
+        meta = self.read_meta(i)
         if meta == None:
             return (np.zeros(self.X_shape, dtype=self.dtype), np.zeros(self.Y_shape, dtype=self.dtype), base_name)
 
@@ -598,9 +798,13 @@ class DataReader_train(DataReader):
         its_list = meta["its"]
 
         sample = normalize(sample)
-        if np.random.random() < 0.95:
-            sample, itp_list, its_list, _ = self.random_shift(sample, itp_list, its_list, shift_range=self.shift_range)
-            sample, itp_list, its_list, _ = self.stack_events(sample, itp_list, its_list, shift_range=self.shift_range)
+        if (np.random.random() if rng is None else rng.random()) < 0.95:
+            sample, itp_list, its_list, _ = self.random_shift(
+                sample, itp_list, its_list, shift_range=self.shift_range, rng=rng
+            )
+            sample, itp_list, its_list, _ = self.stack_events(
+                sample, itp_list, its_list, shift_range=self.shift_range, rng=rng
+            )
             target = self.generate_label(sample, [itp_list, its_list])
             sample, target, itp_list, its_list = self.cut_window(sample, target, itp_list, its_list, self.select_range)
         else:
@@ -614,7 +818,29 @@ class DataReader_train(DataReader):
         sample = normalize(sample)
         return (sample.astype(self.dtype), target.astype(self.dtype), base_name)
 
-    def dataset(self, batch_size, num_parallel_calls=2, shuffle=True, drop_remainder=True):
+    def dataset(self, batch_size, num_parallel_calls=2, shuffle=True, drop_remainder=True, num_workers=0, seed=123):
+        if (num_workers > 0) and (shared_memory is None):
+            logging.warning("num_workers needs multiprocessing.shared_memory (Python >= 3.8), using tf.data threads")
+            num_workers = 0
+        if num_workers > 0:
+            ## augmentation in worker processes, see train_loader.py
+            self.loader = TrainLoader(
+                self, batch_size, num_workers=num_workers, seed=seed, shuffle=shuffle, drop_remainder=drop_remainder
+            )
+            dataset = tf.data.Dataset.from_generator(
+                self.loader.__iter__,
+                output_types=(self.dtype, self.dtype, tf.string),
+                output_shapes=([None] + list(self.X_shape), [None] + list(self.Y_shape), [None]),
+            )
+            return dataset.prefetch(2)
+        if self.format == "shards" and shuffle:
+            dataset = shard_dataset_map(
+                self,
+                output_types=(self.dtype, self.dtype, "string"),
+                output_shapes=(self.X_shape, self.Y_shape, None),
+                num_parallel_calls=num_parallel_calls,
+            )
+            return dataset.batch(batch_size, drop_remainder=drop_remainder).prefetch(batch_size * 2)
         dataset = dataset_map(
             self,
             output_types=(self.dtype, self.dtype, "string"),
@@ -636,10 +862,7 @@ class DataReader_test(DataReader):
     def __getitem__(self, i):
 
         base_name = self.data_list[i]
-        if self.format == "numpy":
-            meta = self.read_numpy(os.path.join(self.data_dir, base_name))
-        elif self.format == "hdf5":
-            meta = self.read_hdf5(base_name)
+        meta = self.read_meta(i)
         if meta == -1:
             return (np.zeros(self.Y_shape, dtype=self.dtype), np.zeros(self.X_shape, dtype=self.dtype), base_name)
 
@@ -720,12 +943,12 @@ class DataReader_pred(DataReader):
         if "t0" in meta:
             t0 = meta["t0"]
         else:
-            t0 = "1970-01-01T00:00:00.000"
+            t0 = DEFAULT_T0
 
         if "station_id" in meta:
             station_id = meta["station_id"]
         else:
-            station_id = base_name.rstrip(".npz")
+            station_id = os.path.splitext(base_name)[0]
 
         if np.isnan(sample).any() or np.isinf(sample).any():
             logging.warning(f"Data error: Nan or Inf found in {base_name}")
@@ -147,7 +147,7 @@ def detect_peaks(x, mph=None, mpd=1, threshold=0, edge='rising',
         ind = np.delete(ind, np.where(dx < threshold)[0])
     # detect small peaks closer than minimum peak distance
     if ind.size and mpd > 1:
-        ind = ind[np.argsort(x[ind])][::-1]  # sort ind by peak height
+        ind = ind[np.argsort(x[ind], kind='stable')][::-1]  # sort ind by peak height
         idel = np.zeros(ind.size, dtype=bool)
         for i in range(ind.size):
             if not idel[i]:
@@ -170,6 +170,77 @@ def detect_peaks(x, mph=None, mpd=1, threshold=0, edge='rising',
     return ind, x[ind]
 
 
+class StreamingPeakDetector(object):
+
+    """Detect peaks in consecutive chunks of a trace.
+
+    The picks are the same as `detect_peaks(x, mph=mph, mpd=mpd)` on the
+    concatenated trace (with the default edge='rising', threshold=0 and
+    kpsh=False, and no NaN's in the data), and each pick is returned once.
+    Only the last two samples and the candidate peaks that a later peak within
+    `mpd` could still remove are kept between calls.
+
+    Examples
+    --------
+    >>> detector = StreamingPeakDetector(mph=0.3, mpd=50)
+    >>> for chunk in chunks:
+    >>>     ind, peaks = detector.update(chunk)
+    >>> ind, peaks = detector.flush()
+    """
+
+    def __init__(self, mph=None, mpd=1):
+        self.mph = mph
+        self.mpd = mpd
+        self.nt = 0  # number of samples received
+        self.tail = np.array([], dtype='float64')
+        self.ind = np.array([], dtype=int)
+        self.val = np.array([], dtype='float64')
+
+    def update(self, x):
+        """Add the next chunk and return the peaks that are final."""
+        x = np.atleast_1d(x).astype('float64')
+        y = np.hstack((self.tail, x))
+        start = self.nt - self.tail.size
+        self.nt += x.size
+        self.tail = y[-2:]
+        if y.size >= 3:
+            dx = y[1:] - y[:-1]
+            # rising edge peaks; the last sample waits for the next chunk
+            ind = np.where((dx[1:] <= 0) & (dx[:-1] > 0))[0] + 1
+            if ind.size and self.mph is not None:
+                ind = ind[y[ind] >= self.mph]
+            self.ind = np.hstack((self.ind, start + ind))
+            self.val = np.hstack((self.val, y[ind]))
+        return self._pop(self.nt - 1)
+
+    def flush(self):
+        """End of trace: return all remaining peaks."""
+        return self._pop(np.inf)
+
+    def _pop(self, next_ind):
+        """Return peaks that no peak at or after `next_ind` can remove."""
+        if not self.ind.size:
+            return np.array([], dtype=int), np.array([], dtype='float64')
+        n = self.ind.size
+        if self.mpd > 1 and next_ind - self.ind[-1] <= self.mpd:
+            # keep the last cluster of peaks closer than mpd
+            gap = np.where(np.diff(self.ind) > self.mpd)[0]
+            n = gap[-1] + 1 if gap.size else 0
+        ind, val = self.ind[:n], self.val[:n]
+        self.ind, self.val = self.ind[n:], self.val[n:]
+        if ind.size and self.mpd > 1:
+            order = np.argsort(val, kind='stable')[::-1]
+            ind_sorted = ind[order]
+            idel = np.zeros(ind.size, dtype=bool)
+            for i in range(ind.size):
+                if not idel[i]:
+                    idel = idel | (ind_sorted >= ind_sorted[i] - self.mpd) & (ind_sorted <= ind_sorted[i] + self.mpd)
+                    idel[i] = 0  # Keep current peak
+            keep = np.sort(order[~idel])
+            ind, val = ind[keep], val[keep]
+        return ind, val
+
+
 def _plot(x, mph, mpd, threshold, edge, valley, ax, ind, title):
     """Plot results of the detect_peaks function, see its help."""
     try:
@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+import httpx
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class GammaClient:
+    """
+    Async client for the GAMMA association API with a shared connection pool, timeouts and a circuit breaker.
+
+    After failure_threshold consecutive failures calls fail fast with CircuitOpenError for reset_timeout seconds,
+    then one trial call decides whether the circuit closes again.
+    With coalesce_ms > 0, predict_stream merges the picks of calls arriving within coalesce_ms into one request,
+    and every caller gets the catalog of the merged call.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        timeout=10.0,
+        max_connections=10,
+        failure_threshold=5,
+        reset_timeout=30.0,
+        coalesce_ms=0,
+        transport=None,
+    ):
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            transport=transport,
+        )
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.coalesce_ms = coalesce_ms
+        self.failures = 0
+        self.open_until = 0.0
+        self.trial = False
+        self.pending = []
+        self.flush_task = None
+
+    @property
+    def state(self):
+        if self.failures < self.failure_threshold:
+            return "closed"
+        if time.monotonic() < self.open_until:
+            return "open"
+        return "half-open"
+
+    async def post(self, path, payload):
+        state = self.state
+        if (state == "open") or (state == "half-open" and self.trial):
+            raise CircuitOpenError(f"GAMMA circuit is open after {self.failures} failures")
+        self.trial = state == "half-open"
+        try:
+            response = await self.client.post(path, json=payload)
+            response.raise_for_status()
+            result = response.json()
+        except Exception:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.open_until = time.monotonic() + self.reset_timeout
+            raise
+        finally:
+            self.trial = False
+        self.failures = 0
+        return result
+
+    async def predict(self, picks, stations=None, config=None):
+        return await self.post("/predict", {"picks": picks, "stations": stations, "config": config})
+
+    async def predict_stream(self, picks):
+        if self.coalesce_ms <= 0:
+            return await self.post("/predict_stream", {"picks": picks})
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((picks, future))
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush())
+        return await future
+
+    async def flush(self):
+        await asyncio.sleep(self.coalesce_ms / 1000)
+        pending, self.pending, self.flush_task = self.pending, [], None
+        picks = [pick for picks, _ in pending for pick in picks]
+        try:
+            result = await self.post("/predict_stream", {"picks": picks})
+        except Exception as error:
+            for _, future in pending:
+                # a caller may have been cancelled meanwhile
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for _, future in pending:
+            if not future.done():
+                future.set_result(result)
+
+    async def aclose(self):
+        await self.client.aclose()
@@ -0,0 +1,253 @@
+import itertools
+import multiprocessing as mp
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+def worker_main(worker_id, checkpoint, task_queue, result_queue, intra_op_threads, inter_op_threads, warmup_shapes):
+    """
+    Inference process: own session with pinned thread counts. Each task names a shared memory block holding
+    the input batch, followed by room for the predictions, so no tensor goes through the queues.
+    """
+    import tensorflow as tf
+
+    from model import UNet
+
+    tf.compat.v1.disable_eager_execution()
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+    model = UNet(mode="pred")
+    sess_config = tf.compat.v1.ConfigProto(
+        intra_op_parallelism_threads=intra_op_threads, inter_op_parallelism_threads=inter_op_threads
+    )
+    sess_config.gpu_options.allow_growth = True
+    sess = tf.compat.v1.Session(config=sess_config)
+    saver = tf.compat.v1.train.Saver(tf.compat.v1.global_variables())
+    sess.run(tf.compat.v1.global_variables_initializer())
+    saver.restore(sess, tf.train.latest_checkpoint(checkpoint))
+
+    def run(vec):
+        return sess.run(model.preds, feed_dict={model.X: vec, model.drop_rate: 0, model.is_training: False})
+
+    for shape in warmup_shapes:
+        run(np.zeros(shape, dtype=np.float32))
+    worker_loop(worker_id, run, task_queue, result_queue)
+    sess.close()
+
+
+def worker_loop(worker_id, run, task_queue, result_queue):
+    """
+    Report ready, then serve the tasks of this worker's own queue until None.
+    """
+    result_queue.put(("ready", worker_id, None))
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        task_id, name, in_shape, out_shape = task
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+            vec = np.ndarray(in_shape, dtype=np.float32, buffer=shm.buf)
+            out = np.ndarray(out_shape, dtype=np.float32, buffer=shm.buf, offset=vec.nbytes)
+            out[:] = run(vec)
+            del vec, out
+            shm.close()
+            result_queue.put((task_id, worker_id, None))
+        except Exception as error:
+            result_queue.put((task_id, worker_id, repr(error)))
+
+
+class WorkerPool:
+    """
+    Run batches on num_workers inference processes. run() may be called from several threads at once;
+    each calling thread keeps one shared memory block that grows with the largest batch it has sent.
+    Each worker has its own task queue and gets the batch when it has the fewest tasks outstanding, so when a
+    worker dies only its own tasks fail. A task without result after task_timeout seconds fails with
+    TimeoutError; its block is unlinked once the late result arrives or its worker exits. target is the
+    process entry point with the signature of worker_main.
+    """
+
+    def __init__(
+        self,
+        checkpoint,
+        num_workers=2,
+        intra_op_threads=1,
+        inter_op_threads=1,
+        n_class=3,
+        warmup_shapes=(),
+        task_timeout=60,
+        target=worker_main,
+    ):
+        context = mp.get_context("spawn")
+        self.n_class = n_class
+        self.task_timeout = task_timeout
+        self.task_queues = [context.Queue() for _ in range(num_workers)]
+        self.result_queue = context.Queue()
+        self.futures = {}
+        # task ids sent to each worker and not finished yet
+        self.running = {i: set() for i in range(num_workers)}
+        self.dead = set()
+        self.lock = threading.Lock()
+        self.task_ids = itertools.count()
+        self.local = threading.local()
+        self.blocks = []
+        # blocks of timed-out tasks that a worker may still write into, by task id
+        self.abandoned = {}
+        self.ready = threading.Event()
+        self.num_ready = 0
+        self.processes = [
+            context.Process(
+                target=target,
+                args=(i, checkpoint, self.task_queues[i], self.result_queue, intra_op_threads, inter_op_threads, warmup_shapes),
+                daemon=True,
+            )
+            for i in range(num_workers)
+        ]
+        for process in self.processes:
+            process.start()
+        self.reader = threading.Thread(target=self.read_results, daemon=True)
+        self.reader.start()
+
+    def read_results(self):
+        last_check = time.monotonic()
+        while True:
+            # workers are checked at least every second, also while the others keep sending results
+            if time.monotonic() - last_check >= 1:
+                self.check_workers()
+                last_check = time.monotonic()
+            try:
+                message, worker_id, value = self.result_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+            if message == "ready":
+                self.num_ready += 1
+                if self.num_ready == len(self.processes):
+                    self.ready.set()
+                continue
+            task_id, error = message, value
+            with self.lock:
+                self.running[worker_id].discard(task_id)
+                future = self.futures.pop(task_id, None)
+                shm = self.abandoned.pop(task_id, None)
+            if shm is not None:
+                self.release(shm)
+            if future is None:
+                # failed or timed out already
+                continue
+            if error is None:
+                future.set_result(worker_id)
+            else:
+                future.set_exception(RuntimeError(f"Inference worker {worker_id}: {error}"))
+
+    def wait_ready(self, timeout=None):
+        """
+        Wait until every worker has restored the model and run its warm-up batches.
+        """
+        while not self.ready.wait(1 if timeout is None else min(timeout, 1)):
+            if any(not process.is_alive() for process in self.processes):
+                raise RuntimeError("An inference worker exited during start-up")
+            if timeout is not None:
+                timeout -= 1
+                if timeout <= 0:
+                    return False
+        return True
+
+    def check_workers(self):
+        """
+        Fail the tasks sent to workers that exited, and every task once no worker is left.
+        """
+        for worker_id, process in enumerate(self.processes):
+            if (worker_id in self.dead) or process.is_alive():
+                continue
+            with self.lock:
+                self.dead.add(worker_id)
+                task_ids, self.running[worker_id] = self.running[worker_id], set()
+                futures = [self.futures.pop(task_id) for task_id in task_ids if task_id in self.futures]
+                blocks = [self.abandoned.pop(task_id) for task_id in task_ids if task_id in self.abandoned]
+            for shm in blocks:
+                self.release(shm)
+            error = RuntimeError(f"Inference worker {worker_id} exited with code {process.exitcode}")
+            for future in futures:
+                future.set_exception(error)
+        if len(self.dead) == len(self.processes):
+            self.fail_all(RuntimeError("All inference workers exited"))
+
+    def fail_all(self, error):
+        with self.lock:
+            futures, self.futures = self.futures, {}
+        for future in futures.values():
+            future.set_exception(error)
+
+    def release(self, shm):
+        with self.lock:
+            if shm not in self.blocks:
+                # unlinked by close() already
+                return
+            self.blocks.remove(shm)
+        shm.close()
+        shm.unlink()
+
+    def block(self, size):
+        shm = getattr(self.local, "shm", None)
+        if (shm is None) or (shm.size < size):
+            if shm is not None:
+                self.release(shm)
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            self.local.shm = shm
+            with self.lock:
+                self.blocks.append(shm)
+        return shm
+
+    def run(self, vec):
+        vec = np.asarray(vec, dtype=np.float32)
+        out_shape = vec.shape[:-1] + (self.n_class,)
+        shm = self.block(vec.nbytes + int(np.prod(out_shape)) * 4)
+        np.ndarray(vec.shape, dtype=np.float32, buffer=shm.buf)[:] = vec
+        future = Future()
+        task_id = next(self.task_ids)
+        with self.lock:
+            alive = [i for i in self.running if i not in self.dead]
+            if len(alive) == 0:
+                raise RuntimeError("All inference workers exited")
+            worker_id = min(alive, key=lambda i: len(self.running[i]))
+            self.running[worker_id].add(task_id)
+            self.futures[task_id] = future
+        self.task_queues[worker_id].put((task_id, shm.name, vec.shape, out_shape))
+        try:
+            future.result(timeout=self.task_timeout)
+        except TimeoutError:
+            # a late worker may still write into the block, so this thread moves on to a new one
+            # and the block is released when the worker is done with the task
+            with self.lock:
+                # without the future, the result or the worker's exit came in meanwhile
+                finished = self.futures.pop(task_id, None) is None
+                if not finished:
+                    self.abandoned[task_id] = shm
+            self.local.shm = None
+            if finished:
+                self.release(shm)
+            raise
+        return np.ndarray(out_shape, dtype=np.float32, buffer=shm.buf, offset=vec.nbytes).copy()
+
+    def close(self):
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        with self.lock:
+            blocks, self.blocks = self.blocks, []
+            self.abandoned = {}
+        for shm in blocks:
+            try:
+                shm.close()
+                shm.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,183 @@
+import json
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+
+# same layout as the raw body of /predict_binary: magic, nsta, nt, nch (little-endian uint32), then float32 samples
+RAW_HEADER = struct.Struct("<4sIII")
+RAW_MAGIC = b"PNET"
+
+## Message schemas on the picks topic (phasenet_picks) and waveform topic (waveform_phasenet); keys are
+## serialized by the producer (JSON strings in app.py).
+## wire_format="json", the format of earlier releases and the default:
+##   picks:    one message per pick, key: station id, value: JSON {"id", "timestamp", "prob", "amp", "type"}
+##   waveform: one message per station, key: station id, value: JSON {"timestamp", "vec": [[...] * nch] * nt, "dt"}
+## wire_format="binary", every message with the header ("format", b"binary"):
+##   picks:    one message per station and request, key: station id, value: JSON list of the picks above
+##   waveform: one message per station, key: station id, value: RAW_HEADER (nsta = 1) + nt x nch float32 samples,
+##             see decode_waveform; headers ("timestamp", ISO time of the first sample) and ("dt", seconds)
+WIRE_FORMATS = ["json", "binary"]
+
+
+def encode_picks(picks):
+    # probabilities and amplitudes are numpy scalars
+    return json.dumps(picks, default=float).encode("utf-8")
+
+
+def encode_waveform(vec):
+    """
+    vec: nt, nch
+    """
+    vec = np.asarray(vec, dtype="<f4")
+    if vec.ndim == 1:
+        vec = vec[:, np.newaxis]
+    return RAW_HEADER.pack(RAW_MAGIC, 1, *vec.shape) + vec.tobytes()
+
+
+def decode_waveform(value):
+    magic, nsta, nt, nch = RAW_HEADER.unpack_from(value)
+    return np.frombuffer(value, dtype="<f4", offset=RAW_HEADER.size).reshape(nt, nch)
+
+
+class KafkaPublisher:
+    """
+    Publish picks and waveforms from a background thread so requests do not wait for the broker.
+    Messages beyond max_queue are dropped and counted, not blocked on. A send that raises (e.g. the
+    producer's buffer is full) is retried up to retries times, waiting retry_backoff, 2 * retry_backoff, ...
+
+    producer: anything with KafkaProducer's send(topic, value=, key=, headers=) returning a future
+              with add_callback/add_errback, e.g. KafkaProducer(value_serializer=None).
+    wire_format: "json" or "binary", see the message schemas above.
+    """
+
+    def __init__(
+        self,
+        producer,
+        max_queue=1000,
+        picks_topic="phasenet_picks",
+        waveform_topic="waveform_phasenet",
+        retries=3,
+        retry_backoff=0.1,
+        wire_format="json",
+    ):
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError(f"wire_format {wire_format} should be one of {WIRE_FORMATS}")
+        self.producer = producer
+        self.wire_format = wire_format
+        self.picks_topic = picks_topic
+        self.waveform_topic = waveform_topic
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.metrics = {
+            "enqueued": 0, "dropped": 0, "sent": 0, "retried": 0, "delivered": 0, "failed": 0, "bytes": 0, "latency": 0.0
+        }
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.metrics[name] += value
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+            self.count("enqueued")
+        except queue.Full:
+            self.count("dropped")
+
+    def publish_picks(self, picks):
+        """
+        Publish picks keyed by station id, so that the picks of a station stay in order on one partition:
+        one message per pick, or with wire_format="binary" one message per station of the request.
+        """
+        if self.wire_format == "json":
+            for pick in picks:
+                self.put(("picks", pick["id"], pick, time.monotonic()))
+            return
+        stations = {}
+        for pick in picks:
+            stations.setdefault(pick["id"], []).append(pick)
+        for key, picks_ in stations.items():
+            self.put(("picks", key, picks_, time.monotonic()))
+
+    def publish_waveforms(self, ids, timestamps, vecs, dt):
+        for id, timestamp, vec in zip(ids, timestamps, vecs):
+            self.put(("waveform", id, (timestamp, vec, dt), time.monotonic()))
+
+    def send(self, kind, key, value, enqueued):
+        headers = []
+        if kind == "picks":
+            topic, value = self.picks_topic, encode_picks(value)
+        elif self.wire_format == "json":
+            timestamp, vec, dt = value
+            topic = self.waveform_topic
+            value = json.dumps({"timestamp": timestamp, "vec": np.asarray(vec).tolist(), "dt": dt}).encode("utf-8")
+        else:
+            timestamp, vec, dt = value
+            topic = self.waveform_topic
+            headers = [("timestamp", timestamp.encode("utf-8")), ("dt", str(dt).encode("utf-8"))]
+            value = encode_waveform(vec)
+        if self.wire_format == "binary":
+            headers = [("format", b"binary")] + headers
+
+        def on_success(metadata):
+            self.count("delivered")
+            self.count("latency", time.monotonic() - enqueued)
+
+        def on_error(error):
+            self.count("failed")
+            print(f"kafka delivery error: {error}")
+
+        future = self.producer.send(topic, value=value, key=key, headers=headers)
+        future.add_callback(on_success)
+        future.add_errback(on_error)
+        self.count("sent")
+        self.count("bytes", len(value))
+
+    def loop(self):
+        while not self.stopped.is_set():
+            try:
+                item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is None:
+                self.queue.task_done()
+                break
+            for retry in range(self.retries + 1):
+                try:
+                    self.send(*item)
+                    break
+                except Exception as error:
+                    if (retry == self.retries) or self.stopped.wait(self.retry_backoff * 2 ** retry):
+                        self.count("failed")
+                        print(f"kafka send error: {error}")
+                        break
+                    self.count("retried")
+            self.queue.task_done()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.metrics)
+        stats["queue_depth"] = self.queue.qsize()
+        return stats
+
+    def close(self, timeout=10):
+        """
+        Deliver what is queued within timeout; if the queue stays full, stop after the current message.
+        """
+        deadline = time.monotonic() + timeout
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            self.stopped.set()
+        self.thread.join(max(deadline - time.monotonic(), 0))
+        self.stopped.set()
+        if hasattr(self.producer, "flush"):
+            self.producer.flush(timeout)
+
@@ -0,0 +1,121 @@
+import argparse
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import requests
+
+from kafka_publisher import RAW_HEADER, RAW_MAGIC
+
+### Load test of the prediction API, e.g. against a running server:
+### python phasenet/load_test.py --url http://localhost:8000 --concurrency 1,4,16
+### or starting one server per worker count:
+### python phasenet/load_test.py --launch --workers 1,2,4 --concurrency 16
+
+
+def read_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000", help="API url")
+    parser.add_argument("--endpoint", default="binary", help="binary: /predict_binary, json: /predict")
+    parser.add_argument("--stations", default=1, type=int, help="Stations per request")
+    parser.add_argument("--requests", default=200, type=int, help="Requests per concurrency level")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated numbers of concurrent clients")
+    parser.add_argument("--launch", action="store_true", help="Start a local server for each worker count")
+    parser.add_argument("--workers", default="1", help="Comma separated INFERENCE_WORKERS, used with --launch")
+    parser.add_argument("--port", default=8000, type=int, help="Port of the launched server")
+    parser.add_argument("--timeout", default=600, type=float, help="Seconds to wait for the launched server")
+    args = parser.parse_args()
+
+    return args
+
+
+def make_request(args):
+    vec = np.random.randn(args.stations, 3000, 3).astype("<f4")
+    ids = [f"LT.{i:04d}..HH" for i in range(args.stations)]
+    timestamps = [datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]] * args.stations
+    if args.endpoint == "json":
+        return "/predict", {"json": {"id": ids, "timestamp": timestamps, "vec": vec.tolist(), "dt": 0.01}}
+    body = RAW_HEADER.pack(RAW_MAGIC, *vec.shape) + vec.tobytes()
+    return "/predict_binary", {"data": body, "params": {"id": ids, "timestamp": timestamps}}
+
+
+def wait_ready(url, timeout):
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            if requests.get(f"{url}/healthz", timeout=1).status_code == 200:
+                return True
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(1)
+    return False
+
+
+def run_level(url, path, kwargs, concurrency, num_requests):
+    local = threading.local()
+
+    def call(_):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        session = local.session
+        start = time.perf_counter()
+        try:
+            ok = session.post(f"{url}{path}", **kwargs).status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, range(num_requests)))
+    elapsed = time.perf_counter() - start
+    latency = np.array([x for x, _ in results])
+    errors = sum(not ok for _, ok in results)
+    return num_requests / elapsed, latency, errors
+
+
+def benchmark(args, url, workers):
+    path, kwargs = make_request(args)
+    for concurrency in [int(x) for x in args.concurrency.split(",")]:
+        throughput, latency, errors = run_level(url, path, kwargs, concurrency, args.requests)
+        print(
+            f"{workers:>7} {concurrency:>11} {throughput:>9.1f} {throughput * args.stations:>11.1f} "
+            f"{np.percentile(latency, 50) * 1000:>8.1f} {np.percentile(latency, 95) * 1000:>8.1f} {errors:>6}"
+        )
+
+
+def main(args):
+
+    print(f"{'workers':>7} {'concurrency':>11} {'req/s':>9} {'stations/s':>11} {'p50 ms':>8} {'p95 ms':>8} {'errors':>6}")
+    if not args.launch:
+        workers = requests.get(f"{args.url}/healthz").json().get("inference_workers", "?")
+        benchmark(args, args.url, workers)
+        return
+
+    url = f"http://localhost:{args.port}"
+    for workers in [int(x) for x in args.workers.split(",")]:
+        env = dict(os.environ, INFERENCE_WORKERS=str(workers))
+        server = subprocess.Popen(
+            ["uvicorn", "--app-dir", os.path.dirname(os.path.abspath(__file__)), "app:app", "--port", str(args.port)],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            if not wait_ready(url, args.timeout):
+                print(f"server with {workers} workers did not become ready")
+                continue
+            benchmark(args, url, workers)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    args = read_args()
+    main(args)
@@ -0,0 +1,111 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Prometheus default latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+REGISTRY = []
+
+
+def format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, value=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        return self.header() + [f"{self.name}{format_labels(self.labelnames, k)} {v}" for k, v in values.items()]
+
+
+class Gauge(Metric):
+    """
+    Gauge read at scrape time from fn(), which returns a number or a {labels: value} dict.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, labelnames=(), registry=REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self.fn = fn
+
+    def render(self):
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return self.header() + [f"{self.name}{format_labels(self.labelnames, k)} {v}" for k, v in values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labelnames=(), registry=REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if labels not in self.values:
+                self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = self.values[labels]
+            counts[0][i] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        with self.lock:
+            values = {k: (list(v[0]), v[1]) for k, v in self.values.items()}
+        lines = self.header()
+        for labels, (counts, total) in values.items():
+            cumulative = 0
+            for le, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+def render(registry=REGISTRY):
+    """
+    Prometheus text exposition format (version 0.0.4).
+    """
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
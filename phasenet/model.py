@@ -2,6 +2,11 @@ import tensorflow as tf
 # tf.compat.v1.disable_eager_execution()
 import numpy as np
 import logging
+import ast
+import os
+
+## settings that define the UNet layers, so a checkpoint can only be restored with the values it was trained with
+ARCHITECTURE_KEYS = ["depths", "filters_root", "kernel_size", "pool_size", "dilation_rate", "separable"]
 
 class ModelConfig:
 
@@ -11,6 +16,7 @@ class ModelConfig:
   kernel_size = [7, 1]
   pool_size = [4, 1]
   dilation_rate = [1, 1]
+  separable = False
   class_weights = [1.0, 1.0, 1.0]
   loss_type = "cross_entropy"
   weight_decay = 0.0
@@ -35,6 +41,31 @@ class ModelConfig:
     for k,v in vars(args).items():
       setattr(self, k, v)
 
+  def write_log(self, log_dir):
+    """
+    Write the settings to log_dir/config.log, always including the architecture
+    """
+    items = {key: getattr(self, key) for key in ARCHITECTURE_KEYS}
+    items.update(vars(self))
+    with open(os.path.join(log_dir, "config.log"), "w") as fp:
+      fp.write('\n'.join("%s: %s" % item for item in items.items()))
+
+  def update_log(self, log_dir):
+    """
+    Read the architecture from the config.log written next to a checkpoint, if there is one. Checkpoints
+    of older training runs are in log_dir/models with config.log one level up, so the parent is tried too.
+    """
+    parent = os.path.dirname(os.path.normpath(log_dir))
+    for config_log in [os.path.join(log_dir, "config.log"), os.path.join(parent, "config.log")]:
+      if os.path.exists(config_log):
+        with open(config_log) as fp:
+          for line in fp:
+            key, _, value = line.partition(": ")
+            if key in ARCHITECTURE_KEYS:
+              setattr(self, key, ast.literal_eval(value.strip()))
+        break
+    return self
+
 
 def crop_and_concat(net1, net2):
   """
@@ -96,6 +127,7 @@ class UNet:
     self.kernel_size = config.kernel_size
     self.dilation_rate = config.dilation_rate
     self.pool_size = config.pool_size
+    self.separable = config.separable
     self.X_shape = config.X_shape
     self.Y_shape = config.Y_shape
     self.n_channel = config.n_channel
@@ -131,16 +163,48 @@ class UNet:
     # self.keep_prob = tf.compat.v1.placeholder(dtype=tf.float32, name="keep_prob")
     self.drop_rate = tf.compat.v1.placeholder(dtype=tf.float32, name="drop_rate")
 
+  def conv(self, net, filters, name, strides=(1, 1)):
+    """
+    kernel_size convolution without bias of the down and up blocks; depthwise-separable if self.separable
+    """
+    if self.separable:
+      return tf.compat.v1.layers.separable_conv2d(net,
+                     filters=filters,
+                     kernel_size=self.kernel_size,
+                     strides=strides,
+                     activation=None,
+                     use_bias=False,
+                     padding='same',
+                     dilation_rate=self.dilation_rate,
+                     depthwise_initializer=self.initializer,
+                     pointwise_initializer=self.initializer,
+                     depthwise_regularizer=self.regularizer,
+                     pointwise_regularizer=self.regularizer,
+                     name=name)
+    return tf.compat.v1.layers.conv2d(net,
+                   filters=filters,
+                   kernel_size=self.kernel_size,
+                   strides=strides,
+                   activation=None,
+                   use_bias=False,
+                   padding='same',
+                   dilation_rate=self.dilation_rate,
+                   kernel_initializer=self.initializer,
+                   kernel_regularizer=self.regularizer,
+                   name=name)
+
   def add_prediction_op(self):
     logging.info("Model: depths {depths}, filters {filters}, "
            "filter size {kernel_size[0]}x{kernel_size[1]}, "
            "pool size: {pool_size[0]}x{pool_size[1]}, "
-           "dilation rate: {dilation_rate[0]}x{dilation_rate[1]}".format(
+           "dilation rate: {dilation_rate[0]}x{dilation_rate[1]}, "
+           "separable: {separable}".format(
             depths=self.depths,
             filters=self.filters_root,
             kernel_size=self.kernel_size,
             dilation_rate=self.dilation_rate,
-            pool_size=self.pool_size))
+            pool_size=self.pool_size,
+            separable=self.separable))
 
     if self.weight_decay > 0:
       weight_decay = tf.constant(self.weight_decay, dtype=tf.float32, name="weight_constant")
@@ -180,16 +244,7 @@ class UNet:
       with tf.compat.v1.variable_scope("DownConv_%d" % depth):
         filters = int(2**(depth) * self.filters_root)
 
-        net = tf.compat.v1.layers.conv2d(net,
-                     filters=filters,
-                     kernel_size=self.kernel_size,
-                     activation=None,
-                     use_bias=False,
-                     padding='same',
-                     dilation_rate=self.dilation_rate,
-                     kernel_initializer=self.initializer,
-                     kernel_regularizer=self.regularizer,
-                     name="down_conv1_{}".format(depth + 1))
+        net = self.conv(net, filters, name="down_conv1_{}".format(depth + 1))
         net = tf.compat.v1.layers.batch_normalization(net,
                           training=self.is_training,
                           name="down_bn1_{}".format(depth + 1))
@@ -203,17 +258,7 @@ class UNet:
         convs[depth] = net
 
         if depth < self.depths - 1:
-          net = tf.compat.v1.layers.conv2d(net,
-                       filters=filters,
-                       kernel_size=self.kernel_size,
-                       strides=self.pool_size,
-                       activation=None,
-                       use_bias=False,
-                       padding='same',
-                       dilation_rate=self.dilation_rate,
-                       kernel_initializer=self.initializer,
-                       kernel_regularizer=self.regularizer,
-                       name="down_conv3_{}".format(depth + 1))
+          net = self.conv(net, filters, strides=self.pool_size, name="down_conv3_{}".format(depth + 1))
           net = tf.compat.v1.layers.batch_normalization(net,
                             training=self.is_training,
                             name="down_bn3_{}".format(depth + 1))
@@ -254,16 +299,7 @@ class UNet:
         net = crop_and_concat(convs[depth], net)
         #net = crop_only(convs[depth], net)
 
-        net = tf.compat.v1.layers.conv2d(net,
-                     filters=filters,
-                     kernel_size=self.kernel_size,
-                     activation=None,
-                     use_bias=False,
-                     padding='same',
-                     dilation_rate=self.dilation_rate,
-                     kernel_initializer=self.initializer,
-                     kernel_regularizer=self.regularizer,
-                     name="up_conv1_{}".format(depth + 1))
+        net = self.conv(net, filters, name="up_conv1_{}".format(depth + 1))
         net = tf.compat.v1.layers.batch_normalization(net,
                           training=self.is_training,
                           name="up_bn1_{}".format(depth + 1))
@@ -0,0 +1,103 @@
+import argparse
+import math
+
+from model import ModelConfig
+
+### Parameters, FLOPs and receptive field of UNet configurations, e.g.:
+### python phasenet/model_stats.py --filters_root 8,4 --separable
+
+
+def read_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--depths", default="5", help="Comma separated depths")
+    parser.add_argument("--filters_root", default="8", help="Comma separated root filter numbers")
+    parser.add_argument("--separable", action="store_true", help="Also report depthwise-separable variants")
+    parser.add_argument("--nt", default=3000, type=int, help="Window length in samples")
+    args = parser.parse_args()
+
+    return args
+
+
+def conv_cost(kernel, c_in, c_out, length, separable=False, bias=False):
+    """
+    Parameters and multiply-adds of a 'same' convolution along time producing length samples
+    """
+    if separable:
+        params = kernel * c_in + c_in * c_out
+    else:
+        params = kernel * c_in * c_out
+    if bias:
+        params += c_out
+    return params, params * length
+
+
+def model_stats(config=ModelConfig(), nt=3000):
+    """
+    Count the layers built by UNet.add_prediction_op along the time axis.
+    Returns trainable parameters, batch normalization moving statistics, FLOPs (2 x multiply-adds of the
+    convolutions) for one window of nt samples, and the receptive field in samples.
+    Dilation spreads the kernel taps, so it widens the receptive field but not the parameters or FLOPs.
+    """
+    kernel = config.kernel_size[0]
+    dilated = (kernel - 1) * config.dilation_rate[0] + 1
+    stride = config.pool_size[0]
+    separable = getattr(config, "separable", False)
+    filters = [int(2**depth * config.filters_root) for depth in range(config.depths)]
+    length = [nt]
+    for _ in range(config.depths - 1):
+        length.append(math.ceil(length[-1] / stride))
+
+    params, macs, bn = 0, 0, 0
+
+    def add(cost, channels):
+        nonlocal params, macs, bn
+        params += cost[0] + 2 * channels
+        macs += cost[1]
+        bn += 2 * channels
+
+    ## receptive field (rf) and distance between outputs (jump) in input samples, along the deepest path
+    add(conv_cost(kernel, config.n_channel, config.filters_root, nt, bias=True), config.filters_root)
+    rf, jump = dilated, 1
+    c_in = config.filters_root
+    for depth in range(config.depths):
+        add(conv_cost(kernel, c_in, filters[depth], length[depth], separable), filters[depth])
+        rf += (dilated - 1) * jump
+        c_in = filters[depth]
+        if depth < config.depths - 1:
+            add(conv_cost(kernel, c_in, c_in, length[depth + 1], separable), c_in)
+            rf += (kernel - 1) * jump
+            jump *= stride
+    for depth in range(config.depths - 2, -1, -1):
+        ## transposed convolution: every output sample sees ceil(kernel / stride) input samples
+        transpose = conv_cost(kernel, c_in, filters[depth], length[depth + 1])
+        add(transpose, filters[depth])
+        rf += (math.ceil(kernel / stride) - 1) * jump
+        jump //= stride
+        add(conv_cost(kernel, 2 * filters[depth], filters[depth], length[depth], separable), filters[depth])
+        rf += (dilated - 1) * jump
+        c_in = filters[depth]
+    params_out, macs_out = conv_cost(1, c_in, config.n_class, nt, bias=True)
+    params += params_out
+    macs += macs_out
+
+    return {"params": params, "bn_statistics": bn, "flops": 2 * macs, "receptive_field": rf}
+
+
+def main(args):
+
+    print(f"{'depths':>6} {'filters':>7} {'separable':>9} {'params':>9} {'MFLOPs':>9} {'receptive field':>22}")
+    for depths in [int(x) for x in args.depths.split(",")]:
+        for filters_root in [int(x) for x in args.filters_root.split(",")]:
+            for separable in [False, True] if args.separable else [False]:
+                config = ModelConfig(depths=depths, filters_root=filters_root, separable=separable)
+                stats = model_stats(config, nt=args.nt)
+                print(
+                    f"{depths:>6} {filters_root:>7} {str(separable):>9} {stats['params']:>9} {stats['flops'] / 1e6:>9.1f} "
+                    f"{stats['receptive_field']:>9} ({stats['receptive_field'] * 0.01:.2f} s)"
+                )
+
+
+if __name__ == "__main__":
+    args = read_args()
+    main(args)
@@ -0,0 +1,102 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+from data_reader import DataReader
+
+### Pack a training list into memory-mappable shards read by DataReader(format="shards", data_dir=output_dir):
+### python phasenet/pack_shards.py --data_dir dataset/waveform_train --data_list dataset/waveform.csv --output_dir dataset/waveform_shards
+
+
+def read_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--format", default="numpy", help="Input data format: numpy, hdf5")
+    parser.add_argument("--data_dir", default="./dataset/waveform_train/", help="Input file directory")
+    parser.add_argument("--data_list", default="./dataset/waveform.csv", help="Input csv file")
+    parser.add_argument("--hdf5_file", default="", help="Input hdf5 file")
+    parser.add_argument("--hdf5_group", default="data", help="data group name in hdf5 file")
+    parser.add_argument("--output_dir", default="./dataset/waveform_shards/", help="Output directory")
+    parser.add_argument("--shard_size", default=10000, type=int, help="Samples per shard")
+    parser.add_argument("--dtype", default="float32", help="Waveform dtype in the shards")
+    parser.add_argument("--seed", default=123, type=int, help="Seed of the pre-shuffle")
+    args = parser.parse_args()
+
+    return args
+
+
+def pad_picks(picks, nsta, max_picks):
+    """
+    Per-station pick lists as a (nsta, max_picks) float array padded with NaN.
+    """
+    padded = np.full([nsta, max_picks], np.nan)
+    for j, trace in enumerate(picks):
+        trace = np.asarray(trace, dtype=float).ravel()
+        padded[j, : len(trace)] = trace
+    return padded
+
+
+def main(args):
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+    data_reader = DataReader(
+        format=args.format,
+        data_dir=args.data_dir,
+        data_list=args.data_list,
+        hdf5_file=args.hdf5_file,
+        hdf5_group=args.hdf5_group,
+    )
+
+    def read(i):
+        if args.format == "numpy":
+            return data_reader.read_numpy(os.path.join(args.data_dir, data_reader.data_list[i]))
+        return data_reader.read_hdf5(data_reader.data_list[i])
+
+    # pre-shuffle once, so that readers can go through each shard sequentially
+    order = np.random.default_rng(args.seed).permutation(data_reader.num_data)
+    meta = read(order[0])
+    shape = meta["data"].shape
+    nsta = shape[1]
+    num_shards = (len(order) + args.shard_size - 1) // args.shard_size
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    fname, shard, row, itp, its = [], [], [], [], []
+    for k in range(num_shards):
+        index = order[k * args.shard_size : (k + 1) * args.shard_size]
+        waveform = np.lib.format.open_memmap(
+            os.path.join(args.output_dir, f"shard_{k:05d}.npy"), mode="w+", dtype=args.dtype, shape=(len(index),) + shape
+        )
+        for j, i in enumerate(tqdm(index, desc=f"shard {k + 1}/{num_shards}")):
+            # the reader's buffer would keep every sample in memory
+            data_reader.buffer.clear()
+            meta = read(i)
+            if meta["data"].shape != shape:
+                raise ValueError(f"{data_reader.data_list[i]} has shape {meta['data'].shape}, expected {shape}")
+            waveform[j] = meta["data"]
+            fname.append(data_reader.data_list[i])
+            shard.append(k)
+            row.append(j)
+            itp.append(meta["itp"])
+            its.append(meta["its"])
+        waveform.flush()
+        del waveform
+
+    max_p = max(len(np.asarray(x, dtype=float).ravel()) for picks in itp for x in picks)
+    max_s = max(len(np.asarray(x, dtype=float).ravel()) for picks in its for x in picks)
+    np.savez(
+        os.path.join(args.output_dir, "index.npz"),
+        fname=np.array(fname),
+        shard=np.array(shard, dtype="int32"),
+        row=np.array(row, dtype="int32"),
+        itp=np.stack([pad_picks(x, nsta, max_p) for x in itp]),
+        its=np.stack([pad_picks(x, nsta, max_s) for x in its]),
+    )
+    logging.info(f"Packed {len(fname)} samples into {num_shards} shards in {args.output_dir}")
+
+
+if __name__ == "__main__":
+    args = read_args()
+    main(args)
@@ -1,19 +1,28 @@
 
 import os
+import gzip
 import numpy as np
+import pandas as pd
 from collections import namedtuple
 from datetime import datetime, timedelta
 import json
 import matplotlib.pyplot as plt
 import logging
-from detect_peaks import detect_peaks
+import h5py
+from detect_peaks import detect_peaks, StreamingPeakDetector
+from scipy.optimize import linear_sum_assignment
+
+## module level so that picks can be sent between processes
+Picks = namedtuple("Picks", ["fname", "station_id", "t0", "p_idx", "p_prob", "s_idx", "s_prob"])
+PicksPS = namedtuple("PicksPS", ["fname", "station_id", "t0", "p_idx", "p_prob", "s_idx", "s_prob", "ps_idx", "ps_prob"])
+Amplitudes = namedtuple("Amplitudes", ["p_amp", "s_amp"])
 
 def extract_picks(preds, fnames=None, station_ids=None, t0=None, config=None):
 
     if preds.shape[-1] == 4:
-        record = namedtuple("phase", ["fname", "station_id", "t0", "p_idx", "p_prob", "s_idx", "s_prob", "ps_idx", "ps_prob"])
+        record = PicksPS
     else:
-        record = namedtuple("phase", ["fname", "station_id", "t0", "p_idx", "p_prob", "s_idx", "s_prob"])
+        record = Picks
 
     picks = []
     for i, pred in enumerate(preds):
@@ -65,8 +74,42 @@ def extract_picks(preds, fnames=None, station_ids=None, t0=None, config=None):
     return picks
 
 
+def extract_picks_stream(chunks, fname, station_id, t0, config=None):
+    """
+    extract_picks for one continuous trace given as consecutive chunks (nt, nsta, n_class),
+    without holding the whole trace in memory
+    """
+    if config is None:
+        mph_p, mph_s, mpd = 0.3, 0.3, 50
+    else:
+        mph_p, mph_s, mpd = config.min_p_prob, config.min_s_prob, config.mpd
+
+    detectors = None
+    p_idx, p_prob, s_idx, s_prob = [], [], [], []
+    for pred in chunks:
+        if detectors is None:
+            detectors = [(StreamingPeakDetector(mph=mph_p, mpd=mpd), StreamingPeakDetector(mph=mph_s, mpd=mpd)) for _ in range(pred.shape[1])]
+            p_idx, p_prob, s_idx, s_prob = [[[] for _ in detectors] for _ in range(4)]
+        for j, (detector_p, detector_s) in enumerate(detectors):
+            p_idx_, p_prob_ = detector_p.update(pred[:, j, 1])
+            s_idx_, s_prob_ = detector_s.update(pred[:, j, 2])
+            p_idx[j].extend(p_idx_)
+            p_prob[j].extend(p_prob_)
+            s_idx[j].extend(s_idx_)
+            s_prob[j].extend(s_prob_)
+    for j, (detector_p, detector_s) in enumerate(detectors or []):
+        p_idx_, p_prob_ = detector_p.flush()
+        s_idx_, s_prob_ = detector_s.flush()
+        p_idx[j].extend(p_idx_)
+        p_prob[j].extend(p_prob_)
+        s_idx[j].extend(s_idx_)
+        s_prob[j].extend(s_prob_)
+
+    return Picks(fname, station_id, t0, p_idx, p_prob, s_idx, s_prob)
+
+
 def extract_amplitude(data, picks, window_p=10, window_s=5, config=None):
-    record = namedtuple("amplitude", ["p_amp", "s_amp"])
+    record = Amplitudes
     dt = 0.01 if config is None else config.dt
     window_p = int(window_p/dt)
     window_s = int(window_s/dt)
@@ -93,29 +136,79 @@ def extract_amplitude(data, picks, window_p=10, window_s=5, config=None):
     return amps
 
 
-def save_picks(picks, output_dir, amps=None, fname=None):
+def extract_amplitude_stream(chunks, picks, window_p=10, window_s=5, config=None):
+    """
+    extract_amplitude for the picks of one continuous trace given as consecutive chunks (nt, nsta, n_channel),
+    without holding the whole trace in memory
+    """
+    dt = 0.01 if config is None else config.dt
+    window_p = int(window_p/dt)
+    window_s = int(window_s/dt)
+
+    def bounds(idx, window):
+        ## picks in time order; each pick's window ends at the next pick, so the window ends are sorted too
+        idx = np.asarray(idx, dtype=np.int64)
+        order = np.argsort(idx, kind="stable")
+        begin = idx[order]
+        end = begin + window
+        end[:-1] = np.minimum(end[:-1], begin[1:])
+        ## [begin, end, max amplitude, cursor: windows before it ended before the current chunk]
+        return [begin, end, np.zeros(len(begin)), 0, order]
+
+    windows = [(bounds(p, window_p), bounds(s, window_s)) for p, s in zip(picks.p_idx, picks.s_idx)]
+    offset = 0
+    for data in chunks:
+        n = len(data)
+        amp = np.max(np.abs(data), axis=-1)
+        for j, station in enumerate(windows):
+            for window in station:
+                begin, end, out, cursor, _ = window
+                cursor += np.searchsorted(end[cursor:], offset, side="right")
+                window[3] = cursor
+                for k in range(cursor, cursor + np.searchsorted(begin[cursor:], offset + n, side="left")):
+                    if begin[k] < end[k]:
+                        out[k] = max(out[k], np.max(amp[max(begin[k] - offset, 0) : min(end[k] - offset, n), j]))
+        offset += n
+
+    def unsort(window):
+        begin, end, out, cursor, order = window
+        value = np.zeros(len(out))
+        value[order] = out
+        return list(value)
+
+    return Amplitudes([unsort(p) for p, _ in windows], [unsort(s) for _, s in windows])
+
+
+def save_picks(picks, output_dir, amps=None, fname=None, mode="w"):
+    """
+    mode="a" appends picks without a header, to write a file batch by batch
+    """
     if fname is None:
         fname = "picks.csv"
+    header = (mode == "w")
 
     int2s = lambda x: ",".join(["["+",".join(map(str, i))+"]" for i in x])
     flt2s = lambda x: ",".join(["["+",".join(map("{:0.3f}".format, i))+"]" for i in x])
     sci2s = lambda x: ",".join(["["+",".join(map("{:0.3e}".format, i))+"]" for i in x])
     if amps is None:
-        if hasattr(picks[0], "ps_idx"):
-            with open(os.path.join(output_dir, fname), "w") as fp:
-                fp.write("fname\tt0\tp_idx\tp_prob\ts_idx\ts_prob\tps_idx\tps_prob\n")
+        if (len(picks) > 0) and hasattr(picks[0], "ps_idx"):
+            with open(os.path.join(output_dir, fname), mode) as fp:
+                if header:
+                    fp.write("fname\tt0\tp_idx\tp_prob\ts_idx\ts_prob\tps_idx\tps_prob\n")
                 for pick in picks:
                     fp.write(f"{pick.fname}\t{pick.t0}\t{int2s(pick.p_idx)}\t{flt2s(pick.p_prob)}\t{int2s(pick.s_idx)}\t{flt2s(pick.s_prob)}\t{int2s(pick.ps_idx)}\t{flt2s(pick.ps_prob)}\n")
                 fp.close()
         else:
-            with open(os.path.join(output_dir, fname), "w") as fp:
-                fp.write("fname\tt0\tp_idx\tp_prob\ts_idx\ts_prob\n")
+            with open(os.path.join(output_dir, fname), mode) as fp:
+                if header:
+                    fp.write("fname\tt0\tp_idx\tp_prob\ts_idx\ts_prob\n")
                 for pick in picks:
                     fp.write(f"{pick.fname}\t{pick.t0}\t{int2s(pick.p_idx)}\t{flt2s(pick.p_prob)}\t{int2s(pick.s_idx)}\t{flt2s(pick.s_prob)}\n")
                 fp.close()
     else:
-        with open(os.path.join(output_dir, fname), "w") as fp:
-            fp.write("fname\tt0\tp_idx\tp_prob\ts_idx\ts_prob\tp_amp\ts_amp\n")
+        with open(os.path.join(output_dir, fname), mode) as fp:
+            if header:
+                fp.write("fname\tt0\tp_idx\tp_prob\ts_idx\ts_prob\tp_amp\ts_amp\n")
             for pick, amp in zip(picks, amps):
                 fp.write(f"{pick.fname}\t{pick.t0}\t{int2s(pick.p_idx)}\t{flt2s(pick.p_prob)}\t{int2s(pick.s_idx)}\t{flt2s(pick.s_prob)}\t{sci2s(amp.p_amp)}\t{sci2s(amp.s_amp)}\n")
             fp.close()
@@ -169,6 +262,83 @@ def save_picks_json(picks, output_dir, dt=0.01, amps=None, fname=None):
     return 0
 
 
+def picks_to_columns(picks, dt=0.01, amps=None):
+    """
+    Flatten extract_picks records into columns: id, timestamp, prob, (amp,) type
+    """
+    flatten = lambda x: np.concatenate([np.asarray(i, dtype=float) for i in x]) if len(x) > 0 else np.array([])
+    columns = {"id": [], "timestamp": [], "prob": [], "amp": [], "type": []}
+    for i, pick in enumerate(picks):
+        t0 = np.datetime64(pick.t0, "us")
+        for phase in ["p", "s"]:
+            idx = flatten(getattr(pick, f"{phase}_idx"))
+            if len(idx) == 0:
+                continue
+            columns["id"].append(np.full(len(idx), pick.station_id, dtype=object))
+            ## same rounding as calc_timestamp: to microseconds, then truncated to milliseconds
+            timestamp = t0 + np.round(idx * dt * 1e6).astype("timedelta64[us]")
+            columns["timestamp"].append(np.datetime_as_string(timestamp.astype("datetime64[ms]")))
+            columns["prob"].append(flatten(getattr(pick, f"{phase}_prob")))
+            if amps is not None:
+                columns["amp"].append(flatten(getattr(amps[i], f"{phase}_amp")))
+            columns["type"].append(np.full(len(idx), phase, dtype=object))
+    if amps is None:
+        del columns["amp"]
+    return {k: np.concatenate(v) if len(v) > 0 else np.array([]) for k, v in columns.items()}
+
+
+class PicksJsonlWriter:
+    """
+    Write picks as JSON Lines (one pick per line) in chunks, gzip compressed if fname ends with .gz
+    """
+
+    def __init__(self, fname, chunk_size=100000):
+        if fname.endswith(".gz"):
+            self.fp = gzip.open(fname, "wt")
+        else:
+            self.fp = open(fname, "w")
+        self.chunk_size = chunk_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.fp.close()
+
+    def write_columns(self, columns):
+        df = pd.DataFrame(columns)
+        for i in range(0, len(df), self.chunk_size):
+            lines = df.iloc[i : i + self.chunk_size].to_json(orient="records", lines=True)
+            self.fp.write(lines.rstrip("\n") + "\n")
+        return 0
+
+    def write(self, picks, dt=0.01, amps=None):
+        return self.write_columns(picks_to_columns(picks, dt=dt, amps=amps))
+
+
+def read_picks_json(fname, chunksize=None, convert_dates=True):
+    """
+    Read picks from save_picks_json (.json) or PicksJsonlWriter (.jsonl, .jsonl.gz) into a DataFrame; a file
+    without picks gives an empty DataFrame with the columns id, timestamp, prob and type.
+    With chunksize, a .jsonl file is streamed as an iterator of DataFrames with at most chunksize picks (none
+    for a file without picks). A .json file is one document that has to be parsed whole, so it takes no chunksize.
+    """
+    if ".jsonl" not in fname:
+        if chunksize is not None:
+            raise ValueError(f"chunksize needs a .jsonl file, {fname} is read whole")
+        df = pd.read_json(fname, convert_dates=convert_dates, dtype={"id": str})
+    else:
+        df = pd.read_json(fname, lines=True, chunksize=chunksize, convert_dates=convert_dates, dtype={"id": str})
+        if chunksize is not None:
+            return df
+    if len(df) == 0:
+        return pd.DataFrame(columns=["id", "timestamp", "prob", "type"])
+    return df
+
+
 def convert_true_picks(fname, itp, its, itps=None):
     true_picks = []
     if itps is None:
@@ -194,52 +364,298 @@ def calc_metrics(nTP, nP, nT):
     f1 = 2* precision * recall / (precision + recall)
     return [precision, recall, f1]
 
+def flatten_picks(traces):
+    """
+    traces: list of pick index lists, one per trace
+    return: trace id and index of every pick
+    """
+    idx = np.array([i for trace in traces for i in trace], dtype=float)
+    trace_id = np.repeat(np.arange(len(traces)), [len(trace) for trace in traces])
+    return trace_id, idx
+
+
+def match_picks(pred_idx, true_idx, tol, pred_trace=None, true_trace=None, inclusive=True):
+    """
+    Pair true and predicted picks of the same trace one-to-one, each pick used at most once, maximizing the
+    number of pairs within tol and, among those, minimizing the total absolute residual.
+    A pair counts if |pred - true| <= tol, or < tol with inclusive=False.
+    pred_trace/true_trace: trace id of each pick (default: a single trace)
+    return: number of true positives, false positives, false negatives, and residuals (pred - true) of matched
+    pairs in the order of the true picks along the traces
+    """
+    pred_idx = np.asarray(pred_idx, dtype=float)
+    true_idx = np.asarray(true_idx, dtype=float)
+    pred_trace = np.zeros(len(pred_idx)) if pred_trace is None else np.asarray(pred_trace, dtype=float)
+    true_trace = np.zeros(len(true_idx)) if true_trace is None else np.asarray(true_trace, dtype=float)
+    keep = ~np.isnan(pred_idx)
+    pred_idx, pred_trace = pred_idx[keep], pred_trace[keep]
+    keep = ~np.isnan(true_idx)
+    true_idx, true_trace = true_idx[keep], true_trace[keep]
+    if (len(pred_idx) == 0) or (len(true_idx) == 0):
+        return np.int64(0), np.int64(len(pred_idx)), np.int64(len(true_idx)), np.array([])
+    within = (lambda x: np.abs(x) <= tol) if inclusive else (lambda x: np.abs(x) < tol)
+
+    ## one sorted axis: traces are separated by more than tol
+    lo = min(pred_idx.min(), true_idx.min())
+    span = max(pred_idx.max(), true_idx.max()) - lo + 2 * tol + 1
+    pred_key = np.sort(pred_trace * span + (pred_idx - lo))
+    true_key = np.sort(true_trace * span + (true_idx - lo))
+
+    ## picks closer than tol to their neighbour form a cluster; pairs never cross clusters
+    key = np.concatenate([pred_key, true_key])
+    order = np.argsort(key, kind="stable")
+    cluster = np.empty(len(key), dtype=np.int64)
+    cluster[order] = np.concatenate([[0], np.cumsum(np.diff(key[order]) > tol)])
+    pred_cluster, true_cluster = cluster[: len(pred_key)], cluster[len(pred_key) :]
+    num_pred = np.bincount(pred_cluster, minlength=cluster.max() + 1)
+    num_true = np.bincount(true_cluster, minlength=cluster.max() + 1)
+
+    ## most clusters hold one true and one predicted pick
+    single = (num_pred == 1) & (num_true == 1)
+    pred_pos = np.searchsorted(pred_cluster, np.arange(len(num_pred)))
+    diff = np.full(len(true_key), np.nan)
+    is_single = single[true_cluster]
+    diff[is_single] = pred_key[pred_pos[true_cluster[is_single]]] - true_key[is_single]
+
+    true_pos = np.searchsorted(true_cluster, np.arange(len(num_true)))
+    for c in np.flatnonzero((num_pred > 0) & (num_true > 0) & ~single):
+        true_ = slice(true_pos[c], true_pos[c] + num_true[c])
+        pair = pred_key[pred_pos[c] : pred_pos[c] + num_pred[c]][np.newaxis, :] - true_key[true_, np.newaxis]
+        ok = within(pair)
+        ## every admissible pair outweighs any sum of residuals, so the number of pairs is maximized first
+        cost = np.where(ok, np.abs(pair) - (tol + 1) * (min(pair.shape) + 1), 0)
+        row, col = linear_sum_assignment(cost)
+        row, col = row[ok[row, col]], col[ok[row, col]]
+        diff[true_.start + row] = pair[row, col]
+
+    matched = ~np.isnan(diff)
+    matched[matched] = within(diff[matched])
+    nTP = np.int64(np.sum(matched))
+    return nTP, len(pred_key) - nTP, len(true_key) - nTP, diff[matched]
+
+
+class PickEvaluator:
+    """
+    Accumulate true/false positives, false negatives and a residual histogram per phase batch by batch,
+    so that a test set is evaluated without keeping its picks.
+    Residual bins are one sample wide and cover [-tol, tol].
+    """
+
+    def __init__(self, tol=3.0, dt=1.0):
+        self.tol = tol
+        self.dt = dt
+        n = int(round(tol / dt))
+        self.bins = (np.arange(-n, n + 2) - 0.5) * dt
+        self.counts = {}
+
+    def update(self, picks, true_picks):
+        assert(len(picks) == len(true_picks))
+        for phase in true_picks[0]._fields:
+            if phase == "fname":
+                continue
+            pred_trace, pred_idx = flatten_picks([trace for pick in picks for trace in getattr(pick, phase)])
+            true_trace, true_idx = flatten_picks([trace for pick in true_picks for trace in getattr(pick, phase)])
+            true_positive, false_positive, false_negative, residual = match_picks(
+                pred_idx, true_idx, self.tol / self.dt, pred_trace=pred_trace, true_trace=true_trace
+            )
+            residual = self.dt * residual
+            if phase not in self.counts:
+                self.counts[phase] = {"records": 0, "tp": np.int64(0), "fp": np.int64(0), "fn": np.int64(0),
+                                      "sum": 0.0, "sum2": 0.0, "hist": np.zeros(len(self.bins) - 1, dtype=np.int64)}
+            counts = self.counts[phase]
+            counts["records"] += len(picks)
+            counts["tp"] += true_positive
+            counts["fp"] += false_positive
+            counts["fn"] += false_negative
+            counts["sum"] += np.sum(residual)
+            counts["sum2"] += np.sum(residual ** 2)
+            counts["hist"] += np.histogram(residual, bins=self.bins)[0]
+
+    def summary(self):
+        metrics = {}
+        for i, (phase, counts) in enumerate(self.counts.items()):
+            if i == 0:
+                logging.info("Total records: {}".format(counts["records"]))
+            true_positive = counts["tp"]
+            positive = true_positive + counts["fp"]
+            true = true_positive + counts["fn"]
+            metrics[phase] = calc_metrics(true_positive, positive, true)
+            mean = counts["sum"] / np.float64(true_positive)
+            std = np.sqrt(max(counts["sum2"] / np.float64(true_positive) - mean ** 2, 0))
+
+            logging.info(f"{phase}-phase:")
+            logging.info(f"True={true}, Positive={positive}, True Positive={true_positive}")
+            logging.info(f"Precision={metrics[phase][0]:.3f}, Recall={metrics[phase][1]:.3f}, F1={metrics[phase][2]:.3f}")
+            logging.info(f"Residual mean={mean:.4f}, std={std:.4f}")
+
+        return metrics
+
+    def save_residuals(self, output_dir, fname="residuals.csv"):
+        df = pd.DataFrame({"residual": np.round((self.bins[:-1] + self.bins[1:]) / 2, 6)})
+        for phase, counts in self.counts.items():
+            df[phase] = counts["hist"]
+        df.to_csv(os.path.join(output_dir, fname), index=False)
+        return 0
+
+
 def calc_performance(picks, true_picks, tol=3.0, dt=1.0):
-    assert(len(picks) == len(true_picks))
-    logging.info("Total records: {}".format(len(picks)))
-
-    count = lambda picks: sum([len(x) for x in picks])
-    metrics = {}
-    for phase in true_picks[0]._fields:
-        if phase == "fname":
-            continue
-        true_positive, positive, true = 0, 0, 0
-        residual = []
-        for i in range(len(true_picks)):
-            true += count(getattr(true_picks[i], phase))
-            positive += count(getattr(picks[i], phase))
-            # print(i, phase, getattr(picks[i], phase), getattr(true_picks[i], phase))
-            diff = dt*(np.array(getattr(picks[i], phase))[:,np.newaxis,:] - np.array(getattr(true_picks[i], phase))[:,:,np.newaxis])
-            residual.extend(list(diff[np.abs(diff) <= tol]))
-            true_positive += np.sum(np.abs(diff) <= tol)
-        metrics[phase] = calc_metrics(true_positive, positive, true)
-
-        logging.info(f"{phase}-phase:")
-        logging.info(f"True={true}, Positive={positive}, True Positive={true_positive}")
-        logging.info(f"Precision={metrics[phase][0]:.3f}, Recall={metrics[phase][1]:.3f}, F1={metrics[phase][2]:.3f}")
-        logging.info(f"Residual mean={np.mean(residual):.4f}, std={np.std(residual):.4f}")
-
-    return metrics
+    evaluator = PickEvaluator(tol=tol, dt=dt)
+    evaluator.update(picks, true_picks)
+    return evaluator.summary()
 
 
 def save_prob_h5(probs, fnames, output_h5):
+    strip_npz = lambda x: x[:-len(".npz")] if x.endswith(".npz") else x
     if fnames is None:
         fnames = [f"{i:04d}" for i in range(len(probs))]
     elif type(fnames[0]) is bytes:
-        fnames = [f.decode().rstrip(".npz") for f in fnames]
+        fnames = [strip_npz(f.decode()) for f in fnames]
     else:
-        fnames = [f.rstrip(".npz") for f in fnames]
+        fnames = [strip_npz(f) for f in fnames]
     for prob, fname in zip(probs, fnames):
         output_h5.create_dataset(fname, data=prob, dtype="float32")
     return 0
 
 def save_prob(probs, fnames, prob_dir):
+    strip_npz = lambda x: x[:-len(".npz")] if x.endswith(".npz") else x
     if fnames is None:
         fnames = [f"{i:04d}" for i in range(len(probs))]
     elif type(fnames[0]) is bytes:
-        fnames = [f.decode().rstrip(".npz") for f in fnames]
+        fnames = [strip_npz(f.decode()) for f in fnames]
     else:
-        fnames = [f.rstrip(".npz") for f in fnames]
+        fnames = [strip_npz(f) for f in fnames]
     for prob, fname in zip(probs, fnames):
         np.savez(os.path.join(prob_dir, fname+".npz"), prob=prob)
-    return 0
\ No newline at end of file
+    return 0
+
+
+class ProbArchive:
+    """
+    Continuous phase probabilities stored per station in one HDF5 file.
+
+    Each station is an extendable dataset under /prob, chunked along time, with the
+    start time (t0) and sampling interval (dt) kept as attributes. Windows are placed
+    at their offset from the station start, so the archive can be read back by station
+    and time range. A window before the station start moves the start back, so records
+    can be written in any order. dtype="uint8" or "float16" quantizes the probabilities.
+    The amplitude envelope used by extract_amplitude can be kept under /amp.
+    """
+
+    time_format = "%Y-%m-%dT%H:%M:%S.%f"
+
+    def __init__(self, fname, mode="r", dt=0.01, dtype="float32", compression="gzip", chunk_size=60000):
+        if dtype not in ["float32", "float16", "uint8"]:
+            raise ValueError(f"dtype {dtype} should be float32, float16 or uint8")
+        self.h5 = h5py.File(fname, mode, libver="latest")
+        if mode == "r":
+            self.group = self.h5["prob"]
+        else:
+            self.group = self.h5.require_group("prob")
+        self.dt = dt
+        self.dtype = dtype
+        self.compression = None if compression in [None, "", "none"] else compression
+        self.chunk_size = chunk_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.h5.close()
+
+    @property
+    def stations(self):
+        return list(self.group.keys())
+
+    def has_amp(self, station_id):
+        return ("amp" in self.h5) and (station_id in self.h5["amp"])
+
+    def offset(self, dataset, timestamp):
+        t0 = datetime.strptime(dataset.attrs["t0"], self.time_format)
+        t = datetime.strptime(timestamp, self.time_format)
+        return int(round((t - t0).total_seconds() / dataset.attrs["dt"]))
+
+    def write_dataset(self, group, station_id, t0, data, dtype):
+        if station_id not in group:
+            ds = group.create_dataset(
+                station_id,
+                shape=(0, *data.shape[1:]),
+                maxshape=(None, *data.shape[1:]),
+                chunks=(self.chunk_size, *data.shape[1:]),
+                dtype=dtype,
+                compression=self.compression,
+                shuffle=self.compression is not None,
+            )
+            ds.attrs["t0"] = t0
+            ds.attrs["dt"] = self.dt
+            ds.attrs["scale"] = 1.0 / 255 if dtype == "uint8" else 1.0
+        ds = group[station_id]
+
+        begin = self.offset(ds, t0)
+        if begin < 0:
+            self.prepend(ds, -begin, t0)
+            begin = 0
+        end = begin + len(data)
+        if end > ds.shape[0]:
+            ds.resize(end, axis=0)
+        ds[begin:end, ...] = data
+        return 0
+
+    def prepend(self, ds, shift, t0):
+        """
+        Move the station start back to t0: shift the stored samples by shift, from the end so that no
+        block is overwritten before it is copied, and zero the samples in front
+        """
+        size = ds.shape[0]
+        ds.resize(size + shift, axis=0)
+        step = self.chunk_size
+        for end in range(size, 0, -step):
+            begin = max(end - step, 0)
+            ds[begin + shift : end + shift, ...] = ds[begin:end, ...]
+        ds[: min(shift, size), ...] = 0
+        ds.attrs["t0"] = t0
+
+    def write(self, station_id, t0, prob, amp=None):
+        """
+        prob: nt, nsta, n_class
+        amp: nt, nsta, n_channel raw amplitude, reduced to max(abs) over channels
+        """
+        prob = np.asarray(prob)
+        if self.dtype == "uint8":
+            data = np.round(np.clip(prob, 0, 1) * 255).astype("uint8")
+        else:
+            data = prob.astype(self.dtype)
+        self.write_dataset(self.group, station_id, t0, data, self.dtype)
+
+        if amp is not None:
+            amp = np.max(np.abs(amp), axis=-1, keepdims=True).astype("float32")
+            self.write_dataset(self.h5.require_group("amp"), station_id, t0, amp, "float32")
+        return 0
+
+    def read(self, station_id, starttime=None, endtime=None, group="prob"):
+        """
+        Return (t0, data) for a station between starttime and endtime, data in float32.
+        """
+        ds = self.h5[group][station_id]
+        begin = 0 if starttime is None else min(max(self.offset(ds, starttime), 0), ds.shape[0])
+        end = ds.shape[0] if endtime is None else min(max(self.offset(ds, endtime), begin), ds.shape[0])
+        data = ds[begin:end, ...].astype("float32")
+        if ds.dtype == np.uint8:
+            data *= ds.attrs["scale"]
+        t0 = datetime.strptime(ds.attrs["t0"], self.time_format) + timedelta(seconds=begin * ds.attrs["dt"])
+        return t0.strftime(self.time_format)[:-3], data
+
+    def read_chunks(self, station_id, starttime=None, group="prob"):
+        """
+        Iterate over a station's data from starttime one storage chunk at a time, data in float32.
+        """
+        ds = self.h5[group][station_id]
+        step = ds.chunks[0] if ds.chunks is not None else self.chunk_size
+        start = 0 if starttime is None else min(max(self.offset(ds, starttime), 0), ds.shape[0])
+        for begin in range(start, ds.shape[0], step):
+            data = ds[begin : begin + step, ...].astype("float32")
+            if ds.dtype == np.uint8:
+                data *= ds.attrs["scale"]
+            yield data
@@ -12,14 +12,17 @@ import pandas as pd
 import tensorflow as tf
 from tqdm import tqdm
 
-from data_reader import DataReader_mseed_array, DataReader_pred
+from data_reader import DEFAULT_T0, DataReader_mseed_array, DataReader_pred
 from model import ModelConfig, UNet
 from postprocess import (
     extract_amplitude,
+    extract_amplitude_stream,
     extract_picks,
+    extract_picks_stream,
     save_picks,
     save_picks_json,
-    save_prob_h5,
+    PicksJsonlWriter,
+    ProbArchive,
 )
 from visulization import plot_waveform
 
@@ -48,6 +51,17 @@ def read_args():
     parser.add_argument("--stations", default="", help="seismic station info")
     parser.add_argument("--plot_figure", action="store_true", help="If plot figure for test")
     parser.add_argument("--save_prob", action="store_true", help="If save result for test")
+    parser.add_argument("--prob_dtype", default="float32", help="Saved probability dtype: float32, float16, uint8")
+    parser.add_argument("--prob_compression", default="gzip", help="Saved probability compression: gzip, lzf, none")
+    parser.add_argument("--json_format", default="json", help="Picks json format: json, jsonl, jsonl.gz")
+    parser.add_argument("--prob_file", default="", help="Re-pick from a saved probability file instead of running the model")
+    parser.add_argument("--num_workers", default=multiprocessing.cpu_count(), type=int, help="Number of re-picking processes")
+    parser.add_argument("--depths", default=None, type=int, help="UNet depths of the checkpoint (default: from config.log)")
+    parser.add_argument("--filters_root", default=None, type=int, help="UNet root filters of the checkpoint (default: from config.log)")
+    parser.add_argument("--separable", action="store_true", default=None, help="The checkpoint uses depthwise-separable convolutions (default: from config.log)")
+    parser.add_argument("--backend", default="tf", choices=["tf", "tflite"], help="tf: checkpoint, tflite: model from quantize.py")
+    parser.add_argument("--tflite_model", default="", help="TFLite model for --backend tflite")
+    parser.add_argument("--num_threads", default=None, type=int, help="TFLite interpreter threads")
     args = parser.parse_args()
 
     return args
@@ -68,8 +82,13 @@ def pred_fn(args, data_reader, figure_dir=None, prob_dir=None, log_dir=None):
         if not os.path.exists(prob_dir):
             os.makedirs(prob_dir)
     if args.save_prob:
-        h5 = h5py.File(os.path.join(args.result_dir, "result.h5"), "w", libver='latest')
-        prob_h5 = h5.create_group("/prob")
+        prob_archive = ProbArchive(
+            os.path.join(args.result_dir, "result.h5"),
+            mode="w",
+            dt=data_reader.dt,
+            dtype=args.prob_dtype,
+            compression=args.prob_compression,
+        )
     logging.info("Pred log: %s" % log_dir)
     logging.info("Dataset size: {}".format(data_reader.num_data))
 
@@ -81,11 +100,20 @@ def pred_fn(args, data_reader, figure_dir=None, prob_dir=None, log_dir=None):
         dataset = data_reader.dataset(batch_size)
         batch = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
 
-    config = ModelConfig(X_shape=data_reader.X_shape)
-    with open(os.path.join(log_dir, 'config.log'), 'w') as fp:
-        fp.write('\n'.join("%s: %s" % item for item in vars(config).items()))
+    if args.backend == "tflite":
+        from quantize import TFLitePredictor
 
-    model = UNet(config=config, input_batch=batch, mode="pred")
+        logging.info(f"TFLite model {args.tflite_model}")
+        predictor = TFLitePredictor(args.tflite_model, num_threads=args.num_threads)
+    else:
+        ## architecture of the checkpoint from its config.log; flags given on the command line take precedence
+        config = ModelConfig(X_shape=data_reader.X_shape).update_log(args.model_dir)
+        for key in ["depths", "filters_root", "separable"]:
+            if getattr(args, key) is not None:
+                setattr(config, key, getattr(args, key))
+        config.write_log(log_dir)
+
+        model = UNet(config=config, input_batch=batch, mode="pred")
     # model = UNet(config=config, mode="pred")
     sess_config = tf.compat.v1.ConfigProto()
     sess_config.gpu_options.allow_growth = True
@@ -93,22 +121,34 @@ def pred_fn(args, data_reader, figure_dir=None, prob_dir=None, log_dir=None):
 
     with tf.compat.v1.Session(config=sess_config) as sess:
 
-        saver = tf.compat.v1.train.Saver(tf.compat.v1.global_variables(), max_to_keep=5)
-        init = tf.compat.v1.global_variables_initializer()
-        sess.run(init)
+        if args.backend == "tf":
+            saver = tf.compat.v1.train.Saver(tf.compat.v1.global_variables(), max_to_keep=5)
+            init = tf.compat.v1.global_variables_initializer()
+            sess.run(init)
 
-        latest_check_point = tf.train.latest_checkpoint(args.model_dir)
-        logging.info(f"restoring model {latest_check_point}")
-        saver.restore(sess, latest_check_point)
+            latest_check_point = tf.train.latest_checkpoint(args.model_dir)
+            logging.info(f"restoring model {latest_check_point}")
+            saver.restore(sess, latest_check_point)
 
-        picks = []
-        amps = [] if args.amplitude else None
+        ## picks are written batch by batch; only a single JSON document needs all of them at the end
+        if args.json_format == "json":
+            picks = []
+            amps = [] if args.amplitude else None
+        else:
+            json_writer = PicksJsonlWriter(os.path.join(args.result_dir, args.result_fname+"."+args.json_format))
+        num_p, num_s = 0, 0
         if args.plot_figure:
             multiprocessing.set_start_method('spawn')
             pool = multiprocessing.Pool(multiprocessing.cpu_count())
 
-        for _ in tqdm(range(0, data_reader.num_data, batch_size), desc="Pred"):
-            if args.amplitude:
+        for num_batch, _ in enumerate(tqdm(range(0, data_reader.num_data, batch_size), desc="Pred")):
+            if args.backend == "tflite":
+                if args.amplitude:
+                    X_batch, amp_batch, fname_batch, t0_batch, station_batch = sess.run(batch)
+                else:
+                    X_batch, fname_batch, t0_batch, station_batch = sess.run(batch)
+                pred_batch = predictor.predict(X_batch)
+            elif args.amplitude:
                 pred_batch, X_batch, amp_batch, fname_batch, t0_batch, station_batch = sess.run(
                     [model.preds, batch[0], batch[1], batch[2], batch[3], batch[4]],
                     feed_dict={model.drop_rate: 0, model.is_training: False},
@@ -126,10 +166,16 @@ def pred_fn(args, data_reader, figure_dir=None, prob_dir=None, log_dir=None):
             # pred_batch = np.vstack(pred_batch)
 
             picks_ = extract_picks(preds=pred_batch, fnames=fname_batch, station_ids=station_batch, t0=t0_batch, config=args)
-            picks.extend(picks_)
-            if args.amplitude:
-                amps_ = extract_amplitude(amp_batch, picks_)
-                amps.extend(amps_)
+            amps_ = extract_amplitude(amp_batch, picks_) if args.amplitude else None
+            save_picks(picks_, args.result_dir, amps=amps_, fname=args.result_fname+".csv", mode="w" if num_batch == 0 else "a")
+            if args.json_format == "json":
+                picks.extend(picks_)
+                if args.amplitude:
+                    amps.extend(amps_)
+            else:
+                json_writer.write(picks_, dt=data_reader.dt, amps=amps_)
+            num_p += sum([len(x) for pick in picks_ for x in pick.p_idx])
+            num_s += sum([len(x) for pick in picks_ for x in pick.s_idx])
 
             if args.plot_figure:
                 pool.starmap(
@@ -142,14 +188,75 @@ def pred_fn(args, data_reader, figure_dir=None, prob_dir=None, log_dir=None):
 
             if args.save_prob:
                 # save_prob(pred_batch, fname_batch, prob_dir=prob_dir)
-                save_prob_h5(pred_batch, [x.decode() for x in fname_batch], prob_h5)
+                for k, (pred, t0, station_id) in enumerate(zip(pred_batch, t0_batch, station_batch)):
+                    ## records without a start time all begin at DEFAULT_T0 and would overwrite each other by station
+                    if t0.decode() == DEFAULT_T0:
+                        key = os.path.splitext(fname_batch[k].decode())[0]
+                    else:
+                        key = station_id.decode()
+                    prob_archive.write(key, t0.decode(), pred, amp=amp_batch[k] if args.amplitude else None)
 
-        save_picks(picks, args.result_dir, amps=amps, fname=args.result_fname+".csv")
-        save_picks_json(picks, args.result_dir, dt=data_reader.dt, amps=amps, fname=args.result_fname+".json")
+        if args.json_format == "json":
+            save_picks_json(picks, args.result_dir, dt=data_reader.dt, amps=amps, fname=args.result_fname+".json")
+        else:
+            json_writer.close()
+        if args.save_prob:
+            prob_archive.close()
 
-    print(
-        f"Done with {sum([len(x) for pick in picks for x in pick.p_idx])} P-picks and {sum([len(x) for pick in picks for x in pick.s_idx])} S-picks"
-    )
+    print(f"Done with {num_p} P-picks and {num_s} S-picks")
+    return 0
+
+
+def repick_station(station_id, args):
+    with ProbArchive(args.prob_file, mode="r") as prob_archive:
+        t0 = prob_archive.group[station_id].attrs["t0"]
+        picks = [extract_picks_stream(prob_archive.read_chunks(station_id), station_id, station_id, t0, config=args)]
+        if args.amplitude:
+            amps = [extract_amplitude_stream(prob_archive.read_chunks(station_id, starttime=t0, group="amp"), picks[0])]
+        else:
+            amps = None
+    return picks, amps
+
+
+def repick_fn(args):
+    with ProbArchive(args.prob_file, mode="r") as prob_archive:
+        station_ids = prob_archive.stations
+        dt = prob_archive.group[station_ids[0]].attrs["dt"] if len(station_ids) > 0 else 0.01
+        if args.amplitude and not all(prob_archive.has_amp(x) for x in station_ids):
+            logging.warning(f"No amplitude saved in {args.prob_file}, re-picking without amplitude")
+            args.amplitude = False
+    logging.info(f"Re-picking {len(station_ids)} stations from {args.prob_file}")
+    if not os.path.exists(args.result_dir):
+        os.makedirs(args.result_dir)
+
+    ## picks are written station by station; only a single JSON document needs all of them at the end
+    if args.json_format == "json":
+        picks = []
+        amps = [] if args.amplitude else None
+    else:
+        json_writer = PicksJsonlWriter(os.path.join(args.result_dir, args.result_fname+"."+args.json_format))
+    save_picks([], args.result_dir, amps=[] if args.amplitude else None, fname=args.result_fname+".csv")
+    num_p, num_s = 0, 0
+    with multiprocessing.Pool(max(args.num_workers, 1)) as pool:
+        for picks_, amps_ in tqdm(
+            pool.imap(partial(repick_station, args=args), station_ids), total=len(station_ids), desc="Re-pick"
+        ):
+            save_picks(picks_, args.result_dir, amps=amps_, fname=args.result_fname+".csv", mode="a")
+            if args.json_format == "json":
+                picks.extend(picks_)
+                if args.amplitude:
+                    amps.extend(amps_)
+            else:
+                json_writer.write(picks_, dt=dt, amps=amps_)
+            num_p += sum([len(x) for pick in picks_ for x in pick.p_idx])
+            num_s += sum([len(x) for pick in picks_ for x in pick.s_idx])
+
+    if args.json_format == "json":
+        save_picks_json(picks, args.result_dir, dt=dt, amps=amps, fname=args.result_fname+".json")
+    else:
+        json_writer.close()
+
+    print(f"Done with {num_p} P-picks and {num_s} S-picks")
     return 0
 
 
@@ -157,6 +264,10 @@ def main(args):
 
     logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
 
+    if args.prob_file:
+        repick_fn(args)
+        return
+
     with tf.compat.v1.name_scope('create_inputs'):
 
         if args.format == "mseed_array":
@@ -0,0 +1,89 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def sizeof(value):
+    """
+    Approximate bytes held by a cached value: arrays and numpy scalars by nbytes, strings by length and
+    Python numbers as 8 bytes, summed through tuples (also namedtuples), lists and dicts.
+    """
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.nbytes
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    if isinstance(value, (tuple, list)):
+        return sum(sizeof(x) for x in value)
+    return 8
+
+
+class PredictionCache:
+    """
+    LRU cache of per-window results, keyed by a hash of the raw window bytes, shape and dtype plus a namespace
+    naming the model and picking settings. Entries older than ttl seconds are evicted, and least recently used
+    entries are dropped to stay under max_bytes.
+    """
+
+    def __init__(self, max_bytes, ttl=300, namespace=""):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.namespace = namespace.encode("utf-8")
+        ## entries in LRU order, and their creation times in insertion order for the expiry sweep
+        self.entries = OrderedDict()
+        self.created = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def key(self, vec):
+        h = hashlib.blake2b(self.namespace, digest_size=16)
+        h.update(f"{vec.dtype.str}{vec.shape}".encode("utf-8"))
+        h.update(memoryview(vec).cast("B") if vec.flags.c_contiguous else vec.tobytes())
+        return h.digest()
+
+    def get(self, key):
+        with self.lock:
+            self.expire()
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, nbytes=None):
+        """
+        Store value; nbytes defaults to sizeof(value), counting every array of the entry.
+        """
+        if nbytes is None:
+            nbytes = sizeof(value)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, nbytes)
+            self.created[key] = time.monotonic()
+            self.nbytes += nbytes
+            self.expire()
+            while self.nbytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def expire(self):
+        ## entries are created in the order of self.created, so the expired ones are at its head
+        now = time.monotonic()
+        while self.created:
+            key, created = next(iter(self.created.items()))
+            if now - created <= self.ttl:
+                break
+            self.remove(key)
+
+    def remove(self, key):
+        self.nbytes -= self.entries.pop(key)[1]
+        del self.created[key]
+
+    def __len__(self):
+        return len(self.entries)
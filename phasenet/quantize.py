@@ -0,0 +1,255 @@
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tqdm import tqdm
+
+from data_reader import DataConfig, DataReader_pred, DataReader_test
+from model import ModelConfig, UNet
+from postprocess import PickEvaluator, convert_true_picks, extract_picks
+
+tf.compat.v1.disable_eager_execution()
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+### Export a checkpoint to a quantized TFLite model for CPU inference, calibrated on prediction inputs:
+### python phasenet/quantize.py --model_dir model/190703-214543 --quantize int8
+### Compare its picks with the float32 checkpoint on a catalog (used by predict.py --backend tflite):
+### python phasenet/quantize.py --model_dir model/190703-214543 --tflite_model model/190703-214543/model_int8.tflite --check
+
+
+def read_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir", help="Checkpoint directory")
+    parser.add_argument("--quantize", default="int8", choices=["int8", "dynamic", "float16", "float32"],
+                        help="int8: weights and activations, dynamic: int8 weights, float16: float16 weights")
+    parser.add_argument("--tflite_model", default="", help="Output TFLite file (default: model_dir/model_{quantize}.tflite)")
+    parser.add_argument("--nt", default=3000, type=int, help="Window length of the exported model")
+    parser.add_argument("--calib_format", default="numpy", help="Calibration data format: numpy, hdf5")
+    parser.add_argument("--calib_dir", default="./dataset/waveform_train/", help="Calibration file directory")
+    parser.add_argument("--calib_list", default="./dataset/waveform.csv", help="Calibration csv file")
+    parser.add_argument("--calib_hdf5_file", default="", help="Calibration hdf5 file")
+    parser.add_argument("--calib_hdf5_group", default="data", help="data group name in hdf5 file")
+    parser.add_argument("--num_calib", default=500, type=int, help="Number of calibration windows")
+    parser.add_argument("--seed", default=123, type=int, help="Seed of the calibration windows")
+    parser.add_argument("--check", action="store_true", help="Compare the TFLite model with the checkpoint instead of exporting")
+    parser.add_argument("--test_dir", default="./test_data/npz/", help="Catalog file directory for --check")
+    parser.add_argument("--test_list", default="./test_data/npz.csv", help="Catalog csv file for --check")
+    parser.add_argument("--batch_size", default=20, type=int, help="batch size of the float32 model in --check")
+    parser.add_argument("--tol", default=0.1, type=float, help="Pick matching tolerance in seconds")
+    parser.add_argument("--num_threads", default=None, type=int, help="TFLite interpreter threads")
+    parser.add_argument("--result_dir", default="results", help="Output directory of --check")
+    args = parser.parse_args()
+
+    return args
+
+
+class InferenceUNet(UNet):
+    """
+    UNet with dropout and batch normalization fixed to inference mode, so the graph has no tf.cond to convert
+    """
+
+    def add_placeholders(self, input_batch=None, mode="pred"):
+        super().add_placeholders(input_batch, mode)
+        self.is_training = tf.constant(False, name="inference")
+        self.drop_rate = tf.constant(0.0, name="no_drop")
+
+
+def build_inference_graph(model_dir, nt, batch_size=None):
+    """
+    Restore the checkpoint of model_dir in its own graph for windows of nt samples
+    """
+    config = ModelConfig(X_shape=[nt, 1, 3], Y_shape=[nt, 1, 3]).update_log(model_dir)
+    graph = tf.Graph()
+    with graph.as_default():
+        X = tf.compat.v1.placeholder(dtype=tf.float32, shape=[batch_size, nt, 1, config.n_channel], name="X")
+        model = InferenceUNet(config=config, input_batch=(X,), mode="pred")
+        sess = tf.compat.v1.Session(graph=graph)
+        saver = tf.compat.v1.train.Saver(tf.compat.v1.global_variables())
+        latest_check_point = tf.train.latest_checkpoint(model_dir)
+        logging.info(f"restoring model {latest_check_point}")
+        saver.restore(sess, latest_check_point)
+    return sess, model
+
+
+def calibration_windows(data_reader, nt, num_windows, seed=123):
+    """
+    Random nt-sample crops of prediction inputs, normalized as in predict.py, to fix the int8 activation ranges
+    """
+    rng = np.random.default_rng(seed)
+    for i in rng.integers(data_reader.num_data, size=num_windows):
+        sample = data_reader[i][0]
+        start = rng.integers(max(len(sample) - nt, 0) + 1)
+        window = np.zeros([1, nt] + list(sample.shape[1:]), dtype=np.float32)
+        window[0, : min(nt, len(sample) - start)] = sample[start : start + nt]
+        yield [window]
+
+
+def export_tflite(sess, model, quantize="int8", representative_dataset=None):
+    """
+    Convert the restored inference graph. All quantized variants keep float32 input and output and run on
+    the built-in TFLite CPU kernels; float16 weights are expanded to float32 when the model is loaded.
+    """
+    converter = tf.compat.v1.lite.TFLiteConverter.from_session(sess, [model.X], [model.preds])
+    if quantize in ["int8", "dynamic", "float16"]:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantize == "int8":
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantize == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    return converter.convert()
+
+
+class TFLitePredictor:
+    """
+    Run an exported model with the TFLite interpreter, one window at a time; predict takes and returns
+    float32 batches like model.preds
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.X_shape = [int(x) for x in self.input["shape"][1:]]
+        self.n_class = int(self.output["shape"][-1])
+
+    def predict(self, X, overlap=None):
+        """
+        X: (batch, nt, 1, nch) for any nt. Shorter inputs are zero-padded to the model window; longer ones are
+        cut into model windows overlapping by overlap samples (default: a third of the window), and each output
+        sample comes from the window where it is furthest from an edge.
+        """
+        nt = self.X_shape[0]
+        if list(X.shape[2:]) != self.X_shape[1:]:
+            raise ValueError(f"Input windows of shape {list(X.shape[1:])}, the TFLite model expects [nt] + {self.X_shape[1:]}")
+        overlap = nt // 3 if overlap is None else overlap
+        length = X.shape[1]
+        if length <= nt:
+            starts = [0]
+        else:
+            starts = list(range(0, length - nt, nt - overlap)) + [length - nt]
+        bounds = [0] + [(start + end + nt) // 2 for start, end in zip(starts[:-1], starts[1:])] + [length]
+
+        preds = np.zeros(X.shape[:-1] + (self.n_class,), dtype=np.float32)
+        window = np.zeros([1] + self.X_shape, dtype=np.float32)
+        for i, x in enumerate(X):
+            for start, lo, hi in zip(starts, bounds[:-1], bounds[1:]):
+                window[:] = 0
+                window[0, : min(nt, length - start)] = x[start : start + nt]
+                self.interpreter.set_tensor(self.input["index"], window)
+                self.interpreter.invoke()
+                preds[i, lo:hi] = self.interpreter.get_tensor(self.output["index"])[0, lo - start : hi - start]
+        return preds
+
+
+def residual_stats(evaluator):
+    stats = {}
+    for phase, counts in evaluator.counts.items():
+        mean = counts["sum"] / max(counts["tp"], 1)
+        std = np.sqrt(max(counts["sum2"] / max(counts["tp"], 1) - mean ** 2, 0))
+        stats[phase] = (mean, std)
+    return stats
+
+
+def check_fn(args, predictor):
+    """
+    Pick the catalog windows with the float32 checkpoint and with the TFLite model, and report precision,
+    recall, F1 and pick residuals of both and their differences
+    """
+    nt = predictor.X_shape[0]
+    data_reader = DataReader_test(
+        format="numpy",
+        data_dir=args.test_dir,
+        data_list=args.test_list,
+        config=DataConfig(X_shape=[nt, 1, 3], Y_shape=[nt, 1, 3]),
+    )
+    if nt != data_reader.select_range[1] - data_reader.select_range[0]:
+        raise ValueError(f"The catalog windows are {data_reader.select_range}, the TFLite model expects {nt} samples")
+    sess, model = build_inference_graph(args.model_dir, nt)
+    evaluators = {"float32": PickEvaluator(tol=args.tol, dt=data_reader.dt), "tflite": PickEvaluator(tol=args.tol, dt=data_reader.dt)}
+    elapsed = {"float32": 0.0, "tflite": 0.0}
+    max_diff = 0.0
+
+    for start in tqdm(range(0, data_reader.num_data, args.batch_size), desc="Check"):
+        batch = [data_reader[i] for i in range(start, min(start + args.batch_size, data_reader.num_data))]
+        X = np.stack([x[0] for x in batch])
+        fname = np.array([str(x[2]).encode() for x in batch])
+        true_picks = convert_true_picks(fname, [x[3] for x in batch], [x[4] for x in batch])
+
+        t0 = time.perf_counter()
+        preds = {"float32": sess.run(model.preds, feed_dict={model.X: X})}
+        elapsed["float32"] += time.perf_counter() - t0
+        t0 = time.perf_counter()
+        preds["tflite"] = predictor.predict(X)
+        elapsed["tflite"] += time.perf_counter() - t0
+
+        max_diff = max(max_diff, float(np.max(np.abs(preds["tflite"] - preds["float32"]))))
+        for name, evaluator in evaluators.items():
+            evaluator.update(extract_picks(preds[name], fname), true_picks)
+    sess.close()
+
+    if not os.path.exists(args.result_dir):
+        os.makedirs(args.result_dir)
+    rows = []
+    for name, evaluator in evaluators.items():
+        logging.info(f"{name}: {elapsed[name] / data_reader.num_data * 1e3:.2f} ms per window")
+        metrics = evaluator.summary()
+        residuals = residual_stats(evaluator)
+        evaluator.save_residuals(args.result_dir, fname=f"residuals_{name}.csv")
+        for phase in metrics:
+            rows.append([name, phase, *metrics[phase], *residuals[phase], elapsed[name] / data_reader.num_data])
+    df = pd.DataFrame(rows, columns=["model", "phase", "precision", "recall", "f1", "residual_mean", "residual_std", "time"])
+    df.to_csv(os.path.join(args.result_dir, "quantize_check.csv"), index=False, float_format="%.6f")
+
+    logging.info(f"Max probability difference: {max_diff:.4f}")
+    float32 = df[df["model"] == "float32"].set_index("phase")
+    tflite = df[df["model"] == "tflite"].set_index("phase")
+    for phase in float32.index:
+        logging.info(
+            f"{phase}: recall {tflite.loc[phase, 'recall'] - float32.loc[phase, 'recall']:+.4f}, "
+            f"precision {tflite.loc[phase, 'precision'] - float32.loc[phase, 'precision']:+.4f}, "
+            f"residual mean {tflite.loc[phase, 'residual_mean'] - float32.loc[phase, 'residual_mean']:+.4f} s, "
+            f"residual std {tflite.loc[phase, 'residual_std'] - float32.loc[phase, 'residual_std']:+.4f} s"
+        )
+    return df
+
+
+def main(args):
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+    tflite_model = args.tflite_model or os.path.join(args.model_dir, f"model_{args.quantize}.tflite")
+
+    if args.check:
+        check_fn(args, TFLitePredictor(tflite_model, num_threads=args.num_threads))
+        return
+
+    calib_reader = DataReader_pred(
+        format=args.calib_format,
+        data_dir=args.calib_dir,
+        data_list=args.calib_list,
+        hdf5_file=args.calib_hdf5_file,
+        hdf5_group=args.calib_hdf5_group,
+        amplitude=False,
+    )
+    sess, model = build_inference_graph(args.model_dir, args.nt, batch_size=1)
+    tflite = export_tflite(
+        sess,
+        model,
+        quantize=args.quantize,
+        representative_dataset=lambda: calibration_windows(calib_reader, args.nt, args.num_calib, args.seed),
+    )
+    sess.close()
+    with open(tflite_model, "wb") as fp:
+        fp.write(tflite)
+    logging.info(f"Saved {args.quantize} model ({len(tflite) / 1e6:.2f} MB) to {tflite_model}")
+
+
+if __name__ == "__main__":
+    args = read_args()
+    main(args)
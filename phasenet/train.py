@@ -6,13 +6,13 @@ import argparse, os, time, logging
 from tqdm import tqdm
 import pandas as pd
 import multiprocessing
-from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import pickle
 from model import UNet, ModelConfig
 from data_reader import DataReader_train, DataReader_test
-from postprocess import extract_picks, save_picks, save_picks_json, extract_amplitude, convert_true_picks, calc_performance
+from postprocess import extract_picks, save_picks, save_picks_json, extract_amplitude, convert_true_picks, calc_performance, PickEvaluator
 from visulization import plot_waveform
-from util import EMA, LMA
+from util import EMA, LMA, StepTimer, BoundedExecutor
 
 def read_args():
 
@@ -28,6 +28,11 @@ def read_args():
     parser.add_argument("--optimizer", default="adam", help="optimizer: adam, momentum")
     parser.add_argument("--summary", default=True, type=bool, help="summary")
     parser.add_argument("--class_weights", nargs="+", default=[1, 1, 1], type=float, help="class weights")
+    parser.add_argument("--depths", default=5, type=int, help="UNet depths")
+    parser.add_argument("--filters_root", default=8, type=int, help="Filters of the first UNet level, doubled at each depth")
+    parser.add_argument("--separable", action="store_true", help="Depthwise-separable convolutions in the UNet blocks")
+    parser.add_argument("--teacher_dir", default=None, help="Checkpoint directory of a teacher model for distillation")
+    parser.add_argument("--distill_alpha", default=0.5, type=float, help="Weight of the true labels against the teacher predictions")
     parser.add_argument("--model_dir", default=None, help="Checkpoint directory (default: None)")
     parser.add_argument("--load_model", action="store_true", help="Load checkpoint")
     parser.add_argument("--log_dir", default="log", help="Log directory (default: log)")
@@ -37,18 +42,133 @@ def read_args():
     parser.add_argument("--format", default="numpy", help="Input data format")
     parser.add_argument("--train_dir", default="./dataset/waveform_train/", help="Input file directory")
     parser.add_argument("--train_list", default="./dataset/waveform.csv", help="Input csv file")
+    parser.add_argument("--num_workers", default=0, type=int, help="Augmentation processes for training (0: tf.data threads)")
+    parser.add_argument("--seed", default=123, type=int, help="Seed of the training input with --num_workers and of the event pool")
+    parser.add_argument("--event_pool_size", default=0, type=int, help="Events kept in memory for stacking (0: read from disk)")
     parser.add_argument("--valid_dir", default=None, help="Input file directory")
     parser.add_argument("--valid_list", default=None, help="Input csv file")
     parser.add_argument("--test_dir", default=None, help="Input file directory")
     parser.add_argument("--test_list", default=None, help="Input csv file")
     parser.add_argument("--result_dir", default="results", help="result directory")
     parser.add_argument("--plot_figure", action="store_true", help="If plot figure for test")
+    parser.add_argument("--intra_op_threads", default=0, type=int, help="Threads within an op (0: TensorFlow default)")
+    parser.add_argument("--inter_op_threads", default=0, type=int, help="Ops run in parallel (0: TensorFlow default)")
     parser.add_argument("--save_prob", action="store_true", help="If save result for test")
+    parser.add_argument("--plot_workers", default=2, type=int, help="Background processes for plotting figures")
+    parser.add_argument("--valid_every", default=0, type=int, help="Validate every K steps (0: after each epoch)")
+    parser.add_argument("--valid_samples", default=0, type=int, help="Validate on a fixed random subsample of this size (0: all)")
     args = parser.parse_args()
 
     return args
 
 
+def session_config(args):
+    sess_config = tf.compat.v1.ConfigProto(intra_op_parallelism_threads=args.intra_op_threads,
+                                           inter_op_parallelism_threads=args.inter_op_threads)
+    sess_config.gpu_options.allow_growth = True
+    # sess_config.log_device_placement = False
+    return sess_config
+
+
+## steps between the traced steps that split the input wait from compute
+TRACE_EVERY = 20
+
+
+def traced_run(sess, fetches, feed_dict, input_op):
+    """
+    sess.run with a software trace. Returns the results, the seconds spent in input_op (the iterator's
+    get_next, i.e. waiting on the input pipeline) and the seconds of the rest of the step.
+    """
+    run_metadata = tf.compat.v1.RunMetadata()
+    start = time.perf_counter()
+    results = sess.run(fetches, feed_dict=feed_dict, run_metadata=run_metadata,
+                       options=tf.compat.v1.RunOptions(trace_level=tf.compat.v1.RunOptions.SOFTWARE_TRACE))
+    total = time.perf_counter() - start
+    input_time = sum(node.all_end_rel_micros for device in run_metadata.step_stats.dev_stats
+                     for node in device.node_stats if node.node_name == input_op.name) / 1e6
+    input_time = min(input_time, total)
+    return results, input_time, total - input_time
+
+
+def write_timing(summary_writer, step_timer, step):
+    summary = tf.compat.v1.Summary(value=[
+        tf.compat.v1.Summary.Value(tag="time/input_wait", simple_value=step_timer.input_time / max(step_timer.count, 1)),
+        tf.compat.v1.Summary.Value(tag="time/compute", simple_value=step_timer.compute_time / max(step_timer.count, 1)),
+        tf.compat.v1.Summary.Value(tag="time/input_fraction", simple_value=step_timer.input_fraction),
+    ])
+    summary_writer.add_summary(summary, step)
+
+
+class AsyncSaver:
+    """
+    Saver that copies the variables into local shadow variables in the graph and writes the checkpoint
+    from the copies on a background thread, so training goes on while the files are written.
+    Checkpoints keep the variable names and load with a plain Saver.
+    """
+    def __init__(self, var_list, max_to_keep=5):
+        shadows = {}
+        with tf.compat.v1.name_scope("checkpoint_snapshot"):
+            for var in var_list:
+                shadows[var.op.name] = tf.compat.v1.Variable(tf.zeros(var.shape, dtype=var.dtype.base_dtype), trainable=False,
+                                                             collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES])
+        self.snapshot = tf.group(*[shadows[var.op.name].assign(var) for var in var_list])
+        self.saver = tf.compat.v1.train.Saver(shadows, max_to_keep=max_to_keep)
+        self.executor = ThreadPoolExecutor(1)
+        self.future = None
+
+    def save(self, sess, save_path):
+        self.wait()
+        sess.run(self.snapshot)
+        self.future = self.executor.submit(self.saver.save, sess, save_path)
+
+    def wait(self):
+        if self.future is not None:
+            self.future.result()
+            self.future = None
+
+
+def load_teacher(teacher_dir, X_shape, sess_config):
+    """
+    Restore a trained UNet in its own graph and session. The architecture is read from the config.log
+    next to the checkpoint if there is one.
+    """
+    config = ModelConfig(X_shape=X_shape).update_log(teacher_dir)
+    graph = tf.Graph()
+    with graph.as_default():
+        model = UNet(config, mode="pred")
+        sess = tf.compat.v1.Session(graph=graph, config=sess_config)
+        saver = tf.compat.v1.train.Saver(tf.compat.v1.global_variables())
+        saver.restore(sess, tf.train.latest_checkpoint(teacher_dir))
+    logging.info("Distilling from teacher: {}".format(teacher_dir))
+    return sess, model
+
+
+def valid_subset(data_reader, num_samples, batch_size, seed=123):
+    """
+    Batches of a fixed, seeded subsample of the validation set, augmented once and kept in memory
+    """
+    index = np.sort(np.random.default_rng(seed).choice(data_reader.num_data, min(num_samples, data_reader.num_data), replace=False))
+    samples = [data_reader.sample(i, np.random.default_rng([seed, i])) for i in index]
+    X = np.stack([x[0] for x in samples])
+    Y = np.stack([x[1] for x in samples])
+    fname = np.array([str(x[2]).encode() for x in samples])
+    return [(X[i:i+batch_size], Y[i:i+batch_size], fname[i:i+batch_size]) for i in range(0, len(X), batch_size)]
+
+
+def validate(sess, model, batches):
+    valid_loss = LMA()
+    for X_batch, Y_batch, fname_batch in batches:
+        loss_batch, preds_batch = sess.run([model.loss, model.preds],
+                                           feed_dict={model.X: X_batch, model.Y: Y_batch, model.drop_rate: 0, model.is_training: False})
+        valid_loss(loss_batch)
+    return valid_loss.value, (X_batch, preds_batch, fname_batch, Y_batch)
+
+
+def submit_plots(plot_pool, plot_batch, figure_dir, dt):
+    for X, pred, fname, Y in zip(*plot_batch):
+        plot_pool.submit(plot_waveform, X, pred, fname.decode(), label=Y, figure_dir=figure_dir, dt=dt)
+
+
 def train_fn(args, data_reader, data_reader_valid=None):
     
     current_time = time.strftime("%y%m%d-%H%M%S")
@@ -67,20 +187,21 @@ def train_fn(args, data_reader, data_reader_valid=None):
     if args.decay_step == -1:
         args.decay_step = data_reader.num_data // args.batch_size
     config.update_args(args)
-    with open(os.path.join(log_dir, 'config.log'), 'w') as fp:
-        fp.write('\n'.join("%s: %s" % item for item in vars(config).items()))
+    ## also next to the checkpoints, where update_log looks when they are restored
+    config.write_log(log_dir)
+    config.write_log(model_dir)
 
     with tf.compat.v1.name_scope('Input_Batch'):
-        dataset = data_reader.dataset(args.batch_size, shuffle=True).repeat()
+        dataset = data_reader.dataset(args.batch_size, shuffle=True, num_workers=args.num_workers, seed=args.seed).repeat()
         batch = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
         if data_reader_valid is not None:
             dataset_valid = data_reader_valid.dataset(args.batch_size, shuffle=False).repeat()
             valid_batch = tf.compat.v1.data.make_one_shot_iterator(dataset_valid).get_next()
 
     model = UNet(config, input_batch=batch)
-    sess_config = tf.compat.v1.ConfigProto()
-    sess_config.gpu_options.allow_growth = True
-    # sess_config.log_device_placement = False
+    sess_config = session_config(args)
+    
+    async_saver = AsyncSaver(tf.compat.v1.global_variables(), max_to_keep=5)
     
     with tf.compat.v1.Session(config=sess_config) as sess:
 
@@ -88,6 +209,7 @@ def train_fn(args, data_reader, data_reader_valid=None):
         saver = tf.compat.v1.train.Saver(tf.compat.v1.global_variables(), max_to_keep=5)
         init = tf.compat.v1.global_variables_initializer()
         sess.run(init)
+        sess.run(tf.compat.v1.local_variables_initializer())
 
         if args.model_dir is not None:
             logging.info("restoring models...")
@@ -95,49 +217,88 @@ def train_fn(args, data_reader, data_reader_valid=None):
             saver.restore(sess, latest_check_point)
 
         if args.plot_figure:
-            multiprocessing.set_start_method('spawn')
-            pool = multiprocessing.Pool(multiprocessing.cpu_count())
+            plot_pool = BoundedExecutor(ProcessPoolExecutor(args.plot_workers, mp_context=multiprocessing.get_context('spawn')),
+                                        max_pending=4 * args.plot_workers)
+
+        if args.teacher_dir is not None:
+            teacher_sess, teacher = load_teacher(args.teacher_dir, data_reader.X_shape, sess_config)
+
+        if data_reader_valid is not None:
+            if args.valid_samples > 0:
+                valid_batches = valid_subset(data_reader_valid, args.valid_samples, args.batch_size, seed=args.seed)
+                num_valid_batches = len(valid_batches)
+            else:
+                num_valid_batches = (data_reader_valid.num_data - 1) // args.batch_size + 1
+                valid_batches = None
+
+        def run_validation(epoch, step):
+            nonlocal best_valid_loss
+            if valid_batches is not None:
+                batches = valid_batches
+            else:
+                batches = (sess.run(valid_batch) for _ in range(num_valid_batches))
+            valid_loss, plot_batch = validate(sess, model, tqdm(batches, total=num_valid_batches, desc="Valid:", leave=False))
+            if valid_loss < best_valid_loss:
+                best_valid_loss = valid_loss
+                name = "model_{}.ckpt".format(epoch) if args.valid_every <= 0 else "model_{}_{}.ckpt".format(epoch, step)
+                async_saver.save(sess, os.path.join(model_dir, name))
+            flog.write("Valid: epoch: {}, step: {}, mean loss: {}\n".format(epoch, step, valid_loss))
+            summary_writer.add_summary(tf.compat.v1.Summary(value=[tf.compat.v1.Summary.Value(tag="valid_loss", simple_value=valid_loss)]), step)
+            return plot_batch
 
         flog = open(os.path.join(log_dir, 'loss.log'), 'w')
         train_loss = EMA(0.9)
+        step_timer = StepTimer()
         best_valid_loss = np.inf
+        plot_batch = None
         for epoch in range(args.epochs):
+            step_timer.reset()
             progressbar = tqdm(range(0, data_reader.num_data, args.batch_size), desc="{}: epoch {}".format(log_dir.split("/")[-1], epoch))
-            for _ in progressbar:
-                loss_batch, _, _ = sess.run([model.loss, model.train_op, model.global_step], 
-                                            feed_dict={model.drop_rate: args.drop_rate, model.is_training: True})
+            for i, _ in enumerate(progressbar):
+                fetches = [model.loss, model.train_op, model.global_step]
+                feed_dict = {model.drop_rate: args.drop_rate, model.is_training: True}
+                if args.teacher_dir is not None:
+                    ## the teacher runs in its own graph, so this batch goes through the host and is fed back
+                    start = time.perf_counter()
+                    X_batch, Y_batch = sess.run([batch[0], batch[1]])
+                    input_time = time.perf_counter() - start
+                    ## soft targets: true labels mixed with the teacher's probabilities
+                    teacher_preds = teacher_sess.run(teacher.preds, feed_dict={teacher.X: X_batch, teacher.drop_rate: 0, teacher.is_training: False})
+                    feed_dict.update({model.X: X_batch, model.Y: args.distill_alpha * Y_batch + (1 - args.distill_alpha) * teacher_preds})
+                    loss_batch, _, step = sess.run(fetches, feed_dict=feed_dict)
+                    step_timer(input_time, time.perf_counter() - start - input_time)
+                elif i % TRACE_EVERY == 0:
+                    (loss_batch, _, step), input_time, compute_time = traced_run(sess, fetches, feed_dict, batch[0].op)
+                    step_timer(input_time, compute_time)
+                else:
+                    loss_batch, _, step = sess.run(fetches, feed_dict=feed_dict)
                 train_loss(loss_batch)
-                progressbar.set_description("{}: epoch {}, loss={:.6f}, mean={:.6f}".format(log_dir.split("/")[-1], epoch, loss_batch, train_loss.value))
+                progressbar.set_description("{}: epoch {}, loss={:.6f}, mean={:.6f}, input={:.0%}".format(log_dir.split("/")[-1], epoch, loss_batch, train_loss.value, step_timer.input_fraction))
+                if (data_reader_valid is not None) and (args.valid_every > 0) and (step > 0) and (step % args.valid_every == 0):
+                    plot_batch = run_validation(epoch, step)
             flog.write("epoch: {}, mean loss: {}\n".format(epoch, train_loss.value))
+            flog.write("epoch: {}, {}\n".format(epoch, step_timer.summary()))
+            write_timing(summary_writer, step_timer, step)
             
             if data_reader_valid is not None:
-                valid_loss = LMA()
-                progressbar = tqdm(range(0, data_reader_valid.num_data, args.batch_size), desc="Valid:")
-                for _ in progressbar:
-                    loss_batch, preds_batch, X_batch, Y_batch, fname_batch = sess.run([model.loss, model.preds, valid_batch[0], valid_batch[1], valid_batch[2]], 
-                                                                                       feed_dict={model.drop_rate: 0, model.is_training: False})
-                    valid_loss(loss_batch)
-                    progressbar.set_description("valid, loss={:.6f}, mean={:.6f}".format(loss_batch, valid_loss.value))
-                if valid_loss.value < best_valid_loss:
-                    best_valid_loss = valid_loss.value
-                    saver.save(sess, os.path.join(model_dir, "model_{}.ckpt".format(epoch)))
-                flog.write("Valid: mean loss: {}\n".format(valid_loss.value))
+                if args.valid_every <= 0:
+                    plot_batch = run_validation(epoch, step)
             else:
-                loss_batch, preds_batch, X_batch, Y_batch, fname_batch = sess.run([model.loss, model.preds, batch[0], batch[1], batch[2]], 
-                                                                                   feed_dict={model.drop_rate: 0, model.is_training: False})
-                saver.save(sess, os.path.join(model_dir, "model_{}.ckpt".format(epoch)))
+                X_batch, Y_batch, fname_batch, preds_batch = sess.run([batch[0], batch[1], batch[2], model.preds],
+                                                                      feed_dict={model.drop_rate: 0, model.is_training: False})
+                plot_batch = (X_batch, preds_batch, fname_batch, Y_batch)
+                async_saver.save(sess, os.path.join(model_dir, "model_{}.ckpt".format(epoch)))
             
-            if args.plot_figure:
-                pool.starmap(
-                    partial(
-                        plot_waveform,
-                        figure_dir=figure_dir,
-                    ),
-                    zip(X_batch, preds_batch, [x.decode() for x in fname_batch], Y_batch),
-                )
-            # plot_waveform(X_batch, preds_batch, fname_batch, label=Y_batch, figure_dir=figure_dir)
+            if args.plot_figure and (plot_batch is not None):
+                submit_plots(plot_pool, plot_batch, figure_dir, data_reader.config.dt)
+                plot_batch = None
             flog.flush()
 
+        async_saver.wait()
+        if args.plot_figure:
+            plot_pool.shutdown()
+        if args.teacher_dir is not None:
+            teacher_sess.close()
         flog.close()
 
     return 0
@@ -156,17 +317,14 @@ def test_fn(args, data_reader):
 
     config = ModelConfig(X_shape=data_reader.X_shape, Y_shape=data_reader.Y_shape)
     config.update_args(args)
-    with open(os.path.join(args.result_dir, 'config.log'), 'w') as fp:
-        fp.write('\n'.join("%s: %s" % item for item in vars(config).items()))
+    config.write_log(args.result_dir)
 
     with tf.compat.v1.name_scope('Input_Batch'):
         dataset = data_reader.dataset(args.batch_size, shuffle=False)
         batch = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
 
     model = UNet(config, input_batch=batch, mode='test')
-    sess_config = tf.compat.v1.ConfigProto()
-    sess_config.gpu_options.allow_growth = True
-    # sess_config.log_device_placement = False
+    sess_config = session_config(args)
 
     with tf.compat.v1.Session(config=sess_config) as sess:
 
@@ -181,29 +339,43 @@ def test_fn(args, data_reader):
             return -1
         saver.restore(sess, latest_check_point)
         
+        if args.plot_figure:
+            plot_pool = BoundedExecutor(ProcessPoolExecutor(args.plot_workers, mp_context=multiprocessing.get_context('spawn')),
+                                        max_pending=4 * args.plot_workers)
+
         flog = open(os.path.join(args.result_dir, 'loss.log'), 'w')
         test_loss = LMA()
+        step_timer = StepTimer()
+        evaluator = PickEvaluator(tol=3.0, dt=data_reader.config.dt)
         progressbar = tqdm(range(0, data_reader.num_data, args.batch_size), desc=args.mode)
-        picks = []
-        true_picks = []
-        for _ in progressbar:
-            loss_batch, preds_batch, X_batch, Y_batch, fname_batch, itp_batch, its_batch \
-                = sess.run([model.loss, model.preds, batch[0], batch[1], batch[2], batch[3], batch[4]], 
-                           feed_dict={model.drop_rate: 0, model.is_training: False})
+        for i, _ in enumerate(progressbar):
+            fetches = [model.loss, model.preds, batch[0], batch[1], batch[2], batch[3], batch[4]]
+            feed_dict = {model.drop_rate: 0, model.is_training: False}
+            if i % TRACE_EVERY == 0:
+                results, input_time, compute_time = traced_run(sess, fetches, feed_dict, batch[0].op)
+                step_timer(input_time, compute_time)
+            else:
+                results = sess.run(fetches, feed_dict=feed_dict)
+            loss_batch, preds_batch, X_batch, Y_batch, fname_batch, itp_batch, its_batch = results
 
             test_loss(loss_batch)
             progressbar.set_description("{}, loss={:.6f}, mean loss={:6f}".format(args.mode, loss_batch, test_loss.value))
 
             picks_ = extract_picks(preds_batch, fname_batch)
-            picks.extend(picks_)
-            true_picks.extend(convert_true_picks(fname_batch, itp_batch, its_batch))
+            evaluator.update(picks_, convert_true_picks(fname_batch, itp_batch, its_batch))
+            save_picks(picks_, args.result_dir, mode="w" if i == 0 else "a")
             if args.plot_figure:
-                plot_waveform(data_reader.config, X_batch, preds_batch, label=Y_batch, fname=fname_batch, 
-                              itp=itp_batch, its=its_batch, figure_dir=figure_dir)
+                for k in range(len(fname_batch)):
+                    plot_pool.submit(plot_waveform, X_batch[k], preds_batch[k], fname_batch[k].decode(), label=Y_batch[k],
+                                     itp=itp_batch[k][0], its=its_batch[k][0], itp_pred=picks_[k].p_idx[0], its_pred=picks_[k].s_idx[0],
+                                     figure_dir=figure_dir, dt=data_reader.config.dt)
 
-        save_picks(picks, args.result_dir)
-        metrics = calc_performance(picks, true_picks, tol=3.0, dt=data_reader.config.dt)
-        flog.write("mean loss: {}\n".format(test_loss))
+        metrics = evaluator.summary()
+        evaluator.save_residuals(args.result_dir)
+        if args.plot_figure:
+            plot_pool.shutdown()
+        flog.write("mean loss: {}\n".format(test_loss.value))
+        flog.write("{}\n".format(step_timer.summary()))
         flog.close()
 
     return 0
@@ -217,7 +389,9 @@ def main(args):
         with tf.compat.v1.name_scope('create_inputs'):
             data_reader = DataReader_train(format=args.format,
                                            data_dir=args.train_dir,
-                                           data_list=args.train_list)
+                                           data_list=args.train_list,
+                                           event_pool_size=args.event_pool_size,
+                                           seed=args.seed)
             if args.mode == "train_valid":
                 data_reader_valid = DataReader_train(format=args.format,
                                                      data_dir=args.valid_dir,
@@ -0,0 +1,156 @@
+import itertools
+import multiprocessing as mp
+import queue
+import weakref
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    ## Python < 3.8: TrainLoader is unavailable and DataReader_train.dataset falls back to tf.data
+    shared_memory = None
+
+import numpy as np
+
+
+def loader_main(data_reader, seed, names, x_shape, y_shape, dtype, task_queue, result_queue):
+    """
+    Augmentation process: fill the shared memory slot named by each task with one batch. Every sample draws
+    from its own np.random.Generator seeded by (seed, epoch, index), so a batch does not depend on which worker
+    builds it.
+    """
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        seq, slot, epoch, index = task
+        try:
+            X = np.ndarray(x_shape, dtype=dtype, buffer=blocks[slot].buf)
+            Y = np.ndarray(y_shape, dtype=dtype, buffer=blocks[slot].buf, offset=X.nbytes)
+            fname = []
+            for k, i in enumerate(index):
+                rng = np.random.default_rng([seed, epoch, i])
+                X[k], Y[k], base_name = data_reader.sample(i, rng)
+                fname.append(str(base_name).encode("utf-8"))
+            del X, Y
+            result_queue.put((seq, slot, fname, None))
+        except Exception as error:
+            result_queue.put((seq, slot, [], repr(error)))
+    for shm in blocks:
+        shm.close()
+
+
+class TrainLoader:
+    """
+    Training batches from DataReader_train.sample built by num_workers processes. Up to prefetch batches are
+    built ahead into shared memory and returned in a fixed order; the sample order of an epoch is a permutation
+    seeded by (seed, epoch), so training input is reproducible for a given seed whatever num_workers is.
+    The workers are spawned, so data_reader is pickled to them.
+    """
+
+    def __init__(
+        self, data_reader, batch_size, num_workers=4, seed=123, shuffle=True, drop_remainder=True, prefetch=None
+    ):
+        if shared_memory is None:
+            raise RuntimeError("TrainLoader needs multiprocessing.shared_memory (Python >= 3.8)")
+        ## spawn: forking after tensorflow and h5py have started threads and opened files is unsafe, so
+        ## workers start fresh and get the reader pickled, reopening its files (DataReader.__setstate__)
+        context = mp.get_context("spawn")
+        self.data_reader = data_reader
+        self.batch_size = batch_size
+        self.seed = seed
+        self.shuffle = shuffle
+        self.drop_remainder = drop_remainder
+        self.dtype = data_reader.dtype
+        self.x_shape = (batch_size,) + tuple(data_reader.X_shape)
+        self.y_shape = (batch_size,) + tuple(data_reader.Y_shape)
+        self.x_nbytes = int(np.prod(self.x_shape)) * np.dtype(self.dtype).itemsize
+        y_nbytes = int(np.prod(self.y_shape)) * np.dtype(self.dtype).itemsize
+        prefetch = 2 * num_workers if prefetch is None else prefetch
+        self.blocks = [shared_memory.SharedMemory(create=True, size=self.x_nbytes + y_nbytes) for _ in range(prefetch)]
+        self.task_queue = context.Queue()
+        self.result_queue = context.Queue()
+        self.processes = [
+            context.Process(
+                target=loader_main,
+                args=(
+                    data_reader,
+                    seed,
+                    [shm.name for shm in self.blocks],
+                    self.x_shape,
+                    self.y_shape,
+                    self.dtype,
+                    self.task_queue,
+                    self.result_queue,
+                ),
+                daemon=True,
+            )
+            for _ in range(num_workers)
+        ]
+        for process in self.processes:
+            process.start()
+        self.finalizer = weakref.finalize(self, TrainLoader.release, self.processes, self.task_queue, self.blocks)
+
+    def batches(self):
+        num_data = self.data_reader.num_data
+        if self.drop_remainder:
+            num_batches = num_data // self.batch_size
+        else:
+            num_batches = (num_data + self.batch_size - 1) // self.batch_size
+        for epoch in itertools.count():
+            if self.shuffle:
+                index = np.random.default_rng([self.seed, epoch]).permutation(num_data)
+            else:
+                index = np.arange(num_data)
+            for b in range(num_batches):
+                yield epoch, index[b * self.batch_size : (b + 1) * self.batch_size]
+
+    def get_result(self):
+        while True:
+            try:
+                return self.result_queue.get(timeout=1)
+            except queue.Empty:
+                if any(not process.is_alive() for process in self.processes):
+                    raise RuntimeError("A training loader worker exited")
+
+    def __iter__(self):
+        batches = self.batches()
+        free = list(range(len(self.blocks)))
+        done = {}
+        submitted = 0
+        received = 0
+        while True:
+            while free:
+                epoch, index = next(batches)
+                self.task_queue.put((submitted, free.pop(), epoch, index))
+                submitted += 1
+            while received not in done:
+                seq, slot, fname, error = self.get_result()
+                if error is not None:
+                    raise RuntimeError(f"Training loader worker: {error}")
+                done[seq] = (slot, fname)
+            slot, fname = done.pop(received)
+            received += 1
+            n = len(fname)
+            X = np.ndarray(self.x_shape, dtype=self.dtype, buffer=self.blocks[slot].buf)[:n].copy()
+            Y = np.ndarray(self.y_shape, dtype=self.dtype, buffer=self.blocks[slot].buf, offset=self.x_nbytes)[:n].copy()
+            free.append(slot)
+            yield X, Y, np.array(fname)
+
+    @staticmethod
+    def release(processes, task_queue, blocks):
+        for _ in processes:
+            task_queue.put(None)
+        for process in processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        for shm in blocks:
+            try:
+                shm.close()
+                shm.unlink()
+            except (BufferError, FileNotFoundError):
+                pass
+
+    def close(self):
+        self.finalizer()
@@ -4,8 +4,10 @@ matplotlib.use('agg')
 import matplotlib.pyplot as plt
 import numpy as np
 import os
+import threading
 from data_reader import DataConfig
 from detect_peaks import detect_peaks
+from postprocess import flatten_picks, match_picks
 import logging
 
 class EMA(object):
@@ -43,6 +45,56 @@ class LMA(object):
         self.count += 1
         return self.x
 
+class StepTimer(object):
+    """
+    Per-step time spent waiting on the input pipeline versus running the model, over the steps it is
+    called for (train.py times every TRACE_EVERY-th step).
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.input_time = 0.
+        self.compute_time = 0.
+        self.count = 0
+
+    def __call__(self, input_time, compute_time):
+        self.input_time += input_time
+        self.compute_time += compute_time
+        self.count += 1
+
+    @property
+    def input_fraction(self):
+        total = self.input_time + self.compute_time
+        return self.input_time / total if total > 0 else 0.
+
+    def summary(self):
+        n = max(self.count, 1)
+        return "steps: {}, input wait: {:.4f}s/step, compute: {:.4f}s/step, input fraction: {:.2f}".format(
+            self.count, self.input_time/n, self.compute_time/n, self.input_fraction)
+
+class BoundedExecutor(object):
+    """
+    Wrap a concurrent.futures executor so that at most max_pending tasks are queued or running;
+    submit blocks beyond that, keeping memory bounded when tasks are slower than the producer.
+    """
+    def __init__(self, executor, max_pending):
+        self.executor = executor
+        self.semaphore = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn, *args, **kwargs):
+        self.semaphore.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.semaphore.release()
+            raise
+        future.add_done_callback(lambda _: self.semaphore.release())
+        return future
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
 def detect_peaks_thread(i, pred, fname=None, result_dir=None, args=None):
   if args is None:
     itp, prob_p = detect_peaks(pred[i,:,0,1], mph=0.5, mpd=0.5/DataConfig().dt, show=False)
@@ -146,13 +198,13 @@ def plot_result_thread(i, pred, X, Y=None, itp=None, its=None,
 
   try:
     plt.savefig(os.path.join(figure_dir, 
-                fname[i].decode().rstrip('.npz')+'.png'), 
+                os.path.splitext(fname[i].decode())[0]+'.png'), 
                 bbox_inches='tight')
   except FileNotFoundError:
   #if not os.path.exists(os.path.dirname(os.path.join(figure_dir, fname[i].decode()))):
     os.makedirs(os.path.dirname(os.path.join(figure_dir, fname[i].decode())), exist_ok=True)
     plt.savefig(os.path.join(figure_dir, 
-                fname[i].decode().rstrip('.npz')+'.png'), 
+                os.path.splitext(fname[i].decode())[0]+'.png'), 
                 bbox_inches='tight')
   #plt.savefig(os.path.join(figure_dir, 
   #            fname[i].decode().split('/')[-1].rstrip('.npz')+'.png'), 
@@ -203,23 +255,17 @@ def correct_picks(picks, true_p, true_s, tol):
   dt = DataConfig().dt
   if len(true_p) != len(true_s):
     print("The length of true P and S pickers are not the same")
-  num = len(true_p)
-  TP_p = 0; TP_s = 0; nP_p = 0; nP_s = 0; nT_p = 0; nT_s = 0
-  diff_p = []; diff_s = []
-  for i in range(num):
-    nT_p += len(true_p[i])
-    nT_s += len(true_s[i])
-    nP_p += len(picks[i][0][0])
-    nP_s += len(picks[i][1][0])
-
-    if len(true_p[i]) > 1 or len(true_s[i]) > 1:
-      print(i, picks[i], true_p[i], true_s[i])
-    tmp_p = np.array(picks[i][0][0]) - np.array(true_p[i])[:,np.newaxis]
-    tmp_s = np.array(picks[i][1][0]) - np.array(true_s[i])[:,np.newaxis]
-    TP_p += np.sum(np.abs(tmp_p) < tol/dt)
-    TP_s += np.sum(np.abs(tmp_s) < tol/dt)
-    diff_p.append(tmp_p[np.abs(tmp_p) < 0.5/dt])
-    diff_s.append(tmp_s[np.abs(tmp_s) < 0.5/dt])
+  trace_p, idx_p = flatten_picks([picks[i][0][0] for i in range(len(true_p))])
+  trace_s, idx_s = flatten_picks([picks[i][1][0] for i in range(len(true_s))])
+  true_trace_p, true_idx_p = flatten_picks(true_p)
+  true_trace_s, true_idx_s = flatten_picks(true_s)
+
+  TP_p, FP_p, FN_p, _ = match_picks(idx_p, true_idx_p, tol/dt, trace_p, true_trace_p, inclusive=False)
+  TP_s, FP_s, FN_s, _ = match_picks(idx_s, true_idx_s, tol/dt, trace_s, true_trace_s, inclusive=False)
+  nP_p, nT_p = TP_p + FP_p, TP_p + FN_p
+  nP_s, nT_s = TP_s + FP_s, TP_s + FN_s
+  diff_p = match_picks(idx_p, true_idx_p, 0.5/dt, trace_p, true_trace_p, inclusive=False)[-1]
+  diff_s = match_picks(idx_s, true_idx_s, 0.5/dt, trace_s, true_trace_s, inclusive=False)[-1]
 
   return [TP_p, TP_s, nP_p, nP_s, nT_p, nT_s, diff_p, diff_s]
 
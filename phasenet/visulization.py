@@ -174,13 +174,13 @@ def plot_waveform(data, pred, fname, label=None,
         for j in range(len(itp)):
             lb = "P" if j==0 else ""
             plt.plot([itp[j]*dt, itp[j]*dt], [tmp_min, tmp_max], 'C0', label=lb, linewidth=0.5)
-        for j in range(len(its[i])):
+        for j in range(len(its)):
             lb = "S" if j==0 else ""
             plt.plot([its[j]*dt, its[j]*dt], [tmp_min, tmp_max], 'C1', label=lb, linewidth=0.5)
     if (itps is not None):
         for j in range(len(itps)):
             lb = "PS" if j==0 else ""
-            plt.plot([itps[j]*dt, its[j]*dt], [tmp_min, tmp_max], 'C2', label=lb, linewidth=0.5)
+            plt.plot([itps[j]*dt, itps[j]*dt], [tmp_min, tmp_max], 'C2', label=lb, linewidth=0.5)
     plt.ylabel('Amplitude')
     plt.legend(loc='upper right', fontsize='small')
     plt.gca().set_xticklabels([])
@@ -281,7 +281,7 @@ def plot_array(config, data, pred, label=None,
     if fname is None:
         fname = [f"{epoch:03d}_{i:03d}" for i in range(len(data))]
     else:
-        fname = [fname[i].decode().rstrip(".npz") for i in range(len(fname))]
+        fname = [os.path.splitext(fname[i].decode())[0] for i in range(len(fname))]
         
     for i in range(len(data)):
         plt.figure(i, figsize=(10, 5))
@@ -0,0 +1,59 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_index import build_index, is_index
+
+
+def write_csv(path, df, sep=","):
+    # an empty field can not be told apart from the separator in whitespace-separated lists
+    df.to_csv(path, index=False, sep=sep, na_rep="NaN" if sep == " " else "")
+    return str(path)
+
+
+@pytest.mark.parametrize("sep", [",", "\t", " "])
+@pytest.mark.parametrize("chunksize", [1, 3, 1000])
+def test_build_index(tmp_path, sep, chunksize):
+    df = pd.DataFrame(
+        {
+            "fname": ["a.npz", "évènement_2.npz", "c" * 200 + ".npz", "d.npz", "e.npz"],
+            "itp": [100, 200, None, 400, 500],
+            "its": [150.5, 250, 350, 450, 550],
+            "channels": ["E,N,Z"] * 5 if sep != "," else ["ENZ"] * 5,
+        }
+    )
+    output = str(tmp_path / "waveform.idx")
+    data_list = build_index(write_csv(tmp_path / "waveform.csv", df, sep), output, chunksize=chunksize)
+
+    assert is_index(output) and not is_index(str(tmp_path))
+    assert len(data_list) == 5
+    assert list(data_list) == list(df["fname"])
+    assert data_list[-1] == "e.npz"
+    with pytest.raises(IndexError):
+        data_list[5]
+    np.testing.assert_array_equal(data_list.columns["itp"], df["itp"].to_numpy(dtype=float))
+    np.testing.assert_array_equal(data_list.columns["its"], df["its"].to_numpy(dtype=float))
+    assert "snr" not in data_list.columns
+
+
+def test_non_numeric_column(tmp_path):
+    df = pd.DataFrame({"fname": ["a.npz", "b.npz"], "itp": [1, 2], "snr": ["high", 3]})
+    data_list = build_index(write_csv(tmp_path / "list.csv", df), str(tmp_path / "idx"), chunksize=1)
+    assert set(data_list.columns) == {"itp"}
+
+
+def test_pickle(tmp_path):
+    df = pd.DataFrame({"fname": [f"event_{i}.npz" for i in range(100)]})
+    data_list = build_index(write_csv(tmp_path / "list.csv", df), str(tmp_path / "idx"))
+    state = pickle.dumps(data_list)
+    assert len(state) < 1000
+    assert list(pickle.loads(state)) == list(df["fname"])
+
+
+def test_empty(tmp_path):
+    (tmp_path / "list.csv").write_text("fname,itp\n")
+    data_list = build_index(str(tmp_path / "list.csv"), str(tmp_path / "idx"))
+    assert len(data_list) == 0
+    assert list(data_list) == []
@@ -0,0 +1,76 @@
+import pickle
+
+import h5py
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("obspy")
+import data_reader
+from data_reader import DataReader, EventPool
+
+
+class FakeReader:
+    """
+    The part of DataReader that EventPool uses: num_data events of 100 samples with one P and one S pick.
+    """
+
+    def __init__(self, num_data=8, broken=()):
+        self.num_data = num_data
+        self.broken = broken
+        self.buffer = {}
+
+    def read_meta(self, i):
+        if i in self.broken:
+            return None
+        rng = np.random.default_rng(i)
+        return {"data": rng.normal(size=(100, 1, 3)), "itp": [[10 + i]], "its": [[50 + i]]}
+
+
+@pytest.mark.parametrize("shared", [True, False])
+def test_event_pool_pickle(monkeypatch, shared):
+    if not shared:
+        # Python < 3.8
+        monkeypatch.setattr(data_reader, "shared_memory", None)
+    pool = EventPool(FakeReader(), size=5, seed=0)
+    assert len(pool) == 5
+    assert (pool.shm is not None) == shared
+
+    copy = pickle.loads(pickle.dumps(pool))
+    np.testing.assert_array_equal(copy.data, pool.data)
+    assert (copy.itp, copy.its) == (pool.itp, pool.its)
+
+    data, itp, its = copy.sample(np.random.default_rng(1))
+    k = pool.itp.index(itp)
+    np.testing.assert_array_equal(data, pool.data[k])
+    assert its == pool.its[k]
+
+
+def test_event_pool_seed():
+    itp = EventPool(FakeReader(), size=4, seed=1).itp
+    np.random.seed(0)
+    assert EventPool(FakeReader(), size=4, seed=1).itp == itp
+    assert EventPool(FakeReader(), size=4, seed=2).itp != itp
+
+
+def test_event_pool_unreadable():
+    pool = EventPool(FakeReader(broken=[0, 1]), size=8, seed=0)
+    assert len(pool) == 6
+    with pytest.raises(ValueError, match="none of the 8"):
+        EventPool(FakeReader(broken=range(8)), size=8, seed=0)
+
+
+def test_hdf5_reader_pickle(tmp_path):
+    fname = str(tmp_path / "data.h5")
+    with h5py.File(fname, "w") as fp:
+        for i in range(3):
+            fp.create_dataset(f"data/event_{i}", data=np.full((100, 3), i, dtype="float32"))
+    reader = DataReader(format="hdf5", hdf5_file=fname, hdf5_group="data")
+    reader.buffer["event_0"] = "cached"
+
+    # the copy opens the file itself, as a TrainLoader worker does
+    copy = pickle.loads(pickle.dumps(reader))
+    assert copy.h5 is not reader.h5
+    assert copy.buffer == {}
+    assert copy.data_list == reader.data_list
+    np.testing.assert_array_equal(copy.h5_data["event_2"][()], reader.h5_data["event_2"][()])
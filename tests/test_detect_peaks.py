@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from detect_peaks import StreamingPeakDetector, detect_peaks
+
+
+def smooth_noise(rng, nt):
+    x = np.convolve(rng.random(nt), np.ones(20) / 20, mode="same")
+    ## plateaus and exact ties
+    return np.round(x, 2)
+
+
+@pytest.mark.parametrize("mpd", [1, 10, 50])
+@pytest.mark.parametrize("chunk", [1, 7, 333, 5000])
+def test_streaming_matches_detect_peaks(mpd, chunk):
+    rng = np.random.default_rng(mpd * 1000 + chunk)
+    for _ in range(5):
+        x = smooth_noise(rng, 3000)
+        mph = float(np.quantile(x, 0.5))
+        detector = StreamingPeakDetector(mph=mph, mpd=mpd)
+        ind, val = [], []
+        for i in range(0, len(x), chunk):
+            ind_, val_ = detector.update(x[i : i + chunk])
+            ind.extend(ind_)
+            val.extend(val_)
+        ind_, val_ = detector.flush()
+        ind.extend(ind_)
+        val.extend(val_)
+
+        expected_ind, expected_val = detect_peaks(x, mph=mph, mpd=mpd)
+        np.testing.assert_array_equal(ind, expected_ind)
+        np.testing.assert_array_equal(val, expected_val)
+
+
+def test_streaming_empty_and_short():
+    detector = StreamingPeakDetector(mph=0.3, mpd=50)
+    ind, val = detector.update(np.array([]))
+    assert len(ind) == len(val) == 0
+    detector.update(np.array([0.0, 0.5]))
+    ind, _ = detector.update(np.array([0.1]))
+    ind_, _ = detector.flush()
+    np.testing.assert_array_equal(np.concatenate([ind, ind_]), [1])
+
+
+def test_equal_heights_later_peak_wins():
+    ## 40 peaks of the same height 3 samples apart: with mpd=4 the greedy pass starts from the last one
+    x = np.zeros(125)
+    x[2:122:3] = 1.0
+    ind, _ = detect_peaks(x, mph=0.5, mpd=4)
+    np.testing.assert_array_equal(ind, np.arange(119, 1, -6)[::-1])
+
+    detector = StreamingPeakDetector(mph=0.5, mpd=4)
+    ind_stream = []
+    for i in range(0, len(x), 10):
+        ind_stream.extend(detector.update(x[i : i + 10])[0])
+    ind_stream.extend(detector.flush()[0])
+    np.testing.assert_array_equal(ind_stream, ind)
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from gamma_client import CircuitOpenError, GammaClient
+
+
+class StubGamma(BaseHTTPRequestHandler):
+    """
+    Minimal GAMMA API: answers /predict and /predict_stream with the number of picks it got,
+    or with HTTP 500 while server.fail is set. Records each request and the client port it came from.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append((self.path, payload, self.client_address[1]))
+        if self.server.fail:
+            status, body = 500, b"{}"
+        else:
+            status, body = 200, json.dumps({"catalog": [], "num_picks": len(payload["picks"])}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubGamma)
+    server.requests = []
+    server.fail = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def test_coalesce(server):
+    async def run():
+        client = GammaClient(url(server), coalesce_ms=50)
+        results = await asyncio.gather(*[client.predict_stream([{"id": i}] * (i + 1)) for i in range(3)])
+        await client.aclose()
+        return results
+
+    results = asyncio.run(run())
+    assert [r["num_picks"] for r in results] == [6, 6, 6]
+    assert [path for path, _, _ in server.requests] == ["/predict_stream"]
+
+
+def test_coalesce_cancelled_caller(server):
+    async def run():
+        client = GammaClient(url(server), coalesce_ms=50)
+        cancelled = asyncio.ensure_future(client.predict_stream([{"id": 0}]))
+        kept = asyncio.ensure_future(client.predict_stream([{"id": 1}]))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        result = await asyncio.wait_for(kept, 5)
+        await client.aclose()
+        return result
+
+    assert asyncio.run(run())["num_picks"] == 2
+
+
+def test_circuit_breaker(server):
+    async def run():
+        client = GammaClient(url(server), failure_threshold=2, reset_timeout=0.2)
+        server.fail = True
+        for _ in range(2):
+            with pytest.raises(Exception):
+                await client.predict([])
+        assert client.state == "open"
+        with pytest.raises(CircuitOpenError):
+            await client.predict([])
+        assert len(server.requests) == 2
+
+        # a failed trial call opens the circuit again
+        time.sleep(0.25)
+        assert client.state == "half-open"
+        with pytest.raises(Exception):
+            await client.predict([])
+        assert client.state == "open"
+
+        # a successful trial call closes it
+        server.fail = False
+        time.sleep(0.25)
+        result = await client.predict([{"id": 0}])
+        assert client.state == "closed"
+        await client.aclose()
+        return result
+
+    assert asyncio.run(run())["num_picks"] == 1
+
+
+def test_pool_reuse(server):
+    async def run():
+        client = GammaClient(url(server), max_connections=2)
+        for _ in range(5):
+            await client.predict([])
+        await asyncio.gather(*[client.predict([]) for _ in range(10)])
+        await client.aclose()
+
+    asyncio.run(run())
+    ports = {port for _, _, port in server.requests}
+    assert len(server.requests) == 15
+    assert len(ports) <= 2
@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from inference_worker import WorkerPool, worker_loop
+
+
+def fake_worker(worker_id, checkpoint, task_queue, result_queue, intra_op_threads, inter_op_threads, warmup_shapes):
+    """
+    Stand-in for worker_main without TensorFlow: predicts vec * 2; the first sample of a batch selects
+    a failure: -1 exits the process, 2 sleeps 1 s, 3 sleeps 3 s, 4 raises.
+    """
+
+    def run(vec):
+        flag = vec.flat[0]
+        if flag == -1:
+            os._exit(1)
+        if flag in (2, 3):
+            time.sleep(1 if flag == 2 else 3)
+        if flag == 4:
+            raise ValueError("bad batch")
+        return vec * 2
+
+    worker_loop(worker_id, run, task_queue, result_queue)
+
+
+def batch(flag, nsta=2, nt=16):
+    vec = np.ones([nsta, nt, 1, 3], dtype=np.float32)
+    vec.flat[0] = flag
+    return vec
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool(None, num_workers=2, task_timeout=10, target=fake_worker)
+    assert pool.wait_ready(timeout=60)
+    yield pool
+    pool.close()
+
+
+def test_run(pool):
+    vec = batch(1)
+    np.testing.assert_array_equal(pool.run(vec), vec * 2)
+    with pytest.raises(RuntimeError, match="bad batch"):
+        pool.run(batch(4))
+    np.testing.assert_array_equal(pool.run(vec), vec * 2)
+
+
+def test_worker_death_fails_only_its_task(pool):
+    results = {}
+
+    def run(name, vec):
+        try:
+            results[name] = pool.run(vec)
+        except Exception as error:
+            results[name] = error
+
+    slow = threading.Thread(target=run, args=("slow", batch(2)))
+    slow.start()
+    time.sleep(0.2)
+    run("dead", batch(-1))
+    slow.join(20)
+
+    assert isinstance(results["dead"], RuntimeError)
+    np.testing.assert_array_equal(results["slow"], batch(2) * 2)
+    # the remaining worker keeps serving
+    vec = batch(1)
+    np.testing.assert_array_equal(pool.run(vec), vec * 2)
+
+
+def test_task_timeout():
+    pool = WorkerPool(None, num_workers=2, task_timeout=0.5, target=fake_worker)
+    try:
+        assert pool.wait_ready(timeout=60)
+        with pytest.raises(TimeoutError):
+            pool.run(batch(3))
+        # the late result is ignored, and the next batch gets its own
+        vec = batch(1)
+        np.testing.assert_array_equal(pool.run(vec), vec * 2)
+        assert len(pool.blocks) == 2
+        # the timed-out block is unlinked once its result comes in
+        deadline = time.monotonic() + 10
+        while pool.abandoned and (time.monotonic() < deadline):
+            time.sleep(0.05)
+        assert pool.abandoned == {}
+        assert len(pool.blocks) == 1
+        np.testing.assert_array_equal(pool.run(vec), vec * 2)
+    finally:
+        pool.close()
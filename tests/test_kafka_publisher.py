@@ -0,0 +1,166 @@
+import json
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from kafka_publisher import KafkaPublisher, decode_waveform
+
+
+class FakeFuture:
+    def __init__(self, error=None):
+        self.error = error
+
+    def add_callback(self, fn):
+        if self.error is None:
+            fn(None)
+        return self
+
+    def add_errback(self, fn):
+        if self.error is not None:
+            fn(self.error)
+        return self
+
+
+class FakeProducer:
+    """
+    In-process stand-in for KafkaProducer: keeps (topic, key, value, headers) in messages.
+    fail makes every delivery report an error, raises makes the first raises sends throw,
+    and block holds send until the event is set.
+    """
+
+    def __init__(self, fail=False, raises=0, block=None):
+        self.messages = []
+        self.fail = fail
+        self.raises = raises
+        self.block = block
+        self.calls = 0
+        self.flushed = False
+
+    def send(self, topic, value=None, key=None, headers=None):
+        self.calls += 1
+        if self.block is not None:
+            self.block.wait()
+        if self.calls <= self.raises:
+            raise BufferError("fake buffer full")
+        self.messages.append((topic, key, value, headers))
+        return FakeFuture(Exception("fake broker error") if self.fail else None)
+
+    def flush(self, timeout=None):
+        self.flushed = True
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def pick(id, type="p"):
+    return {"id": id, "timestamp": "2020-01-01T00:00:00.000", "prob": np.float32(0.9), "amp": 1.0, "type": type}
+
+
+def test_json_format():
+    producer = FakeProducer()
+    publisher = KafkaPublisher(producer)
+    publisher.publish_picks([pick("CI.A.."), pick("CI.B.."), pick("CI.A..", "s")])
+    vec = np.arange(12, dtype=np.float32).reshape(4, 3)
+    publisher.publish_waveforms(["CI.A..HH"], ["2020-01-01T00:00:00.000"], [vec], 0.01)
+    publisher.close()
+
+    picks = [(key, json.loads(value), headers) for topic, key, value, headers in producer.messages if topic == "phasenet_picks"]
+    assert [key for key, _, _ in picks] == ["CI.A..", "CI.B..", "CI.A.."]
+    assert picks[2][1] == {"id": "CI.A..", "timestamp": "2020-01-01T00:00:00.000", "prob": pytest.approx(0.9), "amp": 1.0, "type": "s"}
+    assert all(headers == [] for _, _, headers in picks)
+
+    topic, key, value, headers = producer.messages[-1]
+    assert (topic, key, headers) == ("waveform_phasenet", "CI.A..HH", [])
+    assert json.loads(value) == {"timestamp": "2020-01-01T00:00:00.000", "vec": vec.tolist(), "dt": 0.01}
+    assert producer.flushed
+
+
+def test_binary_picks_keyed_by_station():
+    producer = FakeProducer()
+    publisher = KafkaPublisher(producer, wire_format="binary")
+    publisher.publish_picks([pick("CI.A.."), pick("CI.B.."), pick("CI.A..", "s")])
+    publisher.publish_picks([])
+    publisher.close()
+
+    assert [key for _, key, _, _ in producer.messages] == ["CI.A..", "CI.B.."]
+    assert [len(json.loads(value)) for _, _, value, _ in producer.messages] == [2, 1]
+    assert all(dict(headers)["format"] == b"binary" for _, _, _, headers in producer.messages)
+    assert publisher.stats()["delivered"] == 2
+
+
+def test_binary_waveform():
+    producer = FakeProducer()
+    publisher = KafkaPublisher(producer, wire_format="binary")
+    vec = np.arange(12, dtype=np.float32).reshape(4, 3)
+    publisher.publish_waveforms(["CI.A..HH"], ["2020-01-01T00:00:00.000"], [vec], 0.01)
+    publisher.close()
+
+    topic, key, value, headers = producer.messages[0]
+    assert (topic, key) == ("waveform_phasenet", "CI.A..HH")
+    np.testing.assert_array_equal(decode_waveform(value), vec)
+    assert dict(headers) == {"format": b"binary", "timestamp": b"2020-01-01T00:00:00.000", "dt": b"0.01"}
+
+
+def test_wire_format():
+    with pytest.raises(ValueError):
+        KafkaPublisher(FakeProducer(), wire_format="avro")
+
+
+def test_queue_overflow_drops():
+    block = threading.Event()
+    publisher = KafkaPublisher(FakeProducer(block=block), max_queue=2)
+    for i in range(5):
+        publisher.publish_picks([pick(f"S{i}")])
+    # one message is held in send, two wait in the queue, the rest are dropped
+    wait_for(lambda: publisher.stats()["dropped"] + publisher.stats()["enqueued"] == 5)
+    assert publisher.stats()["dropped"] >= 2
+    block.set()
+    publisher.close()
+    stats = publisher.stats()
+    assert stats["delivered"] == stats["enqueued"] == 5 - stats["dropped"]
+
+
+def test_retry():
+    producer = FakeProducer(raises=2)
+    publisher = KafkaPublisher(producer, retries=3, retry_backoff=0.001)
+    publisher.publish_picks([pick("S")])
+    publisher.close()
+    stats = publisher.stats()
+    assert (stats["retried"], stats["delivered"], stats["failed"]) == (2, 1, 0)
+
+    producer = FakeProducer(raises=10)
+    publisher = KafkaPublisher(producer, retries=2, retry_backoff=0.001)
+    publisher.publish_picks([pick("S")])
+    publisher.close()
+    stats = publisher.stats()
+    assert (stats["retried"], stats["delivered"], stats["failed"]) == (2, 0, 1)
+    assert producer.calls == 3
+
+
+def test_delivery_error():
+    publisher = KafkaPublisher(FakeProducer(fail=True))
+    publisher.publish_picks([pick("S")])
+    publisher.close()
+    stats = publisher.stats()
+    assert (stats["sent"], stats["delivered"], stats["failed"]) == (1, 0, 1)
+
+
+def test_close_with_full_queue():
+    block = threading.Event()
+    publisher = KafkaPublisher(FakeProducer(block=block), max_queue=1)
+    publisher.publish_picks([pick("S0")])
+    wait_for(lambda: publisher.queue.qsize() == 0)
+    publisher.publish_picks([pick("S1")])
+
+    start = time.monotonic()
+    publisher.close(timeout=0.2)
+    assert time.monotonic() - start < 1
+    block.set()
+    publisher.thread.join(1)
+    assert not publisher.thread.is_alive()
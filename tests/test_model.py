@@ -0,0 +1,42 @@
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+from model import ModelConfig, UNet
+
+
+def save_checkpoint(config, model_dir):
+    graph = tf.Graph()
+    with graph.as_default():
+        UNet(config, mode="pred")
+        with tf.compat.v1.Session(graph=graph) as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            tf.compat.v1.train.Saver().save(sess, str(model_dir / "model_0.ckpt"))
+
+
+def test_restore_architecture(tmp_path):
+    # the layout of train_fn: config.log in the run directory, checkpoints in its models directory
+    model_dir = tmp_path / "models"
+    model_dir.mkdir()
+    config = ModelConfig(depths=3, filters_root=4, kernel_size=[5, 1])
+    config.write_log(str(tmp_path))
+    save_checkpoint(config, model_dir)
+
+    restored = ModelConfig().update_log(str(model_dir))
+    assert (restored.depths, restored.filters_root, restored.kernel_size) == (3, 4, [5, 1])
+    graph = tf.Graph()
+    with graph.as_default():
+        UNet(restored, mode="pred")
+        with tf.compat.v1.Session(graph=graph) as sess:
+            tf.compat.v1.train.Saver().restore(sess, tf.train.latest_checkpoint(str(model_dir)))
+
+
+def test_update_log(tmp_path):
+    # config.log next to the checkpoints takes precedence over the one of the run directory
+    model_dir = tmp_path / "models"
+    model_dir.mkdir()
+    ModelConfig(depths=3).write_log(str(tmp_path))
+    ModelConfig(depths=4, separable=True).write_log(str(model_dir))
+    config = ModelConfig().update_log(str(model_dir) + "/")
+    assert (config.depths, config.separable, config.filters_root) == (4, True, 8)
+
+    assert ModelConfig().update_log(str(tmp_path / "other" / "models")).depths == 5
@@ -0,0 +1,30 @@
+import pytest
+
+pytest.importorskip("tensorflow")
+from model import ModelConfig
+from model_stats import conv_cost, model_stats
+
+
+def test_conv_cost():
+    assert conv_cost(7, 3, 8, 100) == (168, 16800)
+    assert conv_cost(7, 3, 8, 100, bias=True) == (176, 17600)
+    assert conv_cost(7, 4, 8, 10, separable=True) == (60, 600)
+
+
+def test_dilation():
+    stats = model_stats(ModelConfig())
+    dilated = model_stats(ModelConfig(dilation_rate=[2, 1]))
+    assert (dilated["params"], dilated["flops"], dilated["bn_statistics"]) == (
+        stats["params"],
+        stats["flops"],
+        stats["bn_statistics"],
+    )
+    assert dilated["receptive_field"] > stats["receptive_field"]
+
+
+def test_separable():
+    stats = model_stats(ModelConfig())
+    separable = model_stats(ModelConfig(separable=True))
+    assert separable["params"] < stats["params"]
+    assert separable["flops"] < stats["flops"]
+    assert separable["receptive_field"] == stats["receptive_field"]
@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+
+from postprocess import (
+    Picks,
+    PicksJsonlWriter,
+    extract_amplitude,
+    extract_amplitude_stream,
+    match_picks,
+    read_picks_json,
+    save_picks_json,
+)
+
+
+def random_picks(rng, nt, nsta):
+    p_idx = [sorted(rng.choice(nt - 10, size=rng.integers(0, 6), replace=False).tolist()) for _ in range(nsta)]
+    s_idx = [sorted(rng.choice(nt - 10, size=rng.integers(0, 6), replace=False).tolist()) for _ in range(nsta)]
+    return Picks("a", "a", "t0", p_idx, [[]] * nsta, s_idx, [[]] * nsta)
+
+
+@pytest.mark.parametrize("chunk", [10, 777, 5000, 20000])
+def test_extract_amplitude_stream(chunk):
+    rng = np.random.default_rng(chunk)
+    for _ in range(5):
+        data = rng.normal(size=(12000, 2, 3))
+        picks = random_picks(rng, len(data), data.shape[1])
+        expected = extract_amplitude(data[np.newaxis, ...], [picks])[0]
+        chunks = (data[i : i + chunk] for i in range(0, len(data), chunk))
+        amps = extract_amplitude_stream(chunks, picks)
+        for phase in ["p_amp", "s_amp"]:
+            for x, y in zip(getattr(amps, phase), getattr(expected, phase)):
+                np.testing.assert_allclose(x, y)
+
+
+def test_extract_amplitude_stream_order():
+    ## picks out of time order get the amplitudes of the same picks in order
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(6000, 1, 3))
+    picks = Picks("a", "a", "t0", [[4000, 100, 2500]], [[]], [[5000, 300]], [[]])
+    ordered = Picks("a", "a", "t0", [[100, 2500, 4000]], [[]], [[300, 5000]], [[]])
+    amps = extract_amplitude_stream((data[i : i + 500] for i in range(0, 6000, 500)), picks)
+    expected = extract_amplitude_stream([data], ordered)
+    np.testing.assert_allclose(amps.p_amp[0], np.array(expected.p_amp[0])[[2, 0, 1]])
+    np.testing.assert_allclose(amps.s_amp[0], np.array(expected.s_amp[0])[[1, 0]])
+
+
+def optimal_matching(pred_idx, true_idx, tol, pred_trace, true_trace):
+    from scipy.optimize import linear_sum_assignment
+
+    pair = np.asarray(pred_idx, dtype=float)[np.newaxis, :] - np.asarray(true_idx, dtype=float)[:, np.newaxis]
+    ok = (np.abs(pair) <= tol) & (np.asarray(pred_trace)[np.newaxis, :] == np.asarray(true_trace)[:, np.newaxis])
+    cost = np.where(ok, np.abs(pair) - 1e6, 0)
+    row, col = linear_sum_assignment(cost)
+    keep = ok[row, col]
+    return keep.sum(), np.abs(pair[row[keep], col[keep]]).sum()
+
+
+def test_match_picks_optimal():
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        num_true, num_pred = rng.integers(0, 12, size=2)
+        true_idx = rng.integers(0, 100, size=num_true)
+        pred_idx = rng.integers(0, 100, size=num_pred)
+        true_trace = rng.integers(0, 2, size=num_true)
+        pred_trace = rng.integers(0, 2, size=num_pred)
+        tol = int(rng.integers(1, 10))
+        TP, FP, FN, residual = match_picks(pred_idx, true_idx, tol, pred_trace, true_trace)
+        expected_TP, expected_residual = optimal_matching(pred_idx, true_idx, tol, pred_trace, true_trace)
+        assert TP == expected_TP
+        assert (FP, FN) == (num_pred - TP, num_true - TP)
+        assert len(residual) == TP
+        assert np.all(np.abs(residual) <= tol)
+        np.testing.assert_allclose(np.abs(residual).sum(), expected_residual)
+
+
+def test_match_picks_close_picks():
+    ## nearest-first would pair 2 with 1 and leave 0 and 3 unmatched
+    TP, FP, FN, residual = match_picks([1, 3], [0, 2], tol=1)
+    assert (TP, FP, FN) == (2, 0, 0)
+    np.testing.assert_array_equal(residual, [1, 1])
+
+
+def test_match_picks_tolerance():
+    assert match_picks([10], [13], tol=3)[0] == 1
+    assert match_picks([10], [13], tol=3, inclusive=False)[0] == 0
+    ## picks of different traces are never paired
+    assert match_picks([10], [10], tol=3, pred_trace=[0], true_trace=[1])[0] == 0
+    assert match_picks([np.nan, 5], [5, np.nan], tol=1) == (1, 0, 0, pytest.approx([0]))
+    assert match_picks([], [5], tol=1)[:3] == (0, 0, 1)
+
+
+@pytest.mark.parametrize("fname", ["picks.json", "picks.jsonl", "picks.jsonl.gz"])
+def test_read_picks_json(tmp_path, fname):
+    picks = [
+        Picks("a.npz", "CX.PB01", "2020-01-01T00:00:00.000", [[100, 2000]], [np.array([0.5, 0.9])], [[300]], [np.array([0.7])]),
+        Picks("b.npz", "CX.PB02", "2020-01-01T00:00:00.000", [[]], [[]], [[]], [[]]),
+    ]
+    if fname == "picks.json":
+        save_picks_json(picks, str(tmp_path), dt=0.01, fname=fname)
+    else:
+        with PicksJsonlWriter(str(tmp_path / fname)) as writer:
+            writer.write(picks, dt=0.01)
+    df = read_picks_json(str(tmp_path / fname))
+    assert len(df) == 3
+    assert sorted(df["type"]) == ["p", "p", "s"]
+    assert set(df["id"]) == {"CX.PB01"}
+    if fname == "picks.json":
+        with pytest.raises(ValueError):
+            read_picks_json(str(tmp_path / fname), chunksize=2)
+    else:
+        chunks = list(read_picks_json(str(tmp_path / fname), chunksize=2))
+        assert [len(x) for x in chunks] == [2, 1]
+
+
+@pytest.mark.parametrize("fname", ["picks.json", "picks.jsonl", "picks.jsonl.gz"])
+def test_read_picks_json_empty(tmp_path, fname):
+    picks = [Picks("b.npz", "CX.PB02", "2020-01-01T00:00:00.000", [[]], [[]], [[]], [[]])]
+    if fname == "picks.json":
+        save_picks_json(picks, str(tmp_path), dt=0.01, fname=fname)
+    else:
+        with PicksJsonlWriter(str(tmp_path / fname)) as writer:
+            writer.write(picks, dt=0.01)
+    df = read_picks_json(str(tmp_path / fname))
+    assert len(df) == 0
+    assert list(df.columns) == ["id", "timestamp", "prob", "type"]
+    if fname != "picks.json":
+        assert list(read_picks_json(str(tmp_path / fname), chunksize=2)) == []
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+import prediction_cache
+from postprocess import Amplitudes, Picks
+from prediction_cache import PredictionCache, sizeof
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(prediction_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_key():
+    cache = PredictionCache(1000, namespace="model-a")
+    vec = np.arange(12, dtype=np.float32).reshape(4, 3)
+    assert cache.key(vec) == cache.key(vec.copy())
+    # the same samples in another layout, shape, dtype or namespace are different windows
+    assert cache.key(vec) == cache.key(np.asfortranarray(vec))
+    assert cache.key(vec) != cache.key(vec.reshape(3, 4))
+    assert cache.key(vec) != cache.key(vec.astype(np.float64))
+    assert cache.key(vec) != PredictionCache(1000, namespace="model-b").key(vec)
+
+
+def test_lru(clock):
+    cache = PredictionCache(30)
+    for key in "abc":
+        cache.put(key, key.upper(), 10)
+    assert cache.get("a") == "A"
+    cache.put("d", "D", 10)
+    # b is the least recently used
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["A", "C", "D"]
+    assert cache.nbytes == 30
+
+    cache.put("c", "C2", 20)
+    assert cache.get("c") == "C2"
+    assert cache.nbytes <= 30
+    assert len(cache) == 2
+
+    # larger than the whole cache
+    cache.put("e", "E", 31)
+    assert cache.get("e") is None
+
+
+def test_ttl(clock):
+    cache = PredictionCache(100, ttl=10)
+    cache.put("a", "A", 10)
+    clock[0] = 5
+    cache.put("b", "B", 10)
+    assert cache.get("a") == "A"
+    clock[0] = 10.5
+    assert cache.get("a") is None
+    assert cache.get("b") == "B"
+    assert cache.nbytes == 10
+
+    # expired entries at the head are evicted on put
+    clock[0] = 16
+    cache.put("c", "C", 10)
+    assert len(cache) == 1
+    assert cache.nbytes == 10
+
+
+def test_ttl_behind_lru_head(clock):
+    cache = PredictionCache(100, ttl=10)
+    cache.put("a", "A", 10)
+    clock[0] = 5
+    cache.put("b", "B", 10)
+    # a is the most recently used, but still expires first
+    assert cache.get("a") == "A"
+    clock[0] = 12
+    cache.put("c", "C", 10)
+    assert len(cache) == 2
+    assert cache.nbytes == 20
+    assert cache.get("a") is None
+
+
+def test_sizeof():
+    pred = np.zeros((3000, 1, 3), dtype=np.float32)
+    pick = Picks("0000", "0000", "1970-01-01T00:00:00.000", [[np.int64(1), np.int64(2)]], [[np.float32(0.5)] * 2], [[]], [[]])
+    amp = Amplitudes([[np.float32(1.0), np.float32(2.0)]], [[]])
+    assert sizeof(pred) == pred.nbytes
+    assert sizeof((pred, pick, amp)) == pred.nbytes + 2 * 4 + 23 + 2 * 8 + 2 * 4 + 2 * 4
+
+    cache = PredictionCache(10 ** 6)
+    cache.put("a", (pred, pick, amp))
+    assert cache.nbytes == sizeof((pred, pick, amp))
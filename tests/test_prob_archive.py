@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from postprocess import ProbArchive
+
+
+def windows(nt=3000, n=3, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.random((nt, 1, 3)).astype("float32") for _ in range(n)]
+
+
+@pytest.mark.parametrize("dtype, atol", [("float32", 0), ("float16", 1e-3), ("uint8", 0.5 / 255 + 1e-6)])
+def test_round_trip(tmp_path, dtype, atol):
+    probs = windows()
+    with ProbArchive(tmp_path / "prob.h5", mode="w", dtype=dtype, chunk_size=1000) as archive:
+        archive.write("CX.PB01", "2020-01-01T00:00:00.000", probs[0])
+        archive.write("CX.PB01", "2020-01-01T00:00:30.000", probs[1])
+        archive.write("CX.PB02", "2020-01-01T00:00:10.000", probs[2])
+
+    with ProbArchive(tmp_path / "prob.h5", mode="r") as archive:
+        assert sorted(archive.stations) == ["CX.PB01", "CX.PB02"]
+        t0, data = archive.read("CX.PB01")
+        assert t0 == "2020-01-01T00:00:00.000"
+        np.testing.assert_allclose(data, np.concatenate(probs[:2]), atol=atol)
+        np.testing.assert_array_equal(np.concatenate(list(archive.read_chunks("CX.PB01"))), data)
+
+        t0, data = archive.read("CX.PB01", starttime="2020-01-01T00:00:25.000", endtime="2020-01-01T00:00:35.000")
+        assert t0 == "2020-01-01T00:00:25.000"
+        np.testing.assert_allclose(data, np.concatenate(probs[:2])[2500:3500], atol=atol)
+
+        t0, data = archive.read("CX.PB02")
+        assert t0 == "2020-01-01T00:00:10.000"
+        np.testing.assert_allclose(data, probs[2], atol=atol)
+        assert not archive.has_amp("CX.PB02")
+
+
+def test_amplitude_and_gap(tmp_path):
+    probs = windows(n=2)
+    amp = np.random.default_rng(1).normal(size=(3000, 1, 3)).astype("float32")
+    with ProbArchive(tmp_path / "prob.h5", mode="w") as archive:
+        archive.write("CX.PB01", "2020-01-01T00:00:00.000", probs[0], amp=amp)
+        archive.write("CX.PB01", "2020-01-01T00:01:00.000", probs[1])
+
+    with ProbArchive(tmp_path / "prob.h5", mode="r") as archive:
+        _, data = archive.read("CX.PB01")
+        assert len(data) == 9000
+        np.testing.assert_array_equal(data[:3000], probs[0])
+        np.testing.assert_array_equal(data[3000:6000], 0)
+        np.testing.assert_array_equal(data[6000:], probs[1])
+        assert archive.has_amp("CX.PB01")
+        _, data = archive.read("CX.PB01", group="amp")
+        np.testing.assert_allclose(data, np.max(np.abs(amp), axis=-1, keepdims=True))
+
+
+@pytest.mark.parametrize("dtype", ["float32", "uint8"])
+def test_out_of_order(tmp_path, dtype):
+    probs = windows(n=4)
+    amps = [np.full((3000, 1, 3), i + 1, dtype="float32") for i in range(4)]
+    ## starts at 60 s, 0 s, 20 s and 10 s: the second and the last go before the start of the station
+    starts = ["2020-01-01T00:01:00.000", "2020-01-01T00:00:00.000", "2020-01-01T00:00:20.000", "2019-12-31T23:59:50.000"]
+    with ProbArchive(tmp_path / "prob.h5", mode="w", dtype=dtype, chunk_size=700) as archive:
+        for t0, prob, amp in zip(starts, probs, amps):
+            archive.write("CX.PB01", t0, prob, amp=amp)
+
+    expected = np.zeros((10000, 1, 3), dtype="float32")
+    expected_amp = np.zeros((10000, 1, 1), dtype="float32")
+    for begin, prob, amp in zip([7000, 1000, 3000, 0], probs, amps):
+        expected[begin : begin + 3000] = prob
+        expected_amp[begin : begin + 3000] = amp[..., :1]
+    with ProbArchive(tmp_path / "prob.h5", mode="r") as archive:
+        t0, data = archive.read("CX.PB01")
+        assert t0 == "2019-12-31T23:59:50.000"
+        np.testing.assert_allclose(data, expected, atol=0.5 / 255 + 1e-6 if dtype == "uint8" else 0)
+        t0, data = archive.read("CX.PB01", group="amp")
+        assert t0 == "2019-12-31T23:59:50.000"
+        np.testing.assert_array_equal(data, expected_amp)
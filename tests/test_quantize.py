@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("obspy")
+from quantize import TFLitePredictor
+
+
+class FakeInterpreter:
+    """
+    Echoes the first input channel and reports the distance of each sample to the nearest window edge.
+    """
+
+    def set_tensor(self, index, value):
+        self.value = value.copy()
+
+    def invoke(self):
+        nt = self.value.shape[1]
+        edge = np.minimum(np.arange(nt), np.arange(nt)[::-1])
+        self.out = np.zeros(self.value.shape[:-1] + (3,), dtype=np.float32)
+        self.out[..., 0] = self.value[..., 0]
+        self.out[..., 1] = edge[np.newaxis, :, np.newaxis]
+
+    def get_tensor(self, index):
+        return self.out
+
+
+def predictor(nt=300):
+    predictor = TFLitePredictor.__new__(TFLitePredictor)
+    predictor.interpreter = FakeInterpreter()
+    predictor.input = predictor.output = {"index": 0}
+    predictor.X_shape = [nt, 1, 3]
+    predictor.n_class = 3
+    return predictor
+
+
+@pytest.mark.parametrize("length", [1, 299, 300, 301, 500, 1000, 3001])
+def test_windows(length):
+    X = np.random.default_rng(length).normal(size=(2, length, 1, 3)).astype(np.float32)
+    preds = predictor().predict(X, overlap=100)
+    assert preds.shape == (2, length, 1, 3)
+    np.testing.assert_array_equal(preds[..., 0], X[..., 0])
+    # away from the ends of the record, every sample is at least overlap / 2 from a window edge
+    if length > 300:
+        assert preds[:, 50:-50, :, 1].min() >= 50
+
+
+def test_channels():
+    with pytest.raises(ValueError):
+        predictor().predict(np.zeros([1, 300, 1, 2], dtype=np.float32))
@@ -0,0 +1,58 @@
+import itertools
+
+import numpy as np
+import pytest
+
+import train_loader
+from train_loader import TrainLoader
+
+
+class FakeReader:
+    """
+    The part of DataReader_train that TrainLoader uses; sample i is filled with i plus a draw from rng.
+    """
+
+    def __init__(self, num_data=10):
+        self.num_data = num_data
+        self.dtype = "float32"
+        self.X_shape = [4, 1, 3]
+        self.Y_shape = [4, 1, 3]
+
+    def sample(self, i, rng):
+        X = np.full(self.X_shape, i, dtype=self.dtype) + rng.random()
+        return X, -X, f"event_{i}.npz"
+
+
+def take(loader, n):
+    try:
+        return list(itertools.islice(iter(loader), n))
+    finally:
+        loader.close()
+
+
+def test_reproducible_across_workers():
+    one = take(TrainLoader(FakeReader(), batch_size=3, num_workers=1, seed=7), 7)
+    three = take(TrainLoader(FakeReader(), batch_size=3, num_workers=3, seed=7), 7)
+    for (X1, Y1, f1), (X3, Y3, f3) in zip(one, three):
+        np.testing.assert_array_equal(X1, X3)
+        np.testing.assert_array_equal(Y1, -X1)
+        assert list(f1) == list(f3)
+
+    # each epoch of 10 events gives 3 full batches, and covers 9 different events
+    fname = np.concatenate([f for _, _, f in one[:3]])
+    assert len(set(fname)) == 9
+    other = take(TrainLoader(FakeReader(), batch_size=3, num_workers=1, seed=8), 1)
+    assert not np.array_equal(other[0][0], one[0][0])
+
+
+def test_keep_remainder():
+    batches = take(TrainLoader(FakeReader(), batch_size=4, num_workers=2, shuffle=False, drop_remainder=False), 3)
+    assert [len(f) for _, _, f in batches] == [4, 4, 2]
+    assert list(batches[2][2]) == [b"event_8.npz", b"event_9.npz"]
+
+
+def test_without_shared_memory(monkeypatch):
+    # Python < 3.8
+    monkeypatch.setattr(train_loader, "shared_memory", None)
+    with pytest.raises(RuntimeError):
+        TrainLoader(FakeReader(), batch_size=3)